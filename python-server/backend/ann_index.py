@@ -0,0 +1,276 @@
+"""
+IVF-PQ approximate nearest-neighbour index over normalized image embeddings.
+
+Layout (the classic inverted file with product quantization):
+- coarse quantizer: `nlist` k-means centroids; every vector goes to the
+  inverted list of its nearest centroid
+- product quantizer: the residual (vector - centroid) is split into `m`
+  sub-vectors and each is replaced by the id of its nearest of 256 sub-centroids,
+  so a 512-d float16 embedding (1 KiB) becomes `m` bytes
+- search probes the `nprobe` lists whose centroids score best against the
+  query. Inner product decomposes as q.c + sum_j q_j.r_j, so one lookup table
+  [m, 256] per query scores every code in every probed list
+
+Entries reference rows of the EmbeddingStore matrix rather than photoIDs, so the
+caller can re-rank candidates against the exact vectors it already has.
+
+Persistence: `save()` writes the codebooks plus list-ordered codes and rows as
+`.npy` files; `load()` memory-maps codes and rows, so opening a million-entry
+index reads only the small codebooks. Lists touched by later adds are copied
+into memory on first write.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_PQ_CENTROIDS = 256
+_PQ_TRAIN_ROWS = 16384
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 12, seed: int = 0,
+           block_rows: int = 16384) -> np.ndarray:
+    """Lloyd's k-means (L2), blocked so `data @ centroids.T` never exceeds one block.
+
+    Args:
+        data: float32[N, D] training vectors.
+        k: Number of centroids (N must be >= k).
+        iterations: Lloyd iterations.
+        seed: RNG seed for the initial sample and empty-cluster restarts.
+
+    Returns:
+        float32[k, D] centroids.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = assign_nearest(data, centroids, block_rows)
+        counts = np.bincount(assign, minlength=k)
+        # Segment sums over the rows sorted by cluster (np.add.at is far slower)
+        order = np.argsort(assign, kind='stable')
+        used = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts[used])[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[used] = np.add.reduceat(data[order], starts, axis=0)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None].astype(np.float32)
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_nearest(data: np.ndarray, centroids: np.ndarray, block_rows: int = 16384) -> np.ndarray:
+    """Index of the nearest (L2) centroid for every row of `data`."""
+    half_norms = 0.5 * (centroids * centroids).sum(axis=1)
+    out = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_rows):
+        block = np.asarray(data[start:start + block_rows], dtype=np.float32)
+        # argmin |x - c|^2 == argmax x.c - |c|^2 / 2
+        scores = block @ centroids.T
+        scores -= half_norms
+        out[start:start + len(block)] = scores.argmax(axis=1)
+    return out
+
+
+class IVFPQIndex:
+    """Inverted lists of product-quantized residuals, keyed by integer row."""
+
+    def __init__(self, dim: int, nlist: int, m: int):
+        if dim % m:
+            raise ValueError(f"dim {dim} is not divisible by m={m}")
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.dsub = dim // m
+        self.centroids: Optional[np.ndarray] = None   # float32[nlist, D]
+        self.codebooks: Optional[np.ndarray] = None   # float32[m, 256, dsub]
+        self._list_rows: List[np.ndarray] = [np.zeros(0, dtype=np.int64) for _ in range(nlist)]
+        self._list_codes: List[np.ndarray] = [np.zeros((0, m), dtype=np.uint8) for _ in range(nlist)]
+        self._list_of_row = np.full(0, -1, dtype=np.int32)
+        self._lock = threading.RLock()
+        self.covered_rows = 0  # rows of the source matrix already offered to add()
+        self.generation = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def __len__(self) -> int:
+        return int((self._list_of_row >= 0).sum())
+
+    # --- training / encoding ---
+
+    def train(self, sample: np.ndarray, iterations: int = 12, seed: int = 0) -> None:
+        """Fit the coarse quantizer and PQ codebooks on a sample of vectors."""
+        sample = np.ascontiguousarray(sample, dtype=np.float32)
+        if len(sample) < max(self.nlist, _PQ_CENTROIDS):
+            raise ValueError(f"Need at least {max(self.nlist, _PQ_CENTROIDS)} training vectors, got {len(sample)}")
+        centroids = kmeans(sample, self.nlist, iterations, seed)
+        # 256 centroids in a handful of dims converge on far fewer rows than the coarse quantizer
+        pq_sample = sample[np.random.default_rng(seed).permutation(len(sample))[:_PQ_TRAIN_ROWS]]
+        residuals = pq_sample - centroids[assign_nearest(pq_sample, centroids)]
+        codebooks = np.empty((self.m, _PQ_CENTROIDS, self.dsub), dtype=np.float32)
+        for j in range(self.m):
+            sub = np.ascontiguousarray(residuals[:, j * self.dsub:(j + 1) * self.dsub])
+            codebooks[j] = kmeans(sub, _PQ_CENTROIDS, iterations, seed + 1 + j)
+        with self._lock:
+            self.centroids, self.codebooks = centroids, codebooks
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (list id per vector, uint8[N, m] PQ codes of the residuals)."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        lists = assign_nearest(vectors, self.centroids)
+        residuals = vectors - self.centroids[lists]
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign_nearest(residuals[:, j * self.dsub:(j + 1) * self.dsub], self.codebooks[j])
+        return lists, codes
+
+    # --- writes ---
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        """Index (or re-index) `vectors` under integer `rows`."""
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        if len(rows) == 0:
+            return
+        lists, codes = self.encode(vectors)
+        with self._lock:
+            top = int(rows.max()) + 1
+            if top > len(self._list_of_row):
+                grown = np.full(max(top, 2 * len(self._list_of_row)), -1, dtype=np.int32)
+                grown[:len(self._list_of_row)] = self._list_of_row
+                self._list_of_row = grown
+            # Re-indexed rows leave their old list first (rare: only on rescans)
+            old = self._list_of_row[rows]
+            for lst in np.unique(old[old >= 0]):
+                keep = ~np.isin(self._list_rows[lst], rows)
+                self._list_rows[lst] = self._list_rows[lst][keep]
+                self._list_codes[lst] = self._list_codes[lst][keep]
+            order = np.argsort(lists, kind='stable')
+            bounds = np.flatnonzero(np.diff(lists[order])) + 1
+            for group in np.split(order, bounds):
+                lst = int(lists[group[0]])
+                self._list_rows[lst] = np.concatenate([self._list_rows[lst], rows[group]])
+                self._list_codes[lst] = np.concatenate([self._list_codes[lst], codes[group]])
+            self._list_of_row[rows] = lists
+
+    # --- reads ---
+
+    def search(self, query: np.ndarray, k: int = 20, nprobe: int = 16) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k by inner product.
+
+        Args:
+            query: float[D] query vector.
+            k: Number of candidates to return.
+            nprobe: Inverted lists to scan (more = better recall, slower).
+
+        Returns:
+            (rows int64[<=k], approximate scores float32[<=k]), best first.
+        """
+        q = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        with self._lock:
+            centroids, codebooks = self.centroids, self.codebooks
+            coarse = centroids @ q
+            nprobe = min(nprobe, self.nlist)
+            probe = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+            parts = [(self._list_rows[lst], self._list_codes[lst], coarse[lst]) for lst in probe]
+        parts = [p for p in parts if len(p[0])]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # lut[j, c] = q_j . codebook_j[c], flattened so codes index it with one take()
+        lut = np.einsum('mcd,md->mc', codebooks, q.reshape(self.m, self.dsub)).ravel()
+        offsets = np.arange(self.m, dtype=np.int64) * _PQ_CENTROIDS
+        rows = np.concatenate([p[0] for p in parts])
+        codes = np.concatenate([p[1] for p in parts])
+        scores = np.take(lut, codes.astype(np.int64) + offsets).sum(axis=1, dtype=np.float32)
+        scores += np.repeat(np.array([p[2] for p in parts], dtype=np.float32), [len(p[0]) for p in parts])
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return rows[top], scores[top]
+
+    def stats(self) -> Dict[str, object]:
+        sizes = np.array([len(r) for r in self._list_rows])
+        return {
+            'entries': int(sizes.sum()),
+            'nlist': self.nlist,
+            'm': self.m,
+            'bytes_per_vector': self.m,
+            'list_size_max': int(sizes.max()) if len(sizes) else 0,
+            'list_size_mean': round(float(sizes.mean()), 1) if len(sizes) else 0.0,
+            'covered_rows': self.covered_rows,
+        }
+
+    # --- persistence ---
+
+    def save(self, base_path: str) -> None:
+        """Write `<base>.ivfpq.<generation>.{npz,codes.npy,rows.npy}`, then `<base>.ivfpq.json`.
+
+        Each save writes a new generation because the previous one may still be
+        memory-mapped (replacing a mapped file fails on Windows); the JSON file
+        names the current generation and older ones are removed best-effort.
+        """
+        with self._lock:
+            sizes = np.array([len(r) for r in self._list_rows], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            rows = np.concatenate(self._list_rows) if sizes.sum() else np.zeros(0, dtype=np.int64)
+            codes = np.concatenate(self._list_codes) if sizes.sum() else np.zeros((0, self.m), dtype=np.uint8)
+            self.generation += 1
+            meta = {'dim': self.dim, 'nlist': self.nlist, 'm': self.m,
+                    'covered_rows': self.covered_rows, 'generation': self.generation}
+            centroids, codebooks = self.centroids, self.codebooks
+        prefix = f"{base_path}.ivfpq.{self.generation}"
+        np.save(f"{prefix}.codes.npy", codes)
+        np.save(f"{prefix}.rows.npy", rows)
+        np.savez(f"{prefix}.npz", centroids=centroids, codebooks=codebooks, offsets=offsets)
+        tmp = f"{base_path}.ivfpq.json.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, f"{base_path}.ivfpq.json")
+        folder, name = os.path.split(base_path)
+        for entry in os.listdir(folder or '.'):
+            if entry.startswith(f"{name}.ivfpq.") and not entry.startswith(f"{name}.ivfpq.{self.generation}.") \
+                    and not entry.endswith('.json'):
+                try:
+                    os.remove(os.path.join(folder, entry))
+                except OSError:
+                    pass  # still mapped; removed by a later save
+
+    @classmethod
+    def load(cls, base_path: str, mmap: bool = True) -> Optional['IVFPQIndex']:
+        """Open an index written by save(); None when there is none."""
+        meta_path = f"{base_path}.ivfpq.json"
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], meta['nlist'], meta['m'])
+        prefix = f"{base_path}.ivfpq.{meta['generation']}"
+        with np.load(f"{prefix}.npz") as data:
+            index.centroids = data['centroids'].astype(np.float32)
+            index.codebooks = data['codebooks'].astype(np.float32)
+            offsets = data['offsets']
+        mode = 'r' if mmap else None
+        codes = np.load(f"{prefix}.codes.npy", mmap_mode=mode)
+        rows = np.load(f"{prefix}.rows.npy", mmap_mode=mode)
+        # Slices of the memmap stay on disk until add() replaces them
+        index._list_rows = [rows[offsets[i]:offsets[i + 1]] for i in range(index.nlist)]
+        index._list_codes = [codes[offsets[i]:offsets[i + 1]] for i in range(index.nlist)]
+        list_of_row = np.full(int(rows.max()) + 1 if len(rows) else 0, -1, dtype=np.int32)
+        list_of_row[np.asarray(rows)] = np.repeat(np.arange(index.nlist, dtype=np.int32), np.diff(offsets))
+        index._list_of_row = list_of_row
+        index.covered_rows = int(meta.get('covered_rows', len(rows)))
+        index.generation = int(meta['generation'])
+        return index
+
+
+def default_nlist(count: int) -> int:
+    """~4 * sqrt(N) lists, a power of two between 64 and 8192."""
+    target = 4 * np.sqrt(max(count, 1))
+    return int(min(8192, max(64, 2 ** int(np.round(np.log2(target))))))
@@ -0,0 +1,418 @@
+"""
+Per-host tuning of inference threads and batch sizes.
+
+The best settings depend on the machine: an 8-core host and a 64-core host
+want different intra-op thread counts and batch sizes, and bf16 autocast only
+pays off on CPUs with native bf16. `tune()` benchmarks the configured
+classifier (and YOLO, in hybrid mode) over a small grid, one knob at a time:
+
+1. intra-op threads at a fixed batch
+2. image-tower batch size at the best thread count
+3. bf16 autocast (torch backends, CPUs with AVX512-BF16 / AMX only); kept
+   only when it is faster and embeddings stay within BF16_MIN_COSINE of fp32
+4. YOLO batch size (hybrid mode)
+
+The winning settings are saved in AUTOTUNE_FILE under a fingerprint of the
+host (CPU model, usable cores, memory, library versions, classifier) and
+applied on later starts by `startup()`. Settings given explicitly in the
+environment always win over a saved profile.
+
+Run `python -m backend.autotune` to tune the current host; see --help.
+"""
+import contextlib
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+import platform
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+TUNABLE_SETTINGS = (
+    'TORCH_INTRA_OP_THREADS',
+    'TORCH_INTER_OP_THREADS',
+    'CLIP_BATCH_SIZE',
+    'CLIP_AUTOCAST',
+    'YOLO_BATCH_SIZE',
+    'ONNX_INTRA_OP_THREADS',
+    'ONNX_BATCH_SIZE',
+)
+BATCH_CANDIDATES = (1, 4, 8, 16, 32)
+YOLO_BATCH_CANDIDATES = (1, 4, 8, 16)
+# bf16 must be at least this much faster, and this close to fp32, to be kept
+BF16_MIN_SPEEDUP = 1.10
+BF16_MIN_COSINE = 0.995
+# Installed versions of these distributions go into the host fingerprint. They are
+# read from package metadata, not sys.modules, so the CLI and the server (which
+# import different libraries before fingerprinting) compute the same key.
+FINGERPRINT_PACKAGES = ('torch', 'onnxruntime', 'onnxruntime-gpu', 'ultralytics')
+
+
+# --- host ---
+
+def _cpu_model() -> str:
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def usable_cpus() -> int:
+    """CPUs this process may run on (affinity mask and cgroup quota included)."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def host_fingerprint() -> Dict[str, Any]:
+    """What the best settings depend on; a change means re-tuning."""
+    from . import clip_switcher
+
+    try:
+        memory_gb = round(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 30)
+    except (ValueError, OSError, AttributeError):
+        memory_gb = None
+    versions = {}
+    for name in FINGERPRINT_PACKAGES:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    classifier = clip_switcher.DEFAULT_CLASSIFIER
+    return {
+        'cpu': _cpu_model(),
+        'machine': platform.machine(),
+        'cpus': usable_cpus(),
+        'memory_gb': memory_gb,
+        'versions': versions,
+        'classifier': classifier,
+        'hybrid': bool(_cfg.USE_HYBRID_CLASSIFICATION),
+    }
+
+
+def fingerprint_key(fingerprint: Dict[str, Any]) -> str:
+    raw = json.dumps(fingerprint, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+# --- profiles ---
+
+def load_profiles(path: Optional[str] = None) -> Dict[str, Any]:
+    path = path or _cfg.AUTOTUNE_FILE
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        logger.exception(f"Failed to read tuning profiles from {path}")
+        return {}
+
+
+def save_profile(fingerprint: Dict[str, Any], settings: Dict[str, Any], results: List[Dict[str, Any]],
+                 path: Optional[str] = None) -> None:
+    """Store the tuned settings for this host (atomic replace; other hosts' entries are kept)."""
+    path = path or _cfg.AUTOTUNE_FILE
+    profiles = load_profiles(path)
+    profiles[fingerprint_key(fingerprint)] = {
+        'host': fingerprint,
+        'settings': settings,
+        'results': results,
+        'tuned_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    }
+    tmp = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def saved_settings(fingerprint: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    entry = load_profiles().get(fingerprint_key(fingerprint or host_fingerprint()))
+    return entry['settings'] if entry else None
+
+
+# --- applying settings ---
+
+def apply_settings(settings: Dict[str, Any], override_env: bool = False) -> Dict[str, Any]:
+    """Copy tuned values into config and set torch's thread pools.
+
+    Args:
+        settings: Setting name -> value (names from TUNABLE_SETTINGS).
+        override_env: Also replace values given explicitly in the environment.
+
+    Returns:
+        The settings that were applied.
+    """
+    applied = {}
+    for key, value in settings.items():
+        if key not in TUNABLE_SETTINGS or (key in os.environ and not override_env):
+            continue
+        setattr(_cfg, key, value)
+        applied[key] = value
+    apply_torch_threads()
+    return applied
+
+
+def apply_torch_threads() -> None:
+    if _cfg.TORCH_INTRA_OP_THREADS <= 0 and _cfg.TORCH_INTER_OP_THREADS <= 0:
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    if _cfg.TORCH_INTRA_OP_THREADS > 0:
+        torch.set_num_threads(_cfg.TORCH_INTRA_OP_THREADS)
+    if _cfg.TORCH_INTER_OP_THREADS > 0 and torch.get_num_interop_threads() != _cfg.TORCH_INTER_OP_THREADS:
+        try:
+            torch.set_num_interop_threads(_cfg.TORCH_INTER_OP_THREADS)
+        except RuntimeError:
+            # Only possible before the first inter-op parallel work in this process
+            logger.warning('TORCH_INTER_OP_THREADS must be applied before any inference; ignored')
+
+
+def autocast_context(device: str):
+    """bf16 autocast for the torch image tower when CLIP_AUTOCAST asks for it (CPU only)."""
+    if _cfg.CLIP_AUTOCAST == 'bf16' and device == 'cpu':
+        import torch
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+# --- benchmarking ---
+
+def sample_images(count: int, directory: Optional[str] = None, size=(1280, 960)) -> list:
+    """Benchmark inputs: photos from `directory`, else deterministic synthetic images."""
+    from PIL import Image
+
+    images = []
+    if directory:
+        for name in sorted(os.listdir(directory)):
+            if len(images) >= count:
+                break
+            try:
+                images.append(Image.open(os.path.join(directory, name)).convert('RGB'))
+            except Exception:
+                continue
+    rng = np.random.default_rng(0)
+    while len(images) < count:
+        # Smooth gradients plus noise: decodes/resizes like a photo, unlike flat colour
+        y, x = np.mgrid[0:size[1], 0:size[0]]
+        base = np.stack([(x * rng.uniform(0.1, 0.3)) % 256, (y * rng.uniform(0.1, 0.3)) % 256,
+                         ((x + y) * rng.uniform(0.05, 0.2)) % 256], axis=-1)
+        noisy = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+        images.append(Image.fromarray(noisy))
+    return images
+
+
+def _throughput(fn: Callable[[list], Any], images: list, repeats: int) -> float:
+    """Images per second, best of `repeats` after one warm-up call."""
+    fn(images[:max(1, len(images) // 4)])
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn(images)
+        best = min(best, time.perf_counter() - t0)
+    return len(images) / best
+
+
+def thread_candidates(cpus: int) -> List[int]:
+    candidates = {cpus, max(1, cpus // 2), max(1, cpus * 3 // 4)}
+    t = 1
+    while t < cpus:
+        candidates.add(t)
+        t *= 2
+    return sorted(candidates)
+
+
+def _cosine(a: np.ndarray, b: np.ndarray) -> float:
+    return float((a * b).sum(axis=1).mean())
+
+
+def tune(images: Optional[list] = None, count: int = 32, repeats: int = 2,
+         threads: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Benchmark the configured pipeline on this host and return the best settings.
+
+    Args:
+        images: PIL images to benchmark with (default: `count` synthetic images).
+        count: Number of synthetic images when `images` is not given.
+        repeats: Timed passes per setting; the best is kept.
+        threads: Intra-op thread counts to try (default: powers of two up to the usable CPUs).
+
+    Returns:
+        Dict with `settings` (best values), `results` (every measurement) and `host`.
+    """
+    from . import clip_switcher
+
+    images = images or sample_images(count)
+    fingerprint = host_fingerprint()
+    threads = threads or thread_candidates(fingerprint['cpus'])
+    onnx = clip_switcher.CLIP_BACKEND in clip_switcher.ONNX_BACKENDS
+    results: List[Dict[str, Any]] = []
+    settings: Dict[str, Any] = {}
+    previous = {key: getattr(_cfg, key) for key in TUNABLE_SETTINGS}
+
+    def measure(stage: str, setting: Dict[str, Any], fn: Callable[[list], Any]) -> float:
+        for key, value in setting.items():
+            setattr(_cfg, key, value)
+        apply_torch_threads()
+        rate = _throughput(fn, images, repeats)
+        results.append({'stage': stage, **setting, 'images_per_sec': round(rate, 2)})
+        logger.info(f"autotune {stage} {setting}: {rate:.1f} images/s")
+        return rate
+
+    try:
+        if onnx:
+            from .onnx_mobile_clip_model import OnnxMobileCLIPPhotoClassifier
+
+            def onnx_session(t):
+                # Thread counts are fixed per session, so each candidate gets its own
+                _cfg.ONNX_INTRA_OP_THREADS = t
+                return OnnxMobileCLIPPhotoClassifier()
+
+            best_rate = 0.0
+            for t in threads:
+                rate = measure('threads', {'ONNX_INTRA_OP_THREADS': t}, onnx_session(t).embed_images)
+                if rate > best_rate:
+                    best_rate, settings['ONNX_INTRA_OP_THREADS'] = rate, t
+            clf = onnx_session(settings['ONNX_INTRA_OP_THREADS'])
+            if clf.dynamic_batch:
+                best_rate = 0.0
+                for b in BATCH_CANDIDATES:
+                    rate = measure('batch', {'ONNX_BATCH_SIZE': b}, clf.embed_images)
+                    if rate > best_rate:
+                        best_rate, settings['ONNX_BATCH_SIZE'] = rate, b
+        else:
+            clf = clip_switcher.get_clip_model()
+            best_rate = 0.0
+            for t in threads:
+                rate = measure('threads', {'TORCH_INTRA_OP_THREADS': t, 'CLIP_BATCH_SIZE': 8}, clf.embed_images)
+                if rate > best_rate:
+                    best_rate, settings['TORCH_INTRA_OP_THREADS'] = rate, t
+            _cfg.TORCH_INTRA_OP_THREADS = settings['TORCH_INTRA_OP_THREADS']
+            best_rate = 0.0
+            for b in BATCH_CANDIDATES:
+                rate = measure('batch', {'CLIP_BATCH_SIZE': b}, clf.embed_images)
+                if rate > best_rate:
+                    best_rate, settings['CLIP_BATCH_SIZE'] = rate, b
+            settings['CLIP_AUTOCAST'] = 'off'
+            if getattr(clf, 'device', 'cpu') == 'cpu' and cpu_supports_bf16():
+                _cfg.CLIP_BATCH_SIZE = settings['CLIP_BATCH_SIZE']
+                _cfg.CLIP_AUTOCAST = 'off'
+                reference = clf.embed_images(images)
+                rate = measure('autocast', {'CLIP_AUTOCAST': 'bf16'}, clf.embed_images)
+                cosine = _cosine(clf.embed_images(images), reference)
+                results[-1]['cosine_vs_fp32'] = round(cosine, 5)
+                if rate >= best_rate * BF16_MIN_SPEEDUP and cosine >= BF16_MIN_COSINE:
+                    settings['CLIP_AUTOCAST'] = 'bf16'
+
+        if _cfg.USE_HYBRID_CLASSIFICATION:
+            from .yolo_clip_hybrid import get_fast_yolo_model
+
+            yolo = get_fast_yolo_model()
+            best_rate = 0.0
+            for b in YOLO_BATCH_CANDIDATES:
+                def run(batch, b=b):
+                    for start in range(0, len(batch), b):
+                        yolo(batch[start:start + b], verbose=False)
+                rate = measure('yolo_batch', {'YOLO_BATCH_SIZE': b}, run)
+                if rate > best_rate:
+                    best_rate, settings['YOLO_BATCH_SIZE'] = rate, b
+    finally:
+        for key, value in previous.items():
+            setattr(_cfg, key, value)
+        apply_torch_threads()
+
+    return {'settings': settings, 'results': results, 'host': fingerprint}
+
+
+# --- entry points ---
+
+def startup() -> Dict[str, Any]:
+    """Apply this host's saved profile (tuning first when AUTOTUNE=tune and there is none).
+
+    Returns:
+        The settings that were applied (empty when nothing was).
+    """
+    mode = _cfg.AUTOTUNE
+    try:
+        if mode == 'off':
+            apply_torch_threads()
+            return {}
+        fingerprint = host_fingerprint()
+        settings = saved_settings(fingerprint)
+        if settings is None and mode == 'tune':
+            logger.info('No tuning profile for this host; benchmarking (AUTOTUNE=tune)...')
+            tuned = tune()
+            save_profile(fingerprint, tuned['settings'], tuned['results'])
+            settings = tuned['settings']
+        if settings is None:
+            apply_torch_threads()
+            return {}
+        applied = apply_settings(settings)
+        logger.info(f"Applied tuning profile {fingerprint_key(fingerprint)}: {applied}")
+        return applied
+    except Exception:
+        logger.exception('Failed to apply tuning profile; using configured defaults')
+        return {}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Tune inference threads and batch sizes for this host.')
+    parser.add_argument('--images', help='directory of sample photos (default: synthetic images)')
+    parser.add_argument('--count', type=int, default=32, help='images per measurement')
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--threads', type=int, nargs='+', help='intra-op thread counts to try')
+    parser.add_argument('--dry-run', action='store_true', help='print the result without saving it')
+    parser.add_argument('--show', action='store_true', help='print the saved profile for this host and exit')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    fingerprint = host_fingerprint()
+    print(f"host {fingerprint_key(fingerprint)}: {json.dumps(fingerprint)}")
+    if args.show:
+        print(json.dumps(load_profiles().get(fingerprint_key(fingerprint)), indent=2))
+        return
+    tuned = tune(sample_images(args.count, args.images), repeats=args.repeats, threads=args.threads)
+    for row in tuned['results']:
+        print(row)
+    print(f"best: {tuned['settings']}")
+    if not args.dry_run:
+        save_profile(fingerprint, tuned['settings'], tuned['results'])
+        print(f"saved to {_cfg.AUTOTUNE_FILE}")
+
+
+if __name__ == '__main__':
+    main()
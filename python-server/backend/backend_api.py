@@ -18,14 +18,17 @@ from fastapi import BackgroundTasks, Header
 # available in the global environment (this keeps the file runnable in editors
 # without changing runtime behavior when FastAPI *is* installed).
 try:
-    from fastapi import FastAPI, UploadFile, HTTPException, Header, File, Form
+    from fastapi import FastAPI, UploadFile, HTTPException, Header, File, Form, Request
     from fastapi.middleware.cors import CORSMiddleware
     from fastapi.staticfiles import StaticFiles
+    from fastapi.responses import FileResponse
 except Exception:  # pragma: no cover - editor fallback
     FastAPI = Any
     HTTPException = Exception
     CORSMiddleware = Any
     StaticFiles = Any
+    FileResponse = Any
+    Request = Any
 
 if TYPE_CHECKING:
     # Import types for static type checking (won't run at runtime in editors)
@@ -35,33 +38,41 @@ from .backend_main import process_single_image, get_model
 from .clip_model import get_clip_model, classify_image
 from .ocr_enhancement import enhance_screenshot_tag, is_ocr_available
 from . import tags_db as _tags_db
+from . import tags_snapshot as _tags_snapshot
+from . import score_store as _score_store
+from . import embedding_store as _embedding_store
+from . import duplicate_index as _duplicate_index
+from . import photo_clusters as _photo_clusters
+from . import autotune as _autotune
+from . import model_registry as _model_registry
+from . import pipeline_version as _pipeline_version
 from pydantic import BaseModel
-from .config import TEMP_FOLDER, TARGET_FOLDER, CONFIDENCE_THRESHOLD, CLIP_CONFIDENCE_THRESHOLD
+from .config import TEMP_FOLDER, TARGET_FOLDER, CONFIDENCE_THRESHOLD, CLIP_CONFIDENCE_THRESHOLD, DUPLICATE_HASHES_ENABLED, \
+    SIMILAR_GROUPS_ENABLED
+from .image_context import ImageContext
 from .model import load_model  # kept for legacy usage elsewhere
 import time
 import json
 from typing import Dict, List
 
 # File to persist tags server-side so tags survive app reinstall
-TAGS_DB_PATH = os.path.join(os.path.dirname(__file__), 'tags_db.json')
+TAGS_DB_PATH = _tags_db.TAGS_DB_PATH
 
 
-def _load_tags_db() -> Dict[str, List[str]]:
-    # Deprecated: use `tags_db` module helpers. Kept for backward compatibility in this file.
+def _load_tags_db(tenant: str | None = None) -> Dict[str, List[str]]:
+    # Deprecated: use `tags_db` module helpers. Reads the shared in-memory cache
+    # so this file never sees a stale copy of the DB.
     try:
-        if os.path.exists(TAGS_DB_PATH):
-            with open(TAGS_DB_PATH, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        return _tags_db._load_tags_db(tenant)
     except Exception:
         pass
     return {}
 
 
-def _save_tags_db(db: Dict[str, List[str]]) -> None:
+def _save_tags_db(db: Dict[str, List[str]], tenant: str | None = None) -> None:
     # Deprecated wrapper; prefer `tags_db.set_tags` and `tags_db.get_tags`.
     try:
-        with open(TAGS_DB_PATH, 'w', encoding='utf-8') as f:
-            json.dump(db, f, ensure_ascii=False, indent=2)
+        _tags_db._save_tags_db(db, tenant)
     except Exception:
         logging.warning('Failed to save tags DB')
 import logging
@@ -79,6 +90,28 @@ else:
     app.mount("/organized", StaticFiles(directory=TARGET_FOLDER), name="organized")
 # The model is loaded/managed by backend_main.get_model() when needed.
 
+
+@app.on_event("startup")
+def _apply_tuning_profile():
+    """Apply this host's saved thread/batch profile (see autotune.py) before serving."""
+    _autotune.startup()
+
+
+@app.on_event("shutdown")
+def _flush_tags_on_shutdown():
+    """Write any coalesced-but-unflushed tag updates before the process exits."""
+    try:
+        _tags_db.flush()
+    except Exception:
+        logging.exception('Failed to flush tags DB on shutdown')
+    try:
+        _score_store.flush()
+        _embedding_store.flush()
+        _duplicate_index.flush()
+        _photo_clusters.flush()
+    except Exception:
+        logging.exception('Failed to flush score/embedding/hash stores on shutdown')
+
 # Allow all origins (for testing), you can restrict later
 # Restrict CORS to local host by default for safety. Use `--allow-remote` or
 # set `ALLOW_ORIGINS` to a comma-separated list to loosen restrictions.
@@ -113,6 +146,21 @@ def _require_token(x_upload_token: str | None):
     if UPLOAD_TOKEN and x_upload_token != UPLOAD_TOKEN:
         raise HTTPException(status_code=403, detail='Forbidden')
 
+
+def _tenant(x_device_id: str | None, x_upload_token: str | None) -> str | None:
+    """Pick the tags DB shard for a request from its headers (see TAGS_DB_SHARDING).
+
+    Returns None (the global tags DB) when sharding is off or no tenant header is sent.
+    """
+    mode = srv_cfg.TAGS_DB_SHARDING
+    if mode in ('off', 'none'):
+        return None
+    if x_device_id:
+        return f"device:{x_device_id}"
+    if mode == 'device-or-token' and x_upload_token:
+        return f"token:{x_upload_token}"
+    return None
+
 # Optional Pillow import for EXIF stripping
 try:
     from PIL import Image
@@ -132,7 +180,8 @@ except Exception:
 
 # --- Routes ---
 @app.post("/process-image/")
-async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...), x_upload_token: str | None = Header(None)):
+async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...), x_upload_token: str | None = Header(None),
+                      x_device_id: str | None = Header(None), contentHash: str | None = Form(None)):
     """
     Upload an image and return all detected object tags (YOLO classes above threshold).
     """
@@ -169,15 +218,16 @@ async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...),
     try:
         t_read0 = time.time()
         data = await file.read()
-        # Strip EXIF if PIL available
+        # Decode once; EXIF stripping, hashing, CLIP, OCR and organizing share it
+        context = ImageContext(path=temp_path, data=data)
+        image_hashes = None
         try:
             if Image is not None and BytesIO is not None:
-                img_buf = BytesIO(data)
-                img = Image.open(img_buf)
-                out = BytesIO()
-                # Save without EXIF by not passing exif info; preserve PNG/JPEG format
-                img.save(out, format=img.format or "PNG")
-                data = out.getvalue()
+                # Save without EXIF by re-encoding; preserve PNG/JPEG format
+                data = context.stripped_bytes()
+                # The image is decoded now; hash it for /duplicates/
+                if DUPLICATE_HASHES_ENABLED:
+                    image_hashes = context.hashes
         except Exception:
             logging.warning("Failed to strip EXIF / image metadata; continuing with original image")
         t_read1 = time.time()
@@ -198,7 +248,7 @@ async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...),
         # categories like `food` are less likely to be filtered out by a
         # box-based confidence threshold (YOLO uses CONFIDENCE_THRESHOLD).
         clip_threshold = CLIP_CONFIDENCE_THRESHOLD if 'CLIP_CONFIDENCE_THRESHOLD' in globals() else CONFIDENCE_THRESHOLD
-        tags = classify_image(temp_path, confidence_threshold=clip_threshold, max_tags=max_tags)
+        tags = classify_image(context, confidence_threshold=clip_threshold, max_tags=max_tags)
         t1 = time.time()
         logging.info(f"CLIP classification for {file.filename} took {round((t1 - t0) * 1000)}ms")
         logging.info(f"Detected tags for {file.filename}: {tags}")
@@ -207,7 +257,7 @@ async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...),
         if tags and is_ocr_available():
             enhanced_tags = []
             for tag in tags:
-                enhanced_tag, specific = enhance_screenshot_tag(temp_path, tag)
+                enhanced_tag, specific = enhance_screenshot_tag(context, tag)
                 enhanced_tags.append(enhanced_tag)
                 if specific:
                     logging.info(f"Enhanced {tag} → {enhanced_tag} (detected: {specific})")
@@ -224,7 +274,7 @@ async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...),
     # Schedule organization as a background task (do not block API response)
     try:
         # Organize the file synchronously so the API can return the final URL/name
-        final_dst = process_single_image(temp_path, results, tags)
+        final_dst = process_single_image(temp_path, results, tags, context=context)
         if final_dst and isinstance(final_dst, str) and final_dst != 'skipped':
             rel_path = os.path.relpath(final_dst, TARGET_FOLDER)
             final_url = f"/organized/{rel_path.replace(os.sep, '/')}"
@@ -252,9 +302,11 @@ async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...),
     # Persist tags under provided `photoID` (tag-only mode required by architecture).
     try:
         try:
-            _tags_db.set_tags(photoID, tags)
+            _tags_db.set_tags(photoID, tags, tenant=_tenant(x_device_id, x_upload_token), content_hash=contentHash)
         except Exception:
             logging.exception('Failed to persist tags under photoID')
+        if image_hashes is not None:
+            _duplicate_index.record_hashes({photoID: image_hashes}, tenant=_tenant(x_device_id, x_upload_token))
     except Exception:
         pass
 
@@ -262,15 +314,32 @@ async def detect_tags(file: "UploadFile" = File(...), photoID: str = Form(...),
 
 
 @app.post("/process-images-batch/")
-async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str = Form(...), x_upload_token: str | None = Header(None)):
+async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str = Form(...), x_upload_token: str | None = Header(None),
+                            x_device_id: str | None = Header(None), contentHashes: str | None = Form(None),
+                            captureTimes: str | None = Form(None), classifier: str | None = Form(None),
+                            x_tier: str | None = Header(None)):
     """
     Upload multiple images and return detected tags for all (faster batch processing).
+    `contentHashes` is an optional JSON array parallel to `photoIDs`; the hashes are
+    stored with the tags so `/scan-plan/` can spot edited photos later.
+    `captureTimes` is an optional JSON array parallel to `photoIDs` (epoch seconds
+    or ms, or ISO-8601) used for `/similar-groups/`; EXIF dates are the fallback.
+    `classifier` (a model registry name, see `/models/`) or the `X-Tier` header
+    (CLASSIFIER_TIERS) picks a classifier other than the deployed one; its tags
+    are stamped with that pipeline's version.
     """
     _require_token(x_upload_token)
+    from . import clip_switcher as _clip_switcher
+    try:
+        classifier_name = _clip_switcher.resolve_classifier(classifier, x_tier)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Score rows and similar-photo links are tied to the deployed classifier's categories and embeddings
+    deployed = classifier_name == _clip_switcher.DEFAULT_CLASSIFIER
     
     # Save all uploaded files concurrently for maximum speed
     async def save_file(file: "UploadFile") -> tuple:
-        """Save a single file and return (temp_path, filename) or None if invalid."""
+        """Save a single file and return (temp_path, filename, data) or None if invalid."""
         if not file.filename.lower().endswith((".jpg", ".jpeg", ".png")):
             return None
             
@@ -282,7 +351,7 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
             async with aiofiles.open(temp_path, "wb") as f:
                 await f.write(data)
             
-            return (temp_path, file.filename)
+            return (temp_path, file.filename, data)
         except Exception as e:
             logging.warning(f"Failed to save {file.filename}: {e}")
             return None
@@ -294,19 +363,29 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
     # Filter out failed uploads
     temp_paths = []
     filenames = []
+    # One decode per upload, shared by YOLO, CLIP, hashing and embedding
+    contexts = []
     for result in save_results:
         if result is not None:
-            temp_path, filename = result
+            temp_path, filename, data = result
             temp_paths.append(temp_path)
             filenames.append(filename)
+            contexts.append(ImageContext(path=temp_path, data=data))
     
     if not temp_paths:
         raise HTTPException(status_code=400, detail="No valid images uploaded")
     
     # Batch classify with YOLO+CLIP hybrid or CLIP-only based on config
     try:
-        from .config import AUTO_TAG_MAX, USE_HYBRID_CLASSIFICATION
-        from .clip_switcher import classify_batch as clip_classify_batch
+        from .config import AUTO_TAG_MAX, USE_HYBRID_CLASSIFICATION, SCORE_STORE_ENABLED, SEMANTIC_SEARCH_ENABLED
+        clip_classify_batch = _clip_switcher.classify_batch_for(classifier_name)
+        
+        # Raw (clip_probs, yolo_detections) per image, kept for re-thresholding later
+        batch_scores = [] if SCORE_STORE_ENABLED and deployed else None
+        # Normalized image embedding per image, kept for semantic search
+        batch_embeddings = [] if SEMANTIC_SEARCH_ENABLED else None
+        # (dhash, phash) per image, kept for /duplicates/
+        batch_hashes = [] if DUPLICATE_HASHES_ENABLED else None
         
         max_tags = AUTO_TAG_MAX if AUTO_TAG_MAX is not None else 5
         # Use CLIP-specific threshold for batch classification as well
@@ -319,12 +398,16 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
             
             t0 = time.time()
             batch_tags, batch_all_detections, stats = classify_batch_hybrid(
-                temp_paths,
+                contexts,
                 yolo_model=None,  # Will auto-load fast nano model
                 clip_batch_func=clip_classify_batch,
                 yolo_confidence=0.60,  # Lower for nano model
                 clip_threshold=clip_threshold,
-                max_tags=max_tags
+                max_tags=max_tags,
+                scores_out=batch_scores,
+                embeddings_out=batch_embeddings,
+                hashes_out=batch_hashes,
+                embed_func=_clip_switcher.embed_images_for(classifier_name),
             )
             t1 = time.time()
             
@@ -339,7 +422,12 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
             # Use CLIP-only (slower but more accurate on CPU)
             logging.info(f"Starting CLIP-only classification for {len(temp_paths)} images")
             t0 = time.time()
-            batch_tags = clip_classify_batch(temp_paths, confidence_threshold=clip_threshold, max_tags=max_tags)
+            clip_probs = [] if batch_scores is not None else None
+            batch_tags = clip_classify_batch(contexts, confidence_threshold=clip_threshold, max_tags=max_tags,
+                                             scores_out=clip_probs, embeddings_out=batch_embeddings,
+                                             hashes_out=batch_hashes)
+            if clip_probs is not None:
+                batch_scores = [(probs, None) for probs in clip_probs]
             # For CLIP-only, all_detections same as tags
             batch_all_detections = batch_tags
             t1 = time.time()
@@ -351,6 +439,10 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
             if os.path.exists(temp_path):
                 os.remove(temp_path)
         raise HTTPException(status_code=500, detail=f"Batch classification error: {e}")
+    finally:
+        # Pixels are no longer needed (capture times are read from the files' EXIF headers)
+        for context in contexts:
+            context.release()
     
     # Build response — map results to provided photoIDs when supplied
     # photoIDs is required and must be a JSON array string matching the uploaded files order
@@ -362,16 +454,45 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
             raise ValueError('photoIDs must be a JSON array')
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid photoIDs: {e}")
+    hashes_list = []
+    if contentHashes:
+        try:
+            hashes_list = _json.loads(contentHashes)
+            if not isinstance(hashes_list, list):
+                raise ValueError('contentHashes must be a JSON array')
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid contentHashes: {e}")
+    times_list = []
+    if captureTimes:
+        try:
+            times_list = _json.loads(captureTimes)
+            if not isinstance(times_list, list):
+                raise ValueError('captureTimes must be a JSON array')
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid captureTimes: {e}")
 
     results = []
+    tag_entries = []
+    score_records = {}
+    embedding_records = {}
+    hash_records = {}
+    capture_times = {}
     for idx, (filename, tags, all_detections, temp_path) in enumerate(zip(filenames, batch_tags, batch_all_detections, temp_paths)):
         photo_id = None
         if ids_list and idx < len(ids_list):
             photo_id = ids_list[idx]
-            try:
-                _tags_db.set_tags(photo_id, tags, all_detections=all_detections)
-            except Exception:
-                logging.exception('Failed to persist tags for photoID in batch')
+            content_hash = hashes_list[idx] if idx < len(hashes_list) else None
+            tag_entries.append((photo_id, tags, all_detections, content_hash))
+            if batch_scores and idx < len(batch_scores):
+                score_records[photo_id] = batch_scores[idx]
+            if batch_embeddings and idx < len(batch_embeddings) and batch_embeddings[idx] is not None:
+                embedding_records[photo_id] = batch_embeddings[idx]
+                if SIMILAR_GROUPS_ENABLED and deployed:
+                    captured = _photo_clusters.parse_capture_time(times_list[idx]) if idx < len(times_list) else None
+                    capture_times[photo_id] = captured if captured is not None else \
+                        _photo_clusters.exif_capture_time(temp_path)
+            if batch_hashes and idx < len(batch_hashes) and batch_hashes[idx] is not None:
+                hash_records[photo_id] = batch_hashes[idx]
 
         results.append({
             "filename": filename,
@@ -388,7 +509,25 @@ async def detect_tags_batch(files: List["UploadFile"] = File(...), photoIDs: str
         except Exception:
             pass
 
-    return {"results": results, "count": len(results)}
+    tenant = _tenant(x_device_id, x_upload_token)
+
+    def persist():
+        # Persist the whole batch at once (one DB write instead of one per image)
+        try:
+            _tags_db.set_tags_many(tag_entries, tenant=tenant,
+                                   model_version=None if deployed else _pipeline_version.current_version(classifier_name))
+        except Exception:
+            logging.exception('Failed to persist tags for photoIDs in batch')
+        _score_store.record_scores(score_records, tenant=tenant)
+        _embedding_store.record_embeddings(embedding_records, tenant=tenant, classifier_name=classifier_name)
+        _photo_clusters.record_photos(embedding_records, capture_times, tenant=tenant,
+                                       classifier_name=classifier_name)
+        _duplicate_index.record_hashes(hash_records, tenant=tenant)
+
+    # The stores may flush .npz files, grow memmaps or fsync journals: keep that off the event loop
+    await asyncio.to_thread(persist)
+
+    return {"results": results, "count": len(results), "classifier": classifier_name}
 
 
 @app.post("/validate-yolo-classifications/")
@@ -444,6 +583,7 @@ async def validate_yolo_classifications(
     # Save uploaded files to temp
     temp_paths = []
     filenames = []
+    contexts = []
     
     for file in files:
         if not file.filename.lower().endswith((".jpg", ".jpeg", ".png")):
@@ -457,6 +597,7 @@ async def validate_yolo_classifications(
             
             temp_paths.append(temp_path)
             filenames.append(file.filename)
+            contexts.append(ImageContext(path=temp_path, data=data))
         except Exception as e:
             logging.warning(f"Failed to save {file.filename} for validation: {e}")
     
@@ -476,7 +617,7 @@ async def validate_yolo_classifications(
         
         logging.info(f"Starting CLIP validation for {len(temp_paths)} YOLO-classified images")
         validations = validate_batch_with_clip(
-            temp_paths,
+            contexts,
             yolo_tags_list,
             clip_classify_batch,
             clip_threshold
@@ -585,11 +726,11 @@ def list_all_organized_images(x_upload_token: str | None = Header(None)):
 
 
 @app.get('/tags/{photo_id}/')
-def get_tags_for_file(photo_id: str, x_upload_token: str | None = Header(None)):
+def get_tags_for_file(photo_id: str, x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
     _require_token(x_upload_token)
     """Return tags for a specific photoID if present in DB."""
     try:
-        tags = _tags_db.get_tags(photo_id)
+        tags = _tags_db.get_tags(photo_id, tenant=_tenant(x_device_id, x_upload_token))
     except Exception:
         logging.exception('Failed to read tags for photoID')
         raise HTTPException(status_code=500, detail='Failed to read tags')
@@ -597,13 +738,13 @@ def get_tags_for_file(photo_id: str, x_upload_token: str | None = Header(None)):
 
 
 @app.get('/tags/')
-def get_tags_query(photoID: str | None = None, x_upload_token: str | None = Header(None)):
+def get_tags_query(photoID: str | None = None, x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
     """Return tags for a photoID supplied as a query parameter (supports URIs with slashes)."""
     _require_token(x_upload_token)
     if not photoID:
         raise HTTPException(status_code=400, detail='photoID query parameter required')
     try:
-        tags = _tags_db.get_tags(photoID)
+        tags = _tags_db.get_tags(photoID, tenant=_tenant(x_device_id, x_upload_token))
     except Exception:
         logging.exception('Failed to read tags for photoID')
         raise HTTPException(status_code=500, detail='Failed to read tags')
@@ -615,11 +756,12 @@ class _TagsPayload(BaseModel):
 
 
 @app.post('/tags/{photo_id}/')
-def set_tags_for_file(photo_id: str, payload: _TagsPayload, x_upload_token: str | None = Header(None)):
+def set_tags_for_file(photo_id: str, payload: _TagsPayload, x_upload_token: str | None = Header(None),
+                      x_device_id: str | None = Header(None)):
     _require_token(x_upload_token)
     """Set tags for a photoID (dev/test helper)."""
     try:
-        _tags_db.set_tags(photo_id, payload.tags)
+        _tags_db.set_tags(photo_id, payload.tags, tenant=_tenant(x_device_id, x_upload_token))
     except Exception:
         logging.exception('Failed to set tags')
         raise HTTPException(status_code=500, detail="Failed to set tags")
@@ -647,20 +789,221 @@ def list_all_organized_images_with_tags(x_upload_token: str | None = Header(None
 
 
 @app.get('/tags-db/')
-def dump_tags_db(x_upload_token: str | None = Header(None)):
+def dump_tags_db(x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
     _require_token(x_upload_token)
-    db = _load_tags_db()
+    db = _load_tags_db(_tenant(x_device_id, x_upload_token))
     return db
 
 
+@app.get('/tags-db/stats/')
+def tags_db_stats(x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
+    """Return tags DB cache metrics (entries, dirty count, flush lag, durability)."""
+    _require_token(x_upload_token)
+    return _tags_db.get_stats(_tenant(x_device_id, x_upload_token))
+
+
+@app.get('/tags-db/stale/')
+async def tags_db_stale(limit: int | None = None, x_upload_token: str | None = Header(None),
+                        x_device_id: str | None = Header(None)):
+    """
+    List photoIDs whose tags would change under the current pipeline version.
+
+    Entries are compared component by component (classifier, prompts,
+    thresholds, YOLO mapping), so e.g. raising the food threshold only
+    reports photos currently tagged food. Re-tag just these instead of
+    clearing the whole library.
+    """
+    _require_token(x_upload_token)
+    return await asyncio.to_thread(_tags_db.find_stale, _tenant(x_device_id, x_upload_token), limit)
+
+
+@app.get('/tags-db/export/')
+def export_tags_db(background_tasks: BackgroundTasks, x_upload_token: str | None = Header(None),
+                   x_device_id: str | None = Header(None)):
+    """Download the tags DB as a columnar `.tagsnap` snapshot (see tags_snapshot.py)."""
+    _require_token(x_upload_token)
+    out_path = os.path.join(TEMP_FOLDER, f"tags_export_{os.getpid()}_{int(time.time() * 1000)}.tagsnap")
+    try:
+        info = _tags_snapshot.export_tags_db(out_path, _tenant(x_device_id, x_upload_token))
+    except Exception as e:
+        logging.exception('Failed to export tags DB')
+        raise HTTPException(status_code=500, detail=f"Export failed: {e}")
+    background_tasks.add_task(os.remove, out_path)
+    return FileResponse(out_path, media_type='application/octet-stream', filename='tags_db.tagsnap',
+                        headers={'X-Tag-Entries': str(info['entries'])})
+
+
+@app.post('/tags-db/import/')
+async def import_tags_db(file: "UploadFile" = File(...), x_upload_token: str | None = Header(None),
+                         x_device_id: str | None = Header(None)):
+    """Replace the tags DB with an uploaded `.tagsnap` snapshot."""
+    _require_token(x_upload_token)
+    in_path = os.path.join(TEMP_FOLDER, f"tags_import_{os.getpid()}_{int(time.time() * 1000)}.tagsnap")
+    try:
+        async with aiofiles.open(in_path, "wb") as f:
+            await f.write(await file.read())
+        info = await asyncio.to_thread(_tags_snapshot.import_tags_db, in_path, _tenant(x_device_id, x_upload_token))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.exception('Failed to import tags DB')
+        raise HTTPException(status_code=500, detail=f"Import failed: {e}")
+    finally:
+        if os.path.exists(in_path):
+            os.remove(in_path)
+    return {"imported": info["entries"], "load_ms": info["load_ms"], "import_ms": info["import_ms"], "status": "ok"}
+
+
+@app.post('/scan-plan/')
+async def scan_plan(request: "Request", x_upload_token: str | None = Header(None),
+                    x_device_id: str | None = Header(None)):
+    """
+    Tell the client which of its photos still need tagging, in one request.
+
+    Body (JSON, optionally gzip with `Content-Encoding: gzip`):
+    `{"photoIDs": [...], "contentHashes": {id: hash} | [...], "modelVersion": "..."}`.
+    `contentHashes` may be a map or a list parallel to `photoIDs`. Returns the
+    photoIDs that are `missing` from the tags DB or `stale` (different content
+    hash or model version); everything else can be skipped. Bodies over
+    SCAN_PLAN_MAX_BYTES (after decompression) or with more than
+    SCAN_PLAN_MAX_IDS photoIDs get 413.
+    """
+    _require_token(x_upload_token)
+    # Read at most SCAN_PLAN_MAX_BYTES (also the cap after gzip decompression)
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > srv_cfg.SCAN_PLAN_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Body exceeds {srv_cfg.SCAN_PLAN_MAX_BYTES} bytes")
+    try:
+        photo_ids, hashes, model_version = _tags_db.parse_scan_request(
+            bytes(body), request.headers.get('content-encoding', '').lower() == 'gzip')
+    except _tags_db.ScanPlanTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid scan plan request: {e}")
+
+    plan = await asyncio.to_thread(_tags_db.plan_scan, photo_ids, hashes, model_version,
+                                   _tenant(x_device_id, x_upload_token))
+    logging.info(f"Scan plan: {plan['requested']} photoIDs -> {len(plan['missing'])} missing, "
+                 f"{len(plan['stale'])} stale in {plan['elapsed_ms']}ms")
+    return plan
+
+
+@app.get('/semantic-search/')
+async def semantic_search(q: str, k: int = 20, x_upload_token: str | None = Header(None),
+                          x_device_id: str | None = Header(None)):
+    """
+    Free-text photo search ("dog playing in snow") over stored image embeddings.
+
+    The query is encoded once with the classifier's text tower and scored
+    against the caller's embedding matrix: an exact scan, or the IVF-PQ index
+    plus exact re-ranking once the library passes ANN_INDEX_MIN_ROWS.
+    """
+    _require_token(x_upload_token)
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty query")
+    k = max(1, min(k, 500))
+    try:
+        return await asyncio.to_thread(_embedding_store.semantic_search, q, k, _tenant(x_device_id, x_upload_token))
+    except NotImplementedError as e:
+        # The ONNX backend ships only the image tower
+        raise HTTPException(status_code=501, detail=str(e))
+
+
+@app.get('/duplicates/')
+async def find_duplicates(max_distance: int | None = None, hash: str = 'phash',
+                          x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
+    """
+    Near-duplicate groups among the caller's classified photos.
+
+    Photos whose perceptual hashes (`phash` or `dhash`) differ in at most
+    `max_distance` bits (default DUPLICATE_MAX_DISTANCE) end up in one group;
+    re-encoded, resized or lightly edited copies of a shot match.
+    """
+    _require_token(x_upload_token)
+    try:
+        return await asyncio.to_thread(_duplicate_index.find_duplicates, _tenant(x_device_id, x_upload_token),
+                                       max_distance, hash)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get('/similar-groups/')
+async def similar_groups(min_size: int = 2, limit: int | None = None, x_upload_token: str | None = Header(None),
+                         x_device_id: str | None = Header(None)):
+    """
+    Groups of near-identical shots (bursts, retakes) for "Cleanup → similar photos".
+
+    Photos are linked as they are classified: captured within
+    SIMILAR_TIME_WINDOW_SECONDS of each other and with image embeddings at
+    least SIMILAR_MIN_SIMILARITY apart in cosine similarity. Groups list their
+    photoIDs in capture order, largest groups first.
+    """
+    _require_token(x_upload_token)
+    return await asyncio.to_thread(_photo_clusters.similar_groups, _tenant(x_device_id, x_upload_token),
+                                   min_size, limit)
+
+
+@app.get('/models/')
+async def list_models(x_upload_token: str | None = Header(None)):
+    """Loaded and available models, their memory use, and the classifier per tier."""
+    _require_token(x_upload_token)
+    from .clip_switcher import DEFAULT_CLASSIFIER
+    return {**_model_registry.stats(), 'default_classifier': DEFAULT_CLASSIFIER,
+            'tiers': srv_cfg.CLASSIFIER_TIERS}
+
+
+@app.post('/models/{name}/unload/')
+async def unload_model(name: str, x_upload_token: str | None = Header(None)):
+    """Free a loaded model now (it is loaded again on next use)."""
+    _require_token(x_upload_token)
+    return {'name': name, 'unloaded': await asyncio.to_thread(_model_registry.unload, name)}
+
+
+@app.get('/cascade/stats/')
+async def cascade_stats(x_upload_token: str | None = Header(None)):
+    """Photos per cascade stage and the escalation rate since the cascade was loaded."""
+    _require_token(x_upload_token)
+    if not _model_registry.registry.is_loaded('cascade'):
+        return {'loaded': False, 'stages': srv_cfg.CASCADE_STAGES}
+    return {'loaded': True, **_model_registry.get_model('cascade').stats()}
+
+
+class _RetagPayload(BaseModel):
+    thresholds: Dict[str, float] | None = None
+    yolo_min_confidence: Dict[str, float] | None = None
+    apply: bool = False
+    limit: int = 100
+
+
+@app.post('/tags-db/retag/')
+async def retag_tags_db(payload: _RetagPayload, x_upload_token: str | None = Header(None),
+                        x_device_id: str | None = Header(None)):
+    """
+    Re-threshold the whole library from stored classifier scores (no inference).
+
+    With candidate `thresholds` / `yolo_min_confidence` this is a dry run that
+    reports how many photos would change. With `apply: true` (deployed settings
+    only) the changed entries are rewritten and re-stamped.
+    """
+    _require_token(x_upload_token)
+    from .retag import retag_library
+    try:
+        return await asyncio.to_thread(retag_library, _tenant(x_device_id, x_upload_token), payload.thresholds,
+                                       payload.yolo_min_confidence, payload.apply, payload.limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.delete('/tags-db/')
-def clear_tags_db(x_upload_token: str | None = Header(None)):
-    """Clear all tags from the server database."""
+def clear_tags_db(x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
+    """Clear all tags from the server database (the caller's shard when sharded)."""
     _require_token(x_upload_token)
     try:
-        db = _load_tags_db()
-        count = len(db)
-        _save_tags_db({})  # Save empty database
+        tenant = _tenant(x_device_id, x_upload_token)
+        count = len(_tags_db.get_store(tenant))
+        _save_tags_db({}, tenant)  # Save empty database
         logging.info(f"Cleared {count} entries from tags database")
         return {"cleared": count, "status": "ok"}
     except Exception as e:
@@ -669,7 +1012,7 @@ def clear_tags_db(x_upload_token: str | None = Header(None)):
 
 
 @app.get('/all-tags/')
-def get_all_unique_tags():
+def get_all_unique_tags(x_upload_token: str | None = Header(None), x_device_id: str | None = Header(None)):
     """
     Get all unique tags that exist across all images.
     Used for search autocomplete suggestions.
@@ -678,7 +1021,7 @@ def get_all_unique_tags():
         {"tags": ["people", "animals", "food", ...]}
     """
     try:
-        db = _load_tags_db()
+        db = _load_tags_db(_tenant(x_device_id, x_upload_token))
         all_tags = set()
         for filename, tags in db.items():
             if isinstance(tags, list):
@@ -3,11 +3,11 @@ import os
 import time
 import cv2
 import logging
-from .model import load_model
 
 logger = logging.getLogger(__name__)
 from .handlers import person, animals, documents, junk, utils
 from . import tags_db
+from .image_context import ImageContext
 from .config import SOURCE_FOLDER, CONFIDENCE_THRESHOLD, AUTO_TAG_MAX, PERSIST_UPLOADS
 from .config import PERSIST_UPLOADS as _PERSIST_UPLOADS
 from .config import ALLOW_REMOTE
@@ -21,24 +21,33 @@ from .config import CONFIDENCE_THRESHOLD
 from .config import AUTO_TAG_MAX
 from . import config as _cfg
 
-# --- Load YOLO model once ---
-model = None
-
 def get_model():
-    """Load YOLO model (singleton)."""
-    global model
-    if model is None:
-        model = load_model()
-    return model
+    """Shared YOLOv8x detector (loaded on demand by model_registry)."""
+    from .model_registry import get_model as _get_registered
+    return _get_registered("yolov8x")
 
 
-def process_single_image(img_path: str, results=None, tags=None) -> str:
+def process_single_image(img_path: str, results=None, tags=None, pending_tags: list = None,
+                         context: ImageContext = None) -> str:
     """
     Process a single image and move it to the appropriate folder.
     Returns the destination folder.
+
+    If `pending_tags` is a list, the (final_name, tags) entry is appended to it
+    instead of being written immediately, so callers processing many images can
+    persist them with one `tags_db.set_tags_many` call.
+
+    `context`, the upload's ImageContext, reuses its decoded pixels instead of
+    reading `img_path` again.
     """
     filename = os.path.basename(img_path)
-    img = cv2.imread(img_path)
+    if context is not None:
+        try:
+            img = context.bgr
+        except Exception:
+            img = None
+    else:
+        img = cv2.imread(img_path)
     if img is None:
         logger.warning(f"Skipping '{filename}' — cannot read image")
         return "skipped"
@@ -46,7 +55,12 @@ def process_single_image(img_path: str, results=None, tags=None) -> str:
     try:
         # Allow caller to pass precomputed results to avoid running inference twice
         if results is None:
-            results = get_model()(img_path)[0]
+            if context is not None:
+                results = get_model()(context.pil)[0]
+                # Handlers match keywords in the file name
+                results.path = img_path
+            else:
+                results = get_model()(img_path)[0]
     except Exception as e:
         logger.error(f"Skipping '{filename}' (YOLO error): {e}")
         return "skipped"
@@ -62,7 +76,7 @@ def process_single_image(img_path: str, results=None, tags=None) -> str:
     dest = (
         person.select(results) or
         animals.select(results) or
-        documents.select(results, img) or
+        documents.select(results, context if context is not None else img) or
         junk.select(results, img)
     )
 
@@ -97,7 +111,10 @@ def process_single_image(img_path: str, results=None, tags=None) -> str:
         # If tags were provided, persist them under the final filename
         try:
             if computed_tags is not None:
-                tags_db.set_tags(final_name, computed_tags)
+                if pending_tags is not None:
+                    pending_tags.append((final_name, computed_tags))
+                else:
+                    tags_db.set_tags_many([(final_name, computed_tags)])
         except Exception:
             pass
         return final_dst
@@ -120,10 +137,14 @@ def run_backend(folder: str = SOURCE_FOLDER):
         logger.warning(f"No images found in source folder: {folder}")
         return
 
+    pending_tags = []
     for idx, img_path in enumerate(image_files, 1):
-        dest = process_single_image(img_path)
+        dest = process_single_image(img_path, pending_tags=pending_tags)
         logger.info(f"{idx}/{len(image_files)} → {os.path.basename(dest)}")
 
+    # Persist all tags from this run in one batch
+    tags_db.set_tags_many(pending_tags)
+
     end_time = time.time()
     minutes, seconds = divmod(end_time - start_time, 60)
     logger.info(f"\n✅ Processing completed in {int(minutes)} min {int(seconds)} sec")
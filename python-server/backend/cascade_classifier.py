@@ -0,0 +1,333 @@
+"""
+Confidence cascade: every photo goes through the smallest classifier, and
+only uncertain ones move up to larger models.
+
+Stages are model_registry classifiers, cheapest first (CASCADE_STAGES, default
+MobileCLIP-S0 -> MobileCLIP-S2 -> full CLIP). A photo's scores from one stage
+are accepted when its top category probability is at least
+CASCADE_MIN_TOP_PROB and beats the runner-up by CASCADE_MIN_MARGIN; otherwise
+it is re-scored by the next stage. The last stage answers whatever reaches it.
+
+All stages share the category list and batch thresholds (clip_model and
+mobile_clip_model use the same ones), so tags come from the accepted stage's
+probabilities through the same thresholding as the classifiers' batch path.
+Images are decoded once and handed to every stage as PIL images.
+
+Embeddings (semantic search, similar photos) always come from the first stage,
+which sees every photo, so the embedding store stays in one model's space.
+
+`stats()` reports how many photos each stage received and answered; the
+escalation rate is the share of photos that needed a stage past the first.
+Run `python -m backend.cascade_classifier --images DIR` to compare speed and
+agreement with the last stage alone.
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from . import config as _cfg
+from .category_tags import match_expected, select_tags
+from .image_context import load_rgb
+from .image_hash import hash_image
+from .mobile_clip_model import CATEGORY_NAMES, CATEGORY_THRESHOLDS, PHOTO_CATEGORIES
+from .retag import clip_tags
+
+logger = logging.getLogger(__name__)
+
+
+def uncertain_rows(probs: np.ndarray, min_top: float, min_margin: float) -> np.ndarray:
+    """Boolean mask of rows whose top probability or top-2 margin falls in the uncertainty band."""
+    if len(probs) == 0:
+        return np.zeros(0, dtype=bool)
+    top2 = np.partition(probs, -2, axis=1)[:, -2:]
+    return (top2[:, 1] < min_top) | (top2[:, 1] - top2[:, 0] < min_margin)
+
+
+class CascadeClassifier:
+    """Classifier API over a cheapest-first chain of registry classifiers."""
+
+    # Stage models live in the registry; this object holds no weights of its own
+    footprint_mb = 0.0
+
+    def __init__(self, stages: Optional[List[str]] = None, min_top: Optional[float] = None,
+                 min_margin: Optional[float] = None):
+        """
+        Args:
+            stages: model_registry classifier names, cheapest first (default CASCADE_STAGES).
+            min_top: Accept a stage's scores at this top probability (default CASCADE_MIN_TOP_PROB).
+            min_margin: ...and this lead over the runner-up (default CASCADE_MIN_MARGIN).
+        """
+        from .model_registry import get_model
+
+        self.stage_names = list(stages or _cfg.CASCADE_STAGES)
+        if not self.stage_names:
+            raise ValueError("CASCADE_STAGES is empty")
+        self.min_top = _cfg.CASCADE_MIN_TOP_PROB if min_top is None else min_top
+        self.min_margin = _cfg.CASCADE_MIN_MARGIN if min_margin is None else min_margin
+        first = get_model(self.stage_names[0])
+        self.categories = PHOTO_CATEGORIES
+        self.embedding_dim = first.embedding_dim
+        # Embeddings are the first stage's, so they share its store
+        self.model_id = first.model_id
+        self.model_name = "cascade:" + ">".join(self.stage_names)
+        self._lock = threading.Lock()
+        self._received = [0] * len(self.stage_names)
+        self._answered = [0] * len(self.stage_names)
+        self._stage_ms = [0.0] * len(self.stage_names)
+        logger.info(f"Cascade {' -> '.join(self.stage_names)} "
+                    f"(accept at top >= {self.min_top}, margin >= {self.min_margin})")
+
+    def _stage(self, index: int):
+        from .model_registry import get_model
+        return get_model(self.stage_names[index])
+
+    def embed_text(self, prompts: list) -> np.ndarray:
+        return self._stage(0).embed_text(prompts)
+
+    def get_text_features(self, prompts: list) -> np.ndarray:
+        return self._stage(0).get_text_features(prompts)
+
+    def embed_images(self, images: list) -> np.ndarray:
+        """First-stage image embeddings (the space the embedding store uses)."""
+        return self._stage(0).embed_images(images)
+
+    def score_embeddings(self, embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+        """First-stage scores of first-stage embeddings (no escalation)."""
+        return self._stage(0).score_embeddings(embeddings, prompt_set)
+
+    def predict(self, images: list, embeddings_out: list = None) -> np.ndarray:
+        """
+        Cascaded category probabilities for decoded images.
+
+        Args:
+            images: PIL RGB images.
+            embeddings_out: If given, extended with the first-stage embedding per image.
+
+        Returns:
+            float32[N, C] probabilities from the stage that accepted each image.
+        """
+        n = len(images)
+        if n == 0:
+            return np.zeros((0, len(CATEGORY_NAMES)), dtype=np.float32)
+        probs = None
+        pending = np.arange(n)
+        last = len(self.stage_names) - 1
+        for index in range(len(self.stage_names)):
+            t0 = time.perf_counter()
+            stage = self._stage(index)
+            embeddings = stage.embed_images([images[i] for i in pending])
+            stage_probs = stage.score_embeddings(embeddings)
+            if probs is None:
+                probs = stage_probs
+                if embeddings_out is not None:
+                    embeddings_out.extend(embeddings)
+            else:
+                probs[pending] = stage_probs
+            unsure = uncertain_rows(stage_probs, self.min_top, self.min_margin) if index < last \
+                else np.zeros(len(pending), dtype=bool)
+            with self._lock:
+                self._received[index] += len(pending)
+                self._answered[index] += int((~unsure).sum())
+                self._stage_ms[index] += (time.perf_counter() - t0) * 1000
+            pending = pending[unsure]
+            if not len(pending):
+                break
+        return probs
+
+    def _tags(self, probs: np.ndarray, max_tags: int) -> List[List[tuple]]:
+        return select_tags(probs, CATEGORY_NAMES, CATEGORY_THRESHOLDS, max_tags, "other")
+
+    def classify_image(self, image_path: str, confidence_threshold: float = 0.15, max_tags: int = 5,
+                       expected_tags: list = None):
+        """
+        Classify image and return relevant tags.
+        Same API as CLIPPhotoClassifier.classify_image()
+
+        Returns:
+            List of tuples: [(tag, confidence), ...]
+        """
+        try:
+            probs = self.predict([load_rgb(image_path)])
+            if expected_tags:
+                match = match_expected(probs[0], CATEGORY_NAMES, expected_tags, max_tags, "other")
+                if match:
+                    return match[1]
+                logger.warning(f"Expected tags {expected_tags} not found even at threshold 0.20")
+            return self._tags(probs, max_tags)[0]
+        except Exception as e:
+            logger.error(f"Error classifying {image_path}: {e}")
+            return []
+
+    def classify_batch(self, image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 5,
+                       scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
+        """
+        Classify multiple images, escalating only uncertain ones.
+        Same API (and output hooks) as MobileCLIPPhotoClassifier.classify_batch()
+
+        Returns:
+            List of results, one per image: [[(tag, conf), ...], ...]
+        """
+        outs = [out for out in (scores_out, embeddings_out, hashes_out) if out is not None]
+        bases = [len(out) for out in outs]
+        for out in outs:
+            out.extend([None] * len(image_paths))
+        try:
+            images, valid_indices = [], []
+            for path_idx, path in enumerate(image_paths):
+                try:
+                    images.append(load_rgb(path))
+                    valid_indices.append(path_idx)
+                except Exception as e:
+                    logger.warning(f"Failed to load {path}: {e}")
+            if not images:
+                return [[] for _ in image_paths]
+
+            embeddings = [] if embeddings_out is not None else None
+            probs = self.predict(images, embeddings_out=embeddings)
+            rows = {id(scores_out): probs, id(embeddings_out): embeddings,
+                    id(hashes_out): [hash_image(img) for img in images] if hashes_out is not None else None}
+            for out, base in zip(outs, bases):
+                for value, path_idx in zip(rows[id(out)], valid_indices):
+                    out[base + path_idx] = value
+
+            batch_results = [[] for _ in image_paths]
+            for path_idx, results in zip(valid_indices, self._tags(probs, max_tags)):
+                batch_results[path_idx] = results
+            return batch_results
+        except Exception as e:
+            logger.error(f"Error in cascade batch classification: {e}")
+            return [[] for _ in image_paths]
+
+    def get_tags_only(self, image_path: str, confidence_threshold: float = 0.15, max_tags: int = 5):
+        return [tag for tag, _ in self.classify_image(image_path, confidence_threshold, max_tags)]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            received, answered, stage_ms = list(self._received), list(self._answered), list(self._stage_ms)
+        total = received[0]
+        return {
+            'stages': self.stage_names,
+            'min_top': self.min_top,
+            'min_margin': self.min_margin,
+            'images': total,
+            'escalation_rate': round(1 - answered[0] / total, 4) if total else 0.0,
+            'per_stage': [
+                {
+                    'name': name,
+                    'received': received[i],
+                    'answered': answered[i],
+                    'share_of_images': round(received[i] / total, 4) if total else 0.0,
+                    'ms_per_received_image': round(stage_ms[i] / received[i], 1) if received[i] else None,
+                }
+                for i, name in enumerate(self.stage_names)
+            ],
+            'ms_per_image': round(sum(stage_ms) / total, 1) if total else None,
+        }
+
+
+def get_cascade_classifier() -> CascadeClassifier:
+    """Get the shared cascade (loaded on demand by model_registry)."""
+    from .model_registry import get_model
+    return get_model("cascade")
+
+
+def classify_image(image_path: str, confidence_threshold: float = 0.15, max_tags: int = 1,
+                   expected_tags: list = None):
+    """
+    Convenience function to classify a single image.
+    Same API as mobile_clip_model.classify_image()
+    """
+    results = get_cascade_classifier().classify_image(image_path, confidence_threshold, max_tags, expected_tags)
+    tags = [tag for tag, _ in results]
+    if len(tags) > 1 and "other" in tags:
+        tags = [t for t in tags if t != "other"]
+    return tags
+
+
+def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1,
+                   scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
+    """
+    Convenience function to classify multiple images.
+    Same API as mobile_clip_model.classify_batch()
+    """
+    results = get_cascade_classifier().classify_batch(image_paths, confidence_threshold, max_tags,
+                                                      scores_out=scores_out, embeddings_out=embeddings_out,
+                                                      hashes_out=hashes_out)
+    cleaned_results = []
+    for img_results in results:
+        tags = [tag for tag, _ in img_results]
+        if len(tags) > 1 and "other" in tags:
+            tags = [t for t in tags if t != "other"]
+        cleaned_results.append(tags)
+    return cleaned_results
+
+
+def classify_batch_with_scores(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1):
+    """Like classify_batch(), but also returns each image's raw category probabilities."""
+    scores = []
+    tags = classify_batch(image_paths, confidence_threshold, max_tags, scores_out=scores)
+    return tags, scores
+
+
+def embed_images(images: list) -> np.ndarray:
+    """First-stage image embeddings (float32[N, D]) for PIL images or paths."""
+    return get_cascade_classifier().embed_images(images)
+
+
+def score_embeddings(embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+    """First-stage probabilities (float32[N, P]) of first-stage embeddings."""
+    return get_cascade_classifier().score_embeddings(embeddings, prompt_set)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Compare the cascade with its last stage alone on a folder of photos."""
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--images', required=True, help='directory of photos')
+    parser.add_argument('--limit', type=int, default=500)
+    parser.add_argument('--min-top', type=float, nargs='+', default=[_cfg.CASCADE_MIN_TOP_PROB])
+    parser.add_argument('--min-margin', type=float, nargs='+', default=[_cfg.CASCADE_MIN_MARGIN])
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    images = []
+    for name in sorted(os.listdir(args.images)):
+        if len(images) >= args.limit:
+            break
+        try:
+            images.append(Image.open(os.path.join(args.images, name)).convert("RGB"))
+        except Exception:
+            continue
+    from .model_registry import get_model
+
+    top = get_model(_cfg.CASCADE_STAGES[-1])
+    top.embed_images(images[:2])
+    t0 = time.perf_counter()
+    reference = top.score_embeddings(top.embed_images(images))
+    top_ms = (time.perf_counter() - t0) * 1000 / len(images)
+    ref_tags = clip_tags(reference, CATEGORY_NAMES, CATEGORY_THRESHOLDS, 1, "other")
+    print(f"{len(images)} images; {_cfg.CASCADE_STAGES[-1]} alone: {top_ms:.1f} ms/image")
+    for name in _cfg.CASCADE_STAGES:
+        get_model(name).embed_images(images[:2])
+    print(f"{'min_top':>7} {'margin':>6} {'escalated':>9} {'ms/img':>7} {'speedup':>7} {'top-1 agree':>11} {'tag agree':>9}")
+    for min_top in args.min_top:
+        for min_margin in args.min_margin:
+            cascade = CascadeClassifier(min_top=min_top, min_margin=min_margin)
+            t0 = time.perf_counter()
+            probs = cascade.predict(images)
+            ms = (time.perf_counter() - t0) * 1000 / len(images)
+            agree = float((probs.argmax(axis=1) == reference.argmax(axis=1)).mean())
+            tags = clip_tags(probs, CATEGORY_NAMES, CATEGORY_THRESHOLDS, 1, "other")
+            tag_agree = float(np.mean([a == b for a, b in zip(tags, ref_tags)]))
+            print(f"{min_top:>7.2f} {min_margin:>6.2f} {cascade.stats()['escalation_rate']:>9.1%} {ms:>7.1f} "
+                  f"{top_ms / ms:>6.2f}x {agree:>11.3f} {tag_agree:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Turn classifier probabilities into category tags, for a whole batch at once.
+
+Every CLIP-family classifier (single image and batch paths alike), the cascade
+and retag.py go through `select_tags`, so the same probabilities always give
+the same tags. The rules, applied as mask operations over the [N, C] matrix:
+- a category passes at or above its threshold
+- "illustration" is never a tag; at ILLUSTRATION_FOOD_CUTOFF or above it
+  suppresses food (mascots and cartoons are not food)
+- a passing "people" suppresses "document" (screenshots of people are people)
+- passing categories are ordered by probability (ties keep category order)
+  and cut to `max_tags`
+- a row with nothing passing gets the classifier's fallback label at 0.0
+
+`match_expected` is the classifiers' expected-tags search (single images
+classified with `expected_tags`, and YOLO validation).
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+ILLUSTRATION_FOOD_CUTOFF = 0.40
+PEOPLE_SUPPRESSES_DOCUMENT = True
+# Thresholds tried, highest first, when looking for expected tags
+EXPECTED_TAG_THRESHOLDS = (0.80, 0.70, 0.60, 0.50, 0.40, 0.30, 0.20)
+
+
+def select_tags(probs: np.ndarray, categories: List[str], thresholds: Dict[str, float], max_tags: int,
+                other_label: str, default_threshold: float = 0.15) -> List[List[Tuple[str, float]]]:
+    """Tags with their probabilities for every row of a probability matrix.
+
+    Args:
+        probs: float[N, C] probabilities in `categories` order.
+        categories: Clean category names.
+        thresholds: Per-category thresholds (missing ones use `default_threshold`).
+        max_tags: Maximum tags per photo (None = no limit).
+        other_label: Fallback tag when no category passes; never a tag otherwise,
+            even if it is one of `categories`.
+
+    Returns:
+        One [(tag, probability), ...] list per row.
+    """
+    probs = np.asarray(probs, dtype=np.float32).reshape(-1, len(categories))
+    n = len(probs)
+    if n == 0:
+        return []
+    column = {name: i for i, name in enumerate(categories)}
+    thr = np.array([thresholds.get(c, default_threshold) for c in categories], dtype=np.float32)
+    passing = probs >= thr
+    for internal in ('illustration', other_label):
+        if internal in column:
+            passing[:, column[internal]] = False
+    if 'illustration' in column and 'food' in column:
+        passing[:, column['food']] &= probs[:, column['illustration']] < ILLUSTRATION_FOOD_CUTOFF
+    if PEOPLE_SUPPRESSES_DOCUMENT and 'people' in column and 'document' in column:
+        passing[:, column['document']] &= ~passing[:, column['people']]
+
+    k = len(categories) if max_tags is None else max(0, min(max_tags, len(categories)))
+    masked = np.where(passing, probs, -np.inf)
+    # Stable sort keeps category order for ties, like list.sort did per image
+    order = np.argsort(-masked, axis=1, kind='stable')[:, :k]
+    counts = np.minimum(passing.sum(axis=1), k).tolist()
+    top = np.take_along_axis(probs, order, axis=1).tolist()
+    order = order.tolist()
+    fallback = [(other_label, 0.0)]
+    return [
+        [(categories[j], p) for j, p in zip(order[i][:counts[i]], top[i])] if counts[i] else list(fallback)
+        for i in range(n)
+    ]
+
+
+def match_expected(probs: np.ndarray, categories: List[str], expected_tags: List[str], max_tags: int,
+                   other_label: str) -> Optional[Tuple[float, List[Tuple[str, float]]]]:
+    """Expected tags at the highest EXPECTED_TAG_THRESHOLDS step any of them reaches.
+
+    Args:
+        probs: float[C] probabilities of one image, in `categories` order.
+        expected_tags: Tags to look for (e.g. YOLO's).
+
+    Returns:
+        (threshold, [(tag, probability), ...] best first), or None if none reaches the last step.
+    """
+    scores = sorted(((name, float(p)) for name, p in zip(categories, probs)
+                     if name != other_label and name in expected_tags),
+                    key=lambda x: x[1], reverse=True)
+    for threshold in EXPECTED_TAG_THRESHOLDS:
+        found = [(tag, score) for tag, score in scores if score >= threshold]
+        if found:
+            return threshold, found[:max_tags]
+    return None
+
+
+def describe() -> Dict[str, Any]:
+    """The rule settings, for pipeline_version."""
+    return {
+        'illustration_food_cutoff': ILLUSTRATION_FOOD_CUTOFF,
+        'people_suppresses_document': PEOPLE_SUPPRESSES_DOCUMENT,
+    }
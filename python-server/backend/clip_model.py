@@ -2,11 +2,18 @@
 CLIP-based image classification for photo organization.
 Provides better quality and more intuitive tagging than YOLO for general photos.
 """
+import numpy as np
 import torch
-from PIL import Image
 from transformers import CLIPProcessor, CLIPModel
 import logging
 
+from . import config as _cfg
+from .autotune import autocast_context
+from .category_tags import match_expected, select_tags
+from .image_context import load_rgb
+from .image_hash import hash_image
+from .text_embedding_cache import get_text_embeddings, softmax_scores
+
 logger = logging.getLogger(__name__)
 
 # Simplified categories for speed - short prompts process much faster
@@ -20,6 +27,30 @@ PHOTO_CATEGORIES = [
     "cartoon, illustration, drawing, mascot, artwork",  # Prevents false food detection on cartoon images
 ]
 
+# Clean tag names for PHOTO_CATEGORIES (same order)
+CATEGORY_NAMES = ["people", "animals", "food", "scenery", "document", "illustration"]
+
+# Category-specific thresholds for single images (category_tags.select_tags)
+CATEGORY_THRESHOLDS = {
+    "food": 0.80,
+    "document": 0.70,
+    "animals": 0.70,
+    "people": 0.60,  # Lowered from 0.80 - profiles and partial faces still count
+    "scenery": 0.70,
+    "illustration": 0.60,  # Lower threshold for cartoon/mascot detection
+}
+
+# Strict thresholds to minimize false positives in batch classification
+# Higher for food and people (80%) to avoid misclassification
+BATCH_CATEGORY_THRESHOLDS = {
+    "food": 0.80,
+    "document": 0.70,
+    "animals": 0.70,
+    "people": 0.80,
+    "scenery": 0.70,
+    "illustration": 0.60,
+}
+
 
 class CLIPPhotoClassifier:
     """CLIP-based photo classifier for intelligent tagging."""
@@ -33,6 +64,7 @@ class CLIPPhotoClassifier:
                        Use "openai/clip-vit-large-patch14" for better accuracy (slower).
         """
         logger.info(f"Loading CLIP model: {model_name}")
+        self.model_name = self.model_id = model_name
         self.model = CLIPModel.from_pretrained(model_name)
         self.processor = CLIPProcessor.from_pretrained(model_name)
         self.categories = PHOTO_CATEGORIES
@@ -40,8 +72,67 @@ class CLIPPhotoClassifier:
         # Move to GPU if available
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model.to(self.device)
+        
+        # Category prompts are fixed: embed them once (cached on disk across restarts)
+        self.text_features = self.get_text_features(self.categories)
+        self.embedding_dim = self.text_features.shape[1]
+        self.logit_scale = float(self.model.logit_scale.exp())
         logger.info(f"CLIP model loaded on {self.device}")
     
+    def _encode_text(self, prompts: list):
+        """Run the text tower (only on a text embedding cache miss)."""
+        inputs = self.processor(text=prompts, return_tensors="pt", padding=True)
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            return self.model.get_text_features(**inputs).float().cpu().numpy()
+    
+    def get_text_features(self, prompts: list) -> np.ndarray:
+        """L2-normalized text embeddings for `prompts`, float32[P, D] (cached)."""
+        return get_text_embeddings(self.model_name, list(prompts), self._encode_text)
+    
+    def embed_text(self, prompts: list) -> np.ndarray:
+        """L2-normalized text embeddings without caching (e.g. search queries)."""
+        emb = self._encode_text(list(prompts))
+        return emb / np.linalg.norm(emb, axis=-1, keepdims=True)
+    
+    def embed_images(self, images: list) -> np.ndarray:
+        """
+        Run only the image tower.
+        
+        Args:
+            images: PIL images, image file paths or ImageContexts
+            
+        Returns:
+            float32[N, D] L2-normalized image embeddings
+        """
+        images = [load_rgb(im) for im in images]
+        if not images:
+            return np.zeros((0, self.embedding_dim), dtype=np.float32)
+        step = _cfg.CLIP_BATCH_SIZE or len(images)
+        chunks = []
+        with torch.no_grad(), autocast_context(self.device):
+            for start in range(0, len(images), step):
+                pixel_values = self.processor(images=images[start:start + step],
+                                              return_tensors="pt")["pixel_values"].to(self.device)
+                image_features = self.model.get_image_features(pixel_values=pixel_values).float()
+                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+                chunks.append(image_features.cpu().numpy())
+        return np.concatenate(chunks)
+    
+    def score_embeddings(self, embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+        """
+        Score image embeddings against a prompt set (no image tower).
+        
+        Args:
+            embeddings: float32[N, D] from embed_images()
+            prompt_set: Prompt strings (defaults to the category prompts)
+            
+        Returns:
+            float32[N, P] softmax probabilities, same as CLIPModel.logits_per_image.softmax
+        """
+        text = self.text_features if prompt_set is None else self.get_text_features(prompt_set)
+        return softmax_scores(embeddings, text, self.logit_scale)
+    
     def classify_image(self, image_path: str, confidence_threshold: float = 0.15, max_tags: int = 5, 
                       expected_tags: list = None):
         """
@@ -58,30 +149,13 @@ class CLIPPhotoClassifier:
         """
         try:
             # Load and process image
-            image = Image.open(image_path).convert("RGB")
+            image = load_rgb(image_path)
             
-            # Prepare inputs for CLIP
-            inputs = self.processor(
-                text=self.categories,
-                images=image,
-                return_tensors="pt",
-                padding=True
-            )
-            
-            # Move to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Get predictions
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits_per_image = outputs.logits_per_image
-                probs = logits_per_image.softmax(dim=1)[0]
+            # Get predictions (text embeddings are precomputed)
+            probs = self.score_embeddings(self.embed_images([image]))[0]
             
             # Map category indices to clean names
-            category_names = [
-                "people", "animals", "food", "scenery",
-                "document", "illustration"
-            ]
+            category_names = CATEGORY_NAMES
             
             # Build all scores for dynamic threshold adjustment
             all_scores = []
@@ -95,69 +169,16 @@ class CLIPPhotoClassifier:
             
             # If expected_tags provided, try to find them with dynamic thresholds
             if expected_tags:
-                # Try progressively lower thresholds: 0.80 -> 0.70 -> 0.60 -> 0.50 -> 0.40 -> 0.30 -> 0.20
-                for threshold_attempt in [0.80, 0.70, 0.60, 0.50, 0.40, 0.30, 0.20]:
-                    found_tags = [
-                        (tag, score) for tag, score in all_scores 
-                        if score >= threshold_attempt and tag in expected_tags
-                    ]
-                    if found_tags:
-                        logger.info(f"Found expected tags {expected_tags} at threshold {threshold_attempt}: {found_tags}")
-                        return found_tags[:max_tags]
-                
-                # If expected tags not found even at 0.20, log it and continue with normal logic
+                match = match_expected(probs, CATEGORY_NAMES, expected_tags, max_tags, "Other")
+                if match:
+                    logger.info(f"Found expected tags {expected_tags} at threshold {match[0]}: {match[1]}")
+                    return match[1]
                 logger.warning(f"Expected tags {expected_tags} not found even at threshold 0.20. Top scores: {all_scores[:3]}")
             
-            # Normal classification with category-specific thresholds
-            category_thresholds = {
-                "food": 0.80,
-                "document": 0.70,
-                "animals": 0.70,
-                "people": 0.60,  # Lowered from 0.80 - profiles and partial faces still count
-                "scenery": 0.70,
-                "illustration": 0.60,  # Lower threshold for cartoon/mascot detection
-            }
-            
-            # Check if this looks like an illustration/cartoon - if so, suppress food detection
-            # to avoid false positives (e.g., mascot with magnifying glass tagged as food)
-            illustration_score = next((score for tag, score in all_scores if tag == "illustration"), 0)
-            is_likely_illustration = illustration_score >= 0.40
-            
-            results = []
-            for tag_name, prob in all_scores:
-                # Skip illustration - it's only used internally for food suppression
-                if tag_name == "illustration":
-                    continue
-                
-                required_threshold = category_thresholds.get(tag_name, confidence_threshold)
-                
-                # Suppress food detection for illustrations/cartoons
-                if tag_name == "food" and is_likely_illustration:
-                    logger.info(f"Suppressing food (score={prob:.2f}) - looks like illustration (score={illustration_score:.2f})")
-                    continue
-                    
-                if prob >= required_threshold:
-                    results.append((tag_name, prob))
-            
-            # Priority logic: If people is detected, it should be the main category
-            # and suppress document classification (screenshots of people should be 'people', not 'document')
-            people_score = next((score for tag, score in results if tag == "people"), 0)
-            if people_score > 0:
-                # People detected - remove document from results if people is present
-                # The person in the photo is more important than any text visible
-                original_len = len(results)
-                results = [(tag, score) for tag, score in results if tag != "document"]
-                if len(results) < original_len:
-                    logger.info(f"Suppressing document - people detected (score={people_score:.2f})")
-            
-            # If no categories matched, tag as 'Other' (scanned but uncategorized)
-            if not results:
+            results = select_tags(probs, CATEGORY_NAMES, CATEGORY_THRESHOLDS, max_tags, "Other",
+                                  confidence_threshold)[0]
+            if results == [("Other", 0.0)]:
                 logger.warning(f"No categories matched for {image_path}. Top scores: {all_scores[:3]}")
-                results.append(("Other", 0.0))
-            
-            # Sort by confidence and limit
-            results.sort(key=lambda x: x[1], reverse=True)
-            results = results[:max_tags]
             
             logger.info(f"Classified {image_path}: {[tag for tag, _ in results]}")
             return results
@@ -166,7 +187,8 @@ class CLIPPhotoClassifier:
             logger.error(f"Error classifying {image_path}: {e}")
             return []
     
-    def classify_batch(self, image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 5):
+    def classify_batch(self, image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 5,
+                       scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
         """
         Classify multiple images in batch for better performance.
         
@@ -174,100 +196,62 @@ class CLIPPhotoClassifier:
             image_paths: List of image file paths
             confidence_threshold: Minimum confidence score
             max_tags: Maximum tags per image
+            scores_out: If given, extended with one raw probability vector per
+                input path (float32, CATEGORY_NAMES order; None if unreadable)
+            embeddings_out: Same, with the normalized image embedding per path
+            hashes_out: Same, with the (dhash, phash) of the decoded image per path
             
         Returns:
             List of results, one per image: [[(tag, conf), ...], ...]
         """
+        if scores_out is not None:
+            scores_base = len(scores_out)
+            scores_out.extend([None] * len(image_paths))
+        if embeddings_out is not None:
+            embeddings_base = len(embeddings_out)
+            embeddings_out.extend([None] * len(image_paths))
+        if hashes_out is not None:
+            hashes_base = len(hashes_out)
+            hashes_out.extend([None] * len(image_paths))
         try:
             # Load all images
             images = []
             valid_paths = []
-            for path in image_paths:
+            valid_indices = []
+            for path_idx, path in enumerate(image_paths):
                 try:
-                    img = Image.open(path).convert("RGB")
+                    img = load_rgb(path)
                     images.append(img)
                     valid_paths.append(path)
+                    valid_indices.append(path_idx)
                 except Exception as e:
                     logger.warning(f"Failed to load {path}: {e}")
             
             if not images:
                 return [[] for _ in image_paths]
             
-            # Process batch
-            inputs = self.processor(
-                text=self.categories,
-                images=images,
-                return_tensors="pt",
-                padding=True
-            )
-            
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Get predictions for all images
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits_per_image = outputs.logits_per_image
-                probs = logits_per_image.softmax(dim=1)
+            if hashes_out is not None:
+                for img, path_idx in zip(images, valid_indices):
+                    hashes_out[hashes_base + path_idx] = hash_image(img)
             
-            # Map category indices to clean names (must match PHOTO_CATEGORIES order)
-            category_names = [
-                "people", "animals", "food", "scenery",
-                "document", "illustration"
-            ]
+            # Get predictions for all images (text embeddings are precomputed)
+            embeddings = self.embed_images(images)
+            probs = self.score_embeddings(embeddings)
             
-            # Strict thresholds to minimize false positives
-            # Higher for food and people (80%) to avoid misclassification
-            category_thresholds = {
-                "food": 0.80,
-                "document": 0.70,
-                "animals": 0.70,
-                "people": 0.80,
-                "scenery": 0.70,
-                "illustration": 0.60,
-            }
+            if embeddings_out is not None:
+                for row, path_idx in zip(embeddings, valid_indices):
+                    embeddings_out[embeddings_base + path_idx] = row
             
-            # Process results for each image
-            batch_results = []
-            for img_idx, image_probs in enumerate(probs):
-                # First pass: get illustration score for food suppression
-                illustration_score = 0.0
-                for idx, prob in enumerate(image_probs):
-                    tag_name = category_names[idx] if idx < len(category_names) else "other"
-                    if tag_name == "illustration":
-                        illustration_score = float(prob)
-                        break
-                
-                is_likely_illustration = illustration_score >= 0.40
-                
-                results = []
-                for idx, prob in enumerate(image_probs):
-                    tag_name = category_names[idx] if idx < len(category_names) else "other"
-                    
-                    # Skip 'other' and 'illustration' (illustration is internal only)
-                    if tag_name in ("other", "illustration"):
-                        continue
-                    
-                    # Suppress food for illustrations
-                    if tag_name == "food" and is_likely_illustration:
-                        logger.info(f"[Batch] Suppressing food (score={float(prob):.2f}) - looks like illustration (score={illustration_score:.2f})")
-                        continue
-                    
-                    # Apply category-specific threshold
-                    required_threshold = category_thresholds.get(tag_name, confidence_threshold)
-                    if prob >= required_threshold:
-                        results.append((tag_name, float(prob)))
-                
-                # If no categories matched, tag as 'Other' (scanned but uncategorized)
-                if not results:
-                    results.append(("Other", 0.0))
-                
-                results.sort(key=lambda x: x[1], reverse=True)
-                results = results[:max_tags]
-                batch_results.append(results)
-                
-                if img_idx < len(valid_paths):
-                    logger.info(f"Batch classified {valid_paths[img_idx]}: {[tag for tag, _ in results]}")
+            if scores_out is not None:
+                for row, path_idx in zip(probs, valid_indices):
+                    scores_out[scores_base + path_idx] = row
             
+            tags = select_tags(probs, CATEGORY_NAMES, BATCH_CATEGORY_THRESHOLDS, max_tags, "Other",
+                               confidence_threshold)
+            batch_results = [[] for _ in image_paths]
+            for path_idx, results in zip(valid_indices, tags):
+                batch_results[path_idx] = results
+            logger.debug(f"Batch classified {len(valid_paths)} images")
             return batch_results
             
         except Exception as e:
@@ -285,16 +269,10 @@ class CLIPPhotoClassifier:
         return [tag for tag, _ in results]
 
 
-# Singleton instance
-_clip_classifier = None
-
-
 def get_clip_model():
-    """Get or create CLIP classifier singleton."""
-    global _clip_classifier
-    if _clip_classifier is None:
-        _clip_classifier = CLIPPhotoClassifier()
-    return _clip_classifier
+    """Get the shared CLIP classifier (loaded on demand by model_registry)."""
+    from .model_registry import get_model
+    return get_model("clip")
 
 
 def classify_image(image_path: str, confidence_threshold: float = 0.15, max_tags: int = 1, 
@@ -322,7 +300,8 @@ def classify_image(image_path: str, confidence_threshold: float = 0.15, max_tags
     return tags
 
 
-def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1):
+def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1,
+                   scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
     """
     Convenience function to classify multiple images.
     Returns only the most confident category per image.
@@ -331,7 +310,8 @@ def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_ta
         List of tag lists: [["people"], ["scenery"], ["food"], ...]
     """
     classifier = get_clip_model()
-    results = classifier.classify_batch(image_paths, confidence_threshold, max_tags)
+    results = classifier.classify_batch(image_paths, confidence_threshold, max_tags, scores_out=scores_out,
+                                        embeddings_out=embeddings_out, hashes_out=hashes_out)
     cleaned_results = []
     
     for img_results in results:
@@ -342,3 +322,26 @@ def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_ta
         cleaned_results.append(tags)
     
     return cleaned_results
+
+
+def classify_batch_with_scores(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1):
+    """
+    Like classify_batch(), but also returns each image's raw category probabilities
+    (float32 vector in CATEGORY_NAMES order, None if the image couldn't be read).
+    
+    Returns:
+        Tuple of (tag lists, probability vectors)
+    """
+    scores = []
+    tags = classify_batch(image_paths, confidence_threshold, max_tags, scores_out=scores)
+    return tags, scores
+
+
+def embed_images(images: list) -> np.ndarray:
+    """L2-normalized image embeddings (float32[N, D]) for PIL images or paths."""
+    return get_clip_model().embed_images(images)
+
+
+def score_embeddings(embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+    """Softmax probabilities (float32[N, P]) of embeddings against a prompt set."""
+    return get_clip_model().score_embeddings(embeddings, prompt_set)
@@ -23,31 +23,167 @@ MOBILE_CLIP_SIZE = "s2"  # If enabled: "s0" (fastest), "s1", "s2" (best accuracy
 # ============================================================================
 
 import logging
+from . import config as _cfg
 logger = logging.getLogger(__name__)
 
-if USE_MOBILE_CLIP:
+# CLIP_BACKEND=onnx serves MobileCLIP-S0 through ONNX Runtime instead (no PyTorch);
+# onnx-int8 / onnx-int8-dynamic serve its quantized variants (quantize_onnx_model.py)
+ONNX_BACKENDS = ("onnx", "onnx-int8", "onnx-int8-dynamic")
+# CLIP_BACKEND=cascade starts every photo on MobileCLIP-S0 and escalates only
+# uncertain ones (cascade_classifier.py)
+CLIP_BACKEND = _cfg.CLIP_BACKEND if _cfg.CLIP_BACKEND in ONNX_BACKENDS + ("cascade",) else "torch"
+
+if CLIP_BACKEND == "cascade":
+    logger.info(f"Using classifier cascade {' -> '.join(_cfg.CASCADE_STAGES)}")
+    from .cascade_classifier import (
+        classify_image,
+        classify_batch,
+        classify_batch_with_scores,
+        embed_images,
+        score_embeddings,
+        get_cascade_classifier as get_clip_model,
+        CascadeClassifier as CLIPPhotoClassifier,
+        CATEGORY_NAMES,
+    )
+elif CLIP_BACKEND in ONNX_BACKENDS:
+    logger.info(f"Using MobileCLIP-S0 on ONNX Runtime ({CLIP_BACKEND}, {_cfg.ONNX_MODEL_PATH})")
+    from .onnx_mobile_clip_model import (
+        classify_image,
+        classify_batch,
+        classify_batch_with_scores,
+        embed_images,
+        score_embeddings,
+        get_onnx_mobile_clip_model as get_clip_model,
+        OnnxMobileCLIPPhotoClassifier as CLIPPhotoClassifier,
+        CATEGORY_NAMES,
+    )
+elif USE_MOBILE_CLIP:
     logger.info(f"Using MobileCLIP ({MOBILE_CLIP_SIZE}) - lightweight model for free tier")
     from .mobile_clip_model import (
         classify_image,
         classify_batch,
+        classify_batch_with_scores,
+        embed_images,
+        score_embeddings,
         get_mobile_clip_model as get_clip_model,
         MobileCLIPPhotoClassifier as CLIPPhotoClassifier,
+        CATEGORY_NAMES,
     )
 else:
     logger.info("Using full CLIP (openai/clip-vit-base-patch32) - premium model")
     from .clip_model import (
         classify_image,
         classify_batch,
+        classify_batch_with_scores,
+        embed_images,
+        score_embeddings,
         get_clip_model,
         CLIPPhotoClassifier,
+        CATEGORY_NAMES,
     )
 
+# Registry name of the deployed classifier; other registry classifiers can be
+# picked per request or per tier (CLASSIFIER_TIERS) without a restart
+if CLIP_BACKEND != "torch":
+    DEFAULT_CLASSIFIER = CLIP_BACKEND
+elif USE_MOBILE_CLIP:
+    DEFAULT_CLASSIFIER = f"mobileclip-{MOBILE_CLIP_SIZE}"
+else:
+    DEFAULT_CLASSIFIER = "clip"
+
+
+def resolve_classifier(name: str = None, tier: str = None) -> str:
+    """
+    Registry name of the classifier to use: explicit name, else the tier's, else the default.
+
+    Raises:
+        ValueError: Unknown classifier name.
+    """
+    from .model_registry import registry
+
+    chosen = name or _cfg.CLASSIFIER_TIERS.get(tier or "") or DEFAULT_CLASSIFIER
+    if chosen not in registry.names("classifier"):
+        raise ValueError(f"Unknown classifier '{chosen}' (available: {', '.join(registry.names('classifier'))})")
+    return chosen
+
+
+def get_classifier(name: str = None):
+    """Shared classifier instance for a registry name (default: the deployed one)."""
+    from .model_registry import get_model
+    return get_model(name or DEFAULT_CLASSIFIER)
+
+
+def category_names_for(name: str = None) -> list:
+    if (name or DEFAULT_CLASSIFIER) in ONNX_BACKENDS:
+        from .onnx_mobile_clip_model import CATEGORY_NAMES as names
+    elif (name or DEFAULT_CLASSIFIER).startswith("mobileclip-") or (name or DEFAULT_CLASSIFIER) == "cascade":
+        from .mobile_clip_model import CATEGORY_NAMES as names
+    else:
+        from .clip_model import CATEGORY_NAMES as names
+    return names
+
+
+def category_thresholds_for(name: str = None) -> dict:
+    """Single-image (classify_image) category thresholds of a registry classifier."""
+    if (name or DEFAULT_CLASSIFIER) in ONNX_BACKENDS:
+        from .onnx_mobile_clip_model import CATEGORY_THRESHOLDS as thresholds
+    elif (name or DEFAULT_CLASSIFIER).startswith("mobileclip-") or (name or DEFAULT_CLASSIFIER) == "cascade":
+        from .mobile_clip_model import CATEGORY_THRESHOLDS as thresholds
+    else:
+        from .clip_model import CATEGORY_THRESHOLDS as thresholds
+    return thresholds
+
+
+def other_label_for(name: str = None) -> str:
+    """Fallback tag of a registry classifier when no category passes."""
+    return "Other" if (name or DEFAULT_CLASSIFIER) == "clip" else "other"
+
+
+def classify_batch_for(name: str = None):
+    """classify_batch() bound to a registry classifier (same signature and tag cleanup)."""
+    name = name or DEFAULT_CLASSIFIER
+    other = other_label_for(name)
+
+    def classify(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1,
+                 scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
+        results = get_classifier(name).classify_batch(image_paths, confidence_threshold, max_tags,
+                                                      scores_out=scores_out, embeddings_out=embeddings_out,
+                                                      hashes_out=hashes_out)
+        cleaned_results = []
+        for img_results in results:
+            tags = [tag for tag, _ in img_results]
+            if len(tags) > 1 and other in tags:
+                tags = [t for t in tags if t != other]
+            cleaned_results.append(tags)
+        return cleaned_results
+    return classify
+
+
+def embed_images_for(name: str = None):
+    """embed_images() bound to a registry classifier."""
+    return lambda images: get_classifier(name).embed_images(images)
+
+
 # Re-export everything with consistent names
 __all__ = [
     'classify_image',
     'classify_batch', 
+    'classify_batch_with_scores',
+    'embed_images',
+    'score_embeddings',
     'get_clip_model',
     'CLIPPhotoClassifier',
+    'CATEGORY_NAMES',
     'USE_MOBILE_CLIP',
+    'CLIP_BACKEND',
+    'ONNX_BACKENDS',
     'MOBILE_CLIP_SIZE',
+    'DEFAULT_CLASSIFIER',
+    'resolve_classifier',
+    'get_classifier',
+    'category_names_for',
+    'category_thresholds_for',
+    'other_label_for',
+    'classify_batch_for',
+    'embed_images_for',
 ]
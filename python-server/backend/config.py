@@ -40,6 +40,150 @@ CLIP_CONFIDENCE_THRESHOLD = float(os.getenv("CLIP_CONFIDENCE_THRESHOLD", "0.15")
 # Hybrid mode is faster when YOLO runs quickly (GPU or nano model on CPU)
 USE_HYBRID_CLASSIFICATION = os.getenv("USE_HYBRID_CLASSIFICATION", "True").lower() in ("1", "true", "yes")
 
+# Tags DB persistence. The DB is kept in memory and written back to
+# tags_db.json by a write-behind flusher:
+# - "write-behind": writes are coalesced and flushed every TAGS_DB_FLUSH_INTERVAL
+#   seconds or once TAGS_DB_FLUSH_THRESHOLD photoIDs are dirty (default)
+# - "sync": every write is flushed before the request returns (slow, safest)
+TAGS_DB_DURABILITY = os.getenv("TAGS_DB_DURABILITY", "write-behind").lower()
+TAGS_DB_FLUSH_INTERVAL = float(os.getenv("TAGS_DB_FLUSH_INTERVAL", "2.0"))
+TAGS_DB_FLUSH_THRESHOLD = int(os.getenv("TAGS_DB_FLUSH_THRESHOLD", "500"))
+
+# Tags DB backend:
+# - "json": in-process cache over tags_db.json (single worker only)
+# - "sqlite": tags_db.sqlite3 in WAL mode, safe with several uvicorn workers or
+#   hosts sharing the file; tags_db.json is imported on first start
+TAGS_DB_BACKEND = os.getenv("TAGS_DB_BACKEND", "json").lower()
+
+# Storage layout for the tags DB (json backend):
+# - "snapshot": whole tags_db.json rewritten on each flush (default)
+# - "journal": each write appends to tags_db.journal.jsonl (O(1) per write);
+#   a background compactor folds the journal into tags_db.json after
+#   TAGS_DB_COMPACT_RECORDS records or every TAGS_DB_COMPACT_INTERVAL seconds
+TAGS_DB_MODE = os.getenv("TAGS_DB_MODE", "snapshot").lower()
+# Journal fsync policy: "always" (every write), "interval" (every TAGS_DB_FLUSH_INTERVAL), "never"
+TAGS_DB_JOURNAL_FSYNC = os.getenv("TAGS_DB_JOURNAL_FSYNC", "interval").lower()
+TAGS_DB_COMPACT_RECORDS = int(os.getenv("TAGS_DB_COMPACT_RECORDS", "100000"))
+TAGS_DB_COMPACT_INTERVAL = float(os.getenv("TAGS_DB_COMPACT_INTERVAL", "300"))
+# Keep tag entries in interned, array-backed columns instead of a dict per photo
+# (several times less memory for large libraries; same API)
+TAGS_DB_COMPACT_MEMORY = os.getenv("TAGS_DB_COMPACT_MEMORY", "True").lower() in ("1", "true", "yes")
+
+# Per-tenant tag DB shards. Each tenant gets its own store file (cached and
+# flushed independently) so one client's scan doesn't slow everyone else:
+# - "off" (or "none"): single global tags DB (default)
+# - "device": shard by the X-Device-ID request header when present
+# - "device-or-token": X-Device-ID, else the X-Upload-Token value
+# Shards start empty: tags already in the global DB are not copied into them, so
+# clients sending X-Device-ID re-scan their library after sharding is turned on.
+TAGS_DB_SHARDING = os.getenv("TAGS_DB_SHARDING", "off").lower()
+# Close a tenant's shard after this many idle seconds / keep at most this many open
+TAGS_DB_SHARD_IDLE_SECONDS = float(os.getenv("TAGS_DB_SHARD_IDLE_SECONDS", "600"))
+TAGS_DB_MAX_OPEN_SHARDS = int(os.getenv("TAGS_DB_MAX_OPEN_SHARDS", "64"))
+# /scan-plan/ request limits: JSON size after gzip decompression, and photoIDs per request
+SCAN_PLAN_MAX_BYTES = int(os.getenv("SCAN_PLAN_MAX_BYTES", str(64 * 1024 * 1024)))
+SCAN_PLAN_MAX_IDS = int(os.getenv("SCAN_PLAN_MAX_IDS", "500000"))
+# Manual epoch folded into the pipeline version stamped on every tags DB entry
+# (see pipeline_version.py). Bump it to force a full rescan.
+TAGS_MODEL_VERSION = os.getenv("TAGS_MODEL_VERSION", "1")
+# Keep each photo's raw CLIP probabilities and YOLO detections (dense float16
+# arrays next to the tags DB) so thresholds can be re-applied without inference.
+# This store and the embedding, duplicate-hash and similar-group stores below are
+# rewritten whole by one process: single worker only (run_server.py --workers N
+# turns them all off)
+SCORE_STORE_ENABLED = os.getenv("SCORE_STORE_ENABLED", "True").lower() in ("1", "true", "yes")
+SCORE_STORE_FLUSH_INTERVAL = float(os.getenv("SCORE_STORE_FLUSH_INTERVAL", "30"))
+# Normalized CLIP text embeddings are cached here per (model, prompt list)
+TEXT_EMBEDDING_CACHE_DIR = os.getenv("TEXT_EMBEDDING_CACHE_DIR",
+                                     os.path.join(os.path.dirname(__file__), "embedding_cache"))
+# Keep every classified photo's image embedding (memory-mapped float16 matrix next
+# to the tags DB) for /semantic-search/. In hybrid mode this costs one extra image
+# tower batch for photos YOLO already classified.
+SEMANTIC_SEARCH_ENABLED = os.getenv("SEMANTIC_SEARCH_ENABLED", "True").lower() in ("1", "true", "yes")
+# Approximate search (IVF-PQ, see ann_index.py) once a store holds this many
+# embeddings. The exact scan costs ~1.5 ms per 1k rows per query on one core
+# (74 ms at 50k, 271 ms at 200k); the index answers in ~2 ms with recall@10 ~0.99
+# at 50k (nprobe 64, rerank 10), while smaller stores give it too few rows per
+# list to train well. NPROBE trades recall for latency, RERANK is how many
+# candidates per result get re-scored exactly, and PQ_M is the compressed size of one embedding in bytes (must divide its dim).
+ANN_INDEX_ENABLED = os.getenv("ANN_INDEX_ENABLED", "True").lower() in ("1", "true", "yes")
+ANN_INDEX_MIN_ROWS = int(os.getenv("ANN_INDEX_MIN_ROWS", "50000"))
+ANN_INDEX_NPROBE = int(os.getenv("ANN_INDEX_NPROBE", "64"))
+ANN_INDEX_RERANK = int(os.getenv("ANN_INDEX_RERANK", "10"))
+ANN_INDEX_PQ_M = int(os.getenv("ANN_INDEX_PQ_M", "64"))
+# Keep a dHash/pHash per classified photo (computed from the image the classifier
+# already decoded) for /duplicates/; pairs within this Hamming distance are grouped
+DUPLICATE_HASHES_ENABLED = os.getenv("DUPLICATE_HASHES_ENABLED", "True").lower() in ("1", "true", "yes")
+DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", "6"))
+# Similar-photo groups (bursts, retakes) for /similar-groups/: shots captured within
+# the window whose image embeddings reach the cosine similarity are linked; each new
+# photo is compared with at most MAX_NEIGHBORS photos closest to it in time
+SIMILAR_GROUPS_ENABLED = os.getenv("SIMILAR_GROUPS_ENABLED", "True").lower() in ("1", "true", "yes")
+SIMILAR_TIME_WINDOW_SECONDS = float(os.getenv("SIMILAR_TIME_WINDOW_SECONDS", "300"))
+SIMILAR_MIN_SIMILARITY = float(os.getenv("SIMILAR_MIN_SIMILARITY", "0.90"))
+SIMILAR_MAX_NEIGHBORS = int(os.getenv("SIMILAR_MAX_NEIGHBORS", "32"))
+
+# CLIP serving backend: "torch" (clip_switcher's USE_MOBILE_CLIP choice), "cascade"
+# (MobileCLIP-S0 escalating to larger models, see CASCADE_* below), "onnx"
+# (MobileCLIP-S0 image tower on ONNX Runtime, the same files the app ships; no
+# PyTorch at runtime), or its INT8 variants "onnx-int8" (static) and
+# "onnx-int8-dynamic" made by quantize_onnx_model.py. ONNX_GRAPH_OPTIMIZATION is disable/basic/extended/all;
+# thread counts of 0 let ONNX Runtime decide. ONNX_OPTIMIZED_MODEL_PATH, when set,
+# saves the optimized graph there. ONNX_BATCH_SIZE only applies to graphs exported
+# with a dynamic batch dimension.
+_ONNX_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "onnx_models")
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "torch").lower()
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", os.path.join(_ONNX_DIR, "mobileclip_image_encoder_256.onnx"))
+ONNX_CATEGORY_EMBEDDINGS = os.getenv("ONNX_CATEGORY_EMBEDDINGS", os.path.join(_ONNX_DIR, "category_embeddings.npy"))
+ONNX_GRAPH_OPTIMIZATION = os.getenv("ONNX_GRAPH_OPTIMIZATION", "all").lower()
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+ONNX_INTER_OP_THREADS = int(os.getenv("ONNX_INTER_OP_THREADS", "0"))
+ONNX_OPTIMIZED_MODEL_PATH = os.getenv("ONNX_OPTIMIZED_MODEL_PATH", "")
+ONNX_BATCH_SIZE = int(os.getenv("ONNX_BATCH_SIZE", "16"))
+
+# Inference tuning (0 keeps the library default). CLIP_BATCH_SIZE is images per
+# image-tower forward pass in the torch classifiers (0 = a whole request at once),
+# YOLO_BATCH_SIZE images per YOLO call in hybrid phase 1, and CLIP_AUTOCAST="bf16"
+# runs the torch image tower under bfloat16 autocast on CPUs with native bf16
+# (AVX512-BF16 / AMX); "off" keeps fp32.
+TORCH_INTRA_OP_THREADS = int(os.getenv("TORCH_INTRA_OP_THREADS", "0"))
+TORCH_INTER_OP_THREADS = int(os.getenv("TORCH_INTER_OP_THREADS", "0"))
+CLIP_BATCH_SIZE = int(os.getenv("CLIP_BATCH_SIZE", "0"))
+YOLO_BATCH_SIZE = int(os.getenv("YOLO_BATCH_SIZE", "8"))
+CLIP_AUTOCAST = os.getenv("CLIP_AUTOCAST", "off").lower()
+# Per-host tuning profiles (see autotune.py): "apply" uses the saved profile for
+# this host when there is one, "tune" also benchmarks at startup when there is
+# none, "off" ignores profiles. Settings given explicitly in the environment
+# always win over a profile.
+AUTOTUNE = os.getenv("AUTOTUNE", "apply").lower()
+AUTOTUNE_FILE = os.getenv("AUTOTUNE_FILE", os.path.join(os.path.dirname(__file__), "autotune.json"))
+
+# Model registry (see model_registry.py): loaded models are evicted least recently
+# used first once their total passes MODEL_MEMORY_BUDGET_MB (0 = no budget), and
+# unloaded after MODEL_IDLE_SECONDS without use (0 = never).
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+MODEL_IDLE_SECONDS = float(os.getenv("MODEL_IDLE_SECONDS", "0"))
+# Classifier per client tier (X-Tier header), e.g. "free=mobileclip-s0,premium=clip".
+# Names are model_registry classifiers; unmapped tiers use the deployed default.
+CLASSIFIER_TIERS = dict(
+    item.split("=", 1) for item in os.getenv("CLASSIFIER_TIERS", "").replace(" ", "").split(",") if "=" in item
+)
+
+# Confidence cascade (CLIP_BACKEND=cascade or classifier "cascade", see
+# cascade_classifier.py): registry classifiers tried cheapest first. A photo is
+# escalated to the next stage unless its top category probability reaches
+# CASCADE_MIN_TOP_PROB and leads the runner-up by CASCADE_MIN_MARGIN.
+CASCADE_STAGES = [
+    s for s in os.getenv("CASCADE_STAGES", "mobileclip-s0,mobileclip-s2,clip").replace(" ", "").split(",") if s
+]
+CASCADE_MIN_TOP_PROB = float(os.getenv("CASCADE_MIN_TOP_PROB", "0.85"))
+CASCADE_MIN_MARGIN = float(os.getenv("CASCADE_MIN_MARGIN", "0.3"))
+
+# Uploads are decoded once per request and shared by every stage (image_context.py).
+# IMAGE_DECODE_MAX_SIDE > 0 decodes at most that many pixels on the long side (JPEGs
+# at reduced DCT scale: much faster); 0 decodes at full resolution.
+IMAGE_DECODE_MAX_SIDE = int(os.getenv("IMAGE_DECODE_MAX_SIDE", "0"))
+
 # How many tags to return per image. Set to None for no limit (return all tags above
 # confidence threshold). Useful to avoid noisy long tag lists.
 AUTO_TAG_MAX = 10
@@ -0,0 +1,271 @@
+"""
+Near-duplicate detection over perceptual hashes (see image_hash.py).
+
+Hashes are kept per tenant as two uint64 columns (dHash, pHash) next to the
+tags DB (`<tags>.hashes.npz`). Finding every pair within Hamming distance k
+uses multi-index hashing: split the 64 bits into 4 chunks of 16; by the
+pigeonhole principle two hashes within distance k agree on at least one chunk
+up to floor(k / 4) bits. For each chunk we sort the chunk values once and, for
+every flip mask of at most that many bits, look up `value ^ mask` with
+searchsorted. Candidates are verified with a full popcount and merged into
+groups with union-find, so the cost follows the number of near pairs instead
+of N^2.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import config as _cfg
+from .image_hash import hamming
+
+logger = logging.getLogger(__name__)
+
+HASH_KINDS = ('dhash', 'phash')
+_CHUNKS = 4
+_CHUNK_BITS = 64 // _CHUNKS
+
+
+class HashStore:
+    """photoID -> (dhash, phash) backed by uint64 arrays."""
+
+    def __init__(self, path: str, flush_interval: float = 30.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._ids: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._hashes = np.zeros((0, len(HASH_KINDS)), dtype=np.uint64)
+        self._dirty = False
+        self._last_save = time.time()
+        # Set while out of the open-store cache: writes then flush immediately
+        self.evicted = False
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self._ids = [str(x) for x in data['photo_ids']]
+                self._hashes = data['hashes'].astype(np.uint64)
+            self._index = {pid: i for i, pid in enumerate(self._ids)}
+            logger.info(f"Loaded perceptual hashes for {len(self._ids)} photos from {self.path}")
+        except Exception:
+            logger.exception(f"Failed to read hash store {self.path}; starting empty")
+
+    def flush(self) -> bool:
+        """Write the store to disk if it changed (atomic replace)."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            n = len(self._ids)
+            tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                np.savez(tmp, photo_ids=np.array(self._ids, dtype=str), hashes=self._hashes[:n])
+                os.replace(tmp, self.path)
+            except Exception:
+                logger.exception(f"Failed to write hash store {self.path}")
+                return False
+            self._dirty = False
+            self._last_save = time.time()
+            return True
+
+    def put_many(self, records: Dict[str, Tuple[int, int]]) -> None:
+        """Record (dhash, phash) for many photos, overwriting earlier values."""
+        if not records:
+            return
+        with self._lock:
+            n = len(self._ids)
+            if n + len(records) > len(self._hashes):
+                grown = np.zeros((max(1024, 2 * (n + len(records))), len(HASH_KINDS)), dtype=np.uint64)
+                grown[:n] = self._hashes[:n]
+                self._hashes = grown
+            for photo_id, hashes in records.items():
+                row = self._index.get(photo_id)
+                if row is None:
+                    row = len(self._ids)
+                    self._ids.append(photo_id)
+                    self._index[photo_id] = row
+                self._hashes[row] = hashes
+            self._dirty = True
+            due = self.evicted or time.time() - self._last_save >= self.flush_interval
+        if due:
+            self.flush()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get(self, photo_id: str) -> Optional[Tuple[int, int]]:
+        with self._lock:
+            row = self._index.get(photo_id)
+            return None if row is None else (int(self._hashes[row, 0]), int(self._hashes[row, 1]))
+
+    def column(self, kind: str) -> Tuple[List[str], np.ndarray]:
+        """Point-in-time (photo_ids, uint64[N]) for one hash kind."""
+        with self._lock:
+            n = len(self._ids)
+            return list(self._ids), self._hashes[:n, HASH_KINDS.index(kind)].copy()
+
+
+def near_pairs(hashes: np.ndarray, max_distance: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """All pairs (i < j) with Hamming distance <= max_distance.
+
+    Args:
+        hashes: uint64[N] hashes.
+        max_distance: Largest Hamming distance to report. Work grows with the
+            per-chunk radius floor(max_distance / 4): ~0.5s per 100k hashes
+            up to 7, several seconds for 8..11.
+
+    Returns:
+        (i, j, distance) int64 arrays, one entry per pair.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    radius = max_distance // _CHUNKS
+    masks = [0] + [sum(1 << b for b in bits) for r in range(1, radius + 1)
+                   for bits in itertools.combinations(range(_CHUNK_BITS), r)]
+    masks = np.array(masks, dtype=np.int64)
+    n = len(hashes)
+    found_i, found_j = [], []
+    for c in range(_CHUNKS):
+        keys = ((hashes >> np.uint64(c * _CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.int64)
+        # Bucket table over the 2^16 chunk values: rows sorted by key, plus offsets
+        order = np.argsort(keys, kind='stable')
+        bucket_size = np.bincount(keys, minlength=1 << _CHUNK_BITS)
+        bucket_start = np.concatenate([[0], np.cumsum(bucket_size)[:-1]])
+        for mask in masks:
+            targets = keys ^ mask
+            counts = bucket_size[targets]
+            total = int(counts.sum())
+            if not total:
+                continue
+            left = np.repeat(np.arange(n), counts)
+            # Position within each target bucket, then map back to original rows
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            right = order[np.repeat(bucket_start[targets], counts) + within]
+            keep = left < right
+            left, right = left[keep], right[keep]
+            # Verify now so only true near pairs are kept across chunks and masks
+            close = hamming(hashes[left], hashes[right]) <= max_distance
+            found_i.append(left[close])
+            found_j.append(right[close])
+    pairs = np.unique(np.concatenate(found_i) * n + np.concatenate(found_j)) if found_i else np.zeros(0, np.int64)
+    # The same pair can surface through several chunks or masks
+    i, j = pairs // max(n, 1), pairs % max(n, 1)
+    return i, j, hamming(hashes[i], hashes[j])
+
+
+def group_pairs(n: int, i: np.ndarray, j: np.ndarray) -> List[List[int]]:
+    """Connected components (size >= 2) of the pair graph, via union-find."""
+    parent = np.arange(n)
+
+    def find(x: int) -> int:
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    groups: Dict[int, List[int]] = {}
+    for x in np.unique(np.concatenate([i, j])).tolist():
+        groups.setdefault(find(x), []).append(x)
+    return sorted(groups.values(), key=lambda g: (-len(g), g[0]))
+
+
+_stores: 'OrderedDict[str, HashStore]' = OrderedDict()
+_stores_lock = threading.Lock()
+# Every store still referenced anywhere, open or evicted
+_held: 'weakref.WeakValueDictionary' = weakref.WeakValueDictionary()
+
+
+def hash_path_for(tags_path: str) -> str:
+    """Hash file that sits next to a tags DB file (or SQLite DB)."""
+    return os.path.splitext(tags_path)[0] + '.hashes.npz'
+
+
+def get_hash_store(tenant: Optional[str] = None) -> HashStore:
+    """Return the hash store paired with `tenant`'s tags DB shard."""
+    from . import tags_db
+
+    path = hash_path_for(tags_db.get_store(tenant).path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            # Reuse an evicted store a request still holds instead of loading a second copy
+            store = _held.get(path)
+            if store is None:
+                store = _held[path] = HashStore(path, _cfg.SCORE_STORE_FLUSH_INTERVAL)
+            store.evicted = False
+            _stores[path] = store
+        _stores.move_to_end(path)
+        evicted = []
+        while len(_stores) > max(1, _cfg.TAGS_DB_MAX_OPEN_SHARDS):
+            old = _stores.popitem(last=False)[1]
+            old.evicted = True
+            evicted.append(old)
+    for old in evicted:
+        old.flush()
+    return store
+
+
+def record_hashes(records: Dict[str, Tuple[int, int]], tenant: Optional[str] = None) -> None:
+    """Best-effort: keep (dhash, phash) for a batch of photoIDs."""
+    if not _cfg.DUPLICATE_HASHES_ENABLED or not records:
+        return
+    try:
+        get_hash_store(tenant).put_many(records)
+    except Exception:
+        logger.exception('Failed to record perceptual hashes')
+
+
+def find_duplicates(tenant: Optional[str] = None, max_distance: Optional[int] = None,
+                    kind: str = 'phash') -> Dict[str, Any]:
+    """Group the tenant's photos into near-duplicate sets.
+
+    Args:
+        tenant: Tenant shard (None for the global store).
+        max_distance: Hamming distance threshold (default DUPLICATE_MAX_DISTANCE).
+        kind: 'phash' (robust to re-encoding and small edits) or 'dhash'.
+
+    Returns:
+        Dict with `groups` (lists of photoIDs, largest first), pair and photo counts.
+    """
+    if kind not in HASH_KINDS:
+        raise ValueError(f"kind must be one of {HASH_KINDS}")
+    max_distance = _cfg.DUPLICATE_MAX_DISTANCE if max_distance is None else max_distance
+    if not 0 <= max_distance <= 11:
+        raise ValueError('max_distance must be between 0 and 11')
+    t0 = time.time()
+    photo_ids, hashes = get_hash_store(tenant).column(kind)
+    i, j, distance = near_pairs(hashes, max_distance)
+    groups = group_pairs(len(photo_ids), i, j)
+    result = {
+        'groups': [[photo_ids[x] for x in group] for group in groups],
+        'pairs': int(len(i)),
+        'photos': len(photo_ids),
+        'hash': kind,
+        'max_distance': max_distance,
+        'elapsed_ms': round((time.time() - t0) * 1000, 1),
+    }
+    logger.info(f"Duplicate scan: {len(photo_ids)} photos, {len(i)} pairs, {len(groups)} groups "
+                f"in {result['elapsed_ms']}ms")
+    return result
+
+
+def flush() -> None:
+    with _stores_lock:
+        stores = list(_held.values())
+    for store in stores:
+        store.flush()
@@ -0,0 +1,387 @@
+"""
+Memory-mapped store of normalized image embeddings for semantic search.
+
+Each tenant/model pair gets three files next to its tags DB:
+- `<base>.f16`  raw float16 matrix [capacity, D], opened with np.memmap
+- `<base>.ids`  photoIDs, one per line, in row order (append-only)
+- `<base>.json` dim / count / model id; written last, so rows past `count`
+                from an interrupted write are ignored on the next load
+
+Re-embedding a photo overwrites its row in place. Search scores the matrix
+block by block (float16 -> float32 into a reused buffer, then one BLAS
+matrix-vector product) and picks the top k with argpartition, so the matrix
+never becomes Python objects and only one block is resident at a time.
+
+Past ANN_INDEX_MIN_ROWS embeddings an IVF-PQ index (ann_index.py) is trained in
+the background and kept up to date on every add; searches then probe it for
+`k * ANN_INDEX_RERANK` candidates and re-score those against the exact rows.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import config as _cfg
+from .ann_index import IVFPQIndex, default_nlist
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """Append/overwrite store of float16 embeddings with a photoID index."""
+
+    def __init__(self, base_path: str, dim: int, model_id: str):
+        self.base_path = base_path
+        self.dim = dim
+        self.model_id = model_id
+        self.data_path = base_path + '.f16'
+        self.ids_path = base_path + '.ids'
+        self.meta_path = base_path + '.json'
+        self._lock = threading.RLock()
+        self._ids: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._matrix: Optional[np.memmap] = None
+        self._capacity = 0
+        self._ids_flushed = 0
+        self._dirty = False
+        self._ann: Optional[IVFPQIndex] = None
+        self._ann_dirty = False
+        self._ann_building = False
+        # Set while out of the open-store cache: writes then flush immediately
+        self.evicted = False
+        self._load()
+        self._load_index()
+
+    # --- files ---
+
+    def _load(self) -> None:
+        count = 0
+        if os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta.get('dim') == self.dim and meta.get('model_id') == self.model_id:
+                    count = int(meta.get('count', 0))
+                else:
+                    logger.warning(f"Embedding store {self.base_path} was built for another model; starting over")
+            except Exception:
+                logger.exception(f"Failed to read {self.meta_path}; starting over")
+        if count and os.path.exists(self.ids_path):
+            with open(self.ids_path, 'r', encoding='utf-8') as f:
+                self._ids = f.read().split('\n')[:count]
+            count = min(count, len(self._ids))
+            self._ids = self._ids[:count]
+            self._index = {pid: i for i, pid in enumerate(self._ids)}
+        # Drop photoIDs written after the last committed count
+        with open(self.ids_path, 'a+', encoding='utf-8') as f:
+            f.seek(0)
+            f.truncate(0)
+            if self._ids:
+                f.write('\n'.join(self._ids) + '\n')
+        self._ids_flushed = len(self._ids)
+        size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        self._open(max(size // (2 * self.dim), count, 1024))
+        if count:
+            logger.info(f"Opened {count} embeddings ({self.dim}-d) from {self.data_path}")
+
+    def _load_index(self) -> None:
+        try:
+            index = IVFPQIndex.load(self.base_path)
+        except Exception:
+            logger.exception(f"Failed to read ANN index for {self.base_path}; it will be rebuilt")
+            return
+        if index is None:
+            return
+        if index.dim != self.dim:
+            logger.warning(f"Ignoring ANN index for {self.base_path}: dim {index.dim} != {self.dim}")
+            return
+        # Rows added after the index was last saved
+        count = len(self._ids)
+        if index.covered_rows < count:
+            self._index_rows(index, index.covered_rows, count)
+            self._ann_dirty = True
+        index.covered_rows = count
+        self._ann = index
+        logger.info(f"Opened ANN index for {self.base_path}: {index.stats()}")
+
+    def _index_rows(self, index: IVFPQIndex, start: int, end: int, block_rows: int = 16384) -> None:
+        for s in range(start, end, block_rows):
+            e = min(s + block_rows, end)
+            index.add(np.arange(s, e), np.asarray(self._matrix[s:e], dtype=np.float32))
+
+    def _open(self, capacity: int) -> None:
+        """(Re)map the data file with room for `capacity` rows."""
+        if self._matrix is not None:
+            self._matrix.flush()
+        nbytes = capacity * self.dim * 2
+        with open(self.data_path, 'ab') as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        self._matrix = np.memmap(self.data_path, dtype=np.float16, mode='r+', shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def flush(self, index: bool = True) -> bool:
+        """Persist new rows and photoIDs; `index=False` skips rewriting the ANN index.
+
+        The index is only saved on full flushes (shutdown, shard eviction); rows
+        appended after its last save are re-indexed from the matrix on load.
+        """
+        with self._lock:
+            if index and self._ann is not None and self._ann_dirty:
+                try:
+                    self._ann.save(self.base_path)
+                    self._ann_dirty = False
+                except Exception:
+                    logger.exception(f"Failed to save ANN index for {self.base_path}")
+            if not self._dirty:
+                return False
+            self._matrix.flush()
+            new_ids = self._ids[self._ids_flushed:]
+            if new_ids:
+                with open(self.ids_path, 'a', encoding='utf-8') as f:
+                    f.write('\n'.join(new_ids) + '\n')
+                self._ids_flushed = len(self._ids)
+            tmp = f"{self.meta_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self.dim, 'count': len(self._ids), 'model_id': self.model_id}, f)
+            os.replace(tmp, self.meta_path)
+            self._dirty = False
+            return True
+
+    # --- writes ---
+
+    def add_many(self, photo_ids: List[str], embeddings: np.ndarray) -> None:
+        """Store (or overwrite) one normalized embedding per photoID."""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(photo_ids), self.dim)
+        with self._lock:
+            rows = []
+            for photo_id in photo_ids:
+                row = self._index.get(photo_id)
+                if row is None:
+                    row = len(self._ids)
+                    self._ids.append(photo_id)
+                    self._index[photo_id] = row
+                rows.append(row)
+            if len(self._ids) > self._capacity:
+                self._open(max(2 * self._capacity, len(self._ids)))
+            self._matrix[np.array(rows)] = embeddings.astype(np.float16)
+            self._dirty = True
+            if self._ann is not None:
+                self._ann.add(np.array(rows), embeddings)
+                self._ann.covered_rows = len(self._ids)
+                self._ann_dirty = True
+        if self.evicted or len(self._ids) - self._ids_flushed >= 1000:
+            self.flush(index=False)
+
+    # --- reads ---
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get(self, photo_id: str) -> Optional[np.ndarray]:
+        row = self._index.get(photo_id)
+        return None if row is None else np.asarray(self._matrix[row], dtype=np.float32)
+
+    def search(self, query: np.ndarray, k: int = 20, nprobe: Optional[int] = None,
+               exact: bool = False) -> List[Tuple[str, float]]:
+        """Top-k by cosine similarity, through the ANN index when one is ready.
+
+        Args:
+            query: float[D] normalized query embedding.
+            k: Number of results.
+            nprobe: Inverted lists to probe (defaults to ANN_INDEX_NPROBE).
+            exact: Always scan the whole matrix.
+
+        Returns:
+            [(photo_id, score), ...] best first; scores are exact either way.
+        """
+        index = self._ann
+        if exact or not self.uses_index():
+            return self.search_exact(query, k)
+        q = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        rows, _ = index.search(q, k * max(1, _cfg.ANN_INDEX_RERANK), nprobe or _cfg.ANN_INDEX_NPROBE)
+        if len(rows) == 0:
+            return []
+        with self._lock:
+            matrix, ids = self._matrix, self._ids
+        # An index saved ahead of the photoID list can reference uncommitted rows
+        rows = np.sort(rows[rows < len(ids)])
+        scores = np.asarray(matrix[rows], dtype=np.float32) @ q
+        top = np.argsort(-scores)[:k]
+        return [(ids[rows[i]], float(scores[i])) for i in top]
+
+    def search_exact(self, query: np.ndarray, k: int = 20, block_rows: int = 16384) -> List[Tuple[str, float]]:
+        """Exact top-k by cosine similarity (embeddings and query are normalized).
+
+        Args:
+            query: float[D] normalized query embedding.
+            k: Number of results.
+            block_rows: Rows converted to float32 per step (bounds memory use).
+
+        Returns:
+            [(photo_id, score), ...] best first.
+        """
+        with self._lock:
+            matrix, count, ids = self._matrix, len(self._ids), self._ids
+        if count == 0:
+            return []
+        q = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        scores = np.empty(count, dtype=np.float32)
+        buf = np.empty((min(block_rows, count), self.dim), dtype=np.float32)
+        for start in range(0, count, block_rows):
+            end = min(start + block_rows, count)
+            block = buf[:end - start]
+            np.copyto(block, matrix[start:end])
+            np.dot(block, q, out=scores[start:end])
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i])) for i in top]
+
+    # --- ANN index ---
+
+    def build_index(self, nlist: Optional[int] = None, m: Optional[int] = None,
+                    train_rows: int = 65536, seed: int = 0) -> IVFPQIndex:
+        """Train an IVF-PQ index on a sample of the stored rows and index all of them.
+
+        Args:
+            nlist: Inverted lists (default: ~4 * sqrt(N), see default_nlist).
+            m: PQ sub-quantizers, i.e. bytes per vector (default ANN_INDEX_PQ_M).
+            train_rows: Training sample size.
+
+        Returns:
+            The new index, which also replaces the current one.
+        """
+        count = len(self._ids)
+        nlist = nlist or default_nlist(count)
+        index = IVFPQIndex(self.dim, nlist, m or _cfg.ANN_INDEX_PQ_M)
+        t0 = time.time()
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, min(count, max(train_rows, nlist)), replace=False))
+        index.train(np.asarray(self._matrix[sample_rows], dtype=np.float32), seed=seed)
+        t1 = time.time()
+        self._index_rows(index, 0, count)
+        with self._lock:
+            # Rows that arrived while training
+            self._index_rows(index, count, len(self._ids))
+            index.covered_rows = len(self._ids)
+            self._ann = index
+            self._ann_dirty = True
+        logger.info(f"Built ANN index for {self.base_path}: {len(self._ids)} rows, nlist={nlist}, m={index.m}, "
+                    f"train {t1 - t0:.1f}s, add {time.time() - t1:.1f}s")
+        self.flush()
+        return index
+
+    def ensure_index(self) -> bool:
+        """Start a background index build once the store is large enough.
+
+        Returns:
+            True when an index is ready to serve searches.
+        """
+        if self._ann is not None:
+            return True
+        if not _cfg.ANN_INDEX_ENABLED or len(self._ids) < _cfg.ANN_INDEX_MIN_ROWS:
+            return False
+        with self._lock:
+            if self._ann_building:
+                return False
+            self._ann_building = True
+
+        def build():
+            try:
+                self.build_index()
+            except Exception:
+                logger.exception(f"ANN index build failed for {self.base_path}")
+            finally:
+                self._ann_building = False
+
+        threading.Thread(target=build, name='ann-index-build', daemon=True).start()
+        return False
+
+    def uses_index(self) -> bool:
+        return _cfg.ANN_INDEX_ENABLED and self._ann is not None and len(self._ids) >= _cfg.ANN_INDEX_MIN_ROWS
+
+    def index_stats(self) -> Optional[Dict[str, object]]:
+        return None if self._ann is None else self._ann.stats()
+
+
+_stores: 'OrderedDict[str, EmbeddingStore]' = OrderedDict()
+_stores_lock = threading.Lock()
+# Every store still referenced anywhere, open or evicted
+_held: 'weakref.WeakValueDictionary' = weakref.WeakValueDictionary()
+
+
+def get_embedding_store(dim: int, model_id: str, tenant: Optional[str] = None) -> EmbeddingStore:
+    """Return the embedding store for `tenant`'s tags DB shard and the given model."""
+    from . import tags_db
+
+    model_key = hashlib.sha256(model_id.encode('utf-8')).hexdigest()[:8]
+    base = f"{os.path.splitext(tags_db.get_store(tenant).path)[0]}.emb_{model_key}"
+    with _stores_lock:
+        store = _stores.get(base)
+        if store is None:
+            # Reuse an evicted store a request still holds instead of loading a second copy
+            store = _held.get(base)
+            if store is None:
+                store = _held[base] = EmbeddingStore(base, dim, model_id)
+            store.evicted = False
+            _stores[base] = store
+        _stores.move_to_end(base)
+        evicted = []
+        while len(_stores) > max(1, _cfg.TAGS_DB_MAX_OPEN_SHARDS):
+            old = _stores.popitem(last=False)[1]
+            old.evicted = True
+            evicted.append(old)
+    for old in evicted:
+        old.flush()
+    return store
+
+
+def record_embeddings(embeddings: Dict[str, np.ndarray], tenant: Optional[str] = None,
+                      classifier_name: Optional[str] = None) -> None:
+    """Best-effort: keep image embeddings for a batch of photoIDs (in that classifier's store)."""
+    if not _cfg.SEMANTIC_SEARCH_ENABLED or not embeddings:
+        return
+    try:
+        from .clip_switcher import get_classifier
+        clf = get_classifier(classifier_name)
+        get_embedding_store(clf.embedding_dim, clf.model_id, tenant).add_many(
+            list(embeddings), np.stack(list(embeddings.values())))
+    except Exception:
+        logger.exception('Failed to record image embeddings')
+
+
+def semantic_search(query: str, k: int = 20, tenant: Optional[str] = None) -> Dict[str, object]:
+    """Encode `query` with the text tower and return the k most similar photos."""
+    from .clip_switcher import get_clip_model
+
+    t0 = time.time()
+    clf = get_clip_model()
+    q = clf.embed_text([query])[0]
+    t1 = time.time()
+    store = get_embedding_store(clf.embedding_dim, clf.model_id, tenant)
+    store.ensure_index()
+    hits = store.search(q, k)
+    t2 = time.time()
+    return {
+        'query': query,
+        'results': [{'photoID': pid, 'score': round(score, 4)} for pid, score in hits],
+        'searched': len(store),
+        'mode': 'ann' if store.uses_index() else 'exact',
+        'encode_ms': round((t1 - t0) * 1000, 1),
+        'search_ms': round((t2 - t1) * 1000, 1),
+    }
+
+
+def flush() -> None:
+    with _stores_lock:
+        stores = list(_held.values())
+    for store in stores:
+        store.flush()
@@ -1,4 +1,5 @@
 from ..config import DOCUMENTS_FOLDER
+from ..image_context import ImageContext
 import os
 import cv2
 import numpy as np
@@ -11,6 +12,8 @@ def select(results, img=None):
     Detect documents by analyzing:
     - Filename keywords (doc, receipt, invoice, paper, screenshot)
     - Image characteristics: high contrast, white/light background, text-like edges
+
+    `img` is a BGR array or an ImageContext (its cached BGR and grayscale views are used).
     """
     # Check filename first
     try:
@@ -31,7 +34,10 @@ def select(results, img=None):
     if img is not None:
         try:
             # Convert to grayscale
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+            if isinstance(img, ImageContext):
+                img, gray = img.bgr, img.gray
+            else:
+                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
             h, w = gray.shape
             
             # STRICT CHECK 1: Very bright overall (documents are usually white/light background)
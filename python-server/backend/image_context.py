@@ -0,0 +1,153 @@
+"""
+Decode an uploaded image once and share it between pipeline stages.
+
+An `ImageContext` wraps one upload (its bytes and/or temp path). The first
+stage that needs pixels decodes it; every other view is derived lazily from
+that decode and cached:
+- `pil`: RGB PIL image (CLIP, YOLO, hashes)
+- `rgb` / `bgr` / `gray`: uint8 arrays (OCR, OpenCV heuristics)
+- `hashes`: (dhash, phash) for /duplicates/
+- `view(key, build)`: any model-specific input (e.g. a resized, normalized tensor)
+- `stripped_bytes()`: the upload re-encoded without metadata
+
+Classifiers, the YOLO+CLIP hybrid, OCR and the document heuristics accept a
+context wherever they take an image path (`load_rgb` does the dispatch), so an
+endpoint builds one context per upload and passes it along.
+
+With IMAGE_DECODE_MAX_SIDE set, `pil` and the arrays are reduced to between
+that many and twice that many pixels on the long side without resampling:
+JPEGs are decoded at a smaller DCT scale directly (much faster than a full
+decode), other formats are box-reduced by an integer factor. The default 0
+decodes at full resolution, exactly like opening the file.
+"""
+import logging
+from io import BytesIO
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+
+class ImageContext:
+    """One image, decoded at most once, with cached views for each stage."""
+
+    def __init__(self, path: Optional[str] = None, data: Optional[bytes] = None,
+                 max_side: Optional[int] = None):
+        """
+        Args:
+            path: Image file (used for decoding when `data` is not given, and as its name).
+            data: Encoded image bytes, e.g. the upload body.
+            max_side: Target long side of the decoded views (default IMAGE_DECODE_MAX_SIDE; 0 = full size).
+        """
+        if path is None and data is None:
+            raise ValueError("ImageContext needs a path or data")
+        self.path = path
+        self.data = data
+        self.max_side = _cfg.IMAGE_DECODE_MAX_SIDE if max_side is None else max_side
+        self._full: Optional[Image.Image] = None
+        self._views: Dict[Hashable, Any] = {}
+
+    def __repr__(self) -> str:
+        return f"ImageContext({self.path or f'<{len(self.data)} bytes>'})"
+
+    __str__ = __repr__
+
+    def _open(self) -> Image.Image:
+        return Image.open(BytesIO(self.data) if self.data is not None else self.path)
+
+    @property
+    def full(self) -> Image.Image:
+        """Full-resolution image in its own mode (format and metadata kept)."""
+        if self._full is None:
+            img = self._open()
+            img.load()
+            self._full = img
+        return self._full
+
+    def _cached(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        if key not in self._views:
+            self._views[key] = build()
+        return self._views[key]
+
+    def _decode_rgb(self) -> Image.Image:
+        if self._full is not None:
+            img = self._full.convert("RGB")
+        else:
+            img = self._open()
+            if self.max_side and img.format == "JPEG" and max(img.size) > self.max_side:
+                # Smallest DCT scale (1/2, 1/4, 1/8) still covering max_side
+                scale = self.max_side / max(img.size)
+                img.draft("RGB", (int(img.width * scale), int(img.height * scale)))
+            img.load()
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+        factor = max(img.size) // self.max_side if self.max_side else 1
+        if factor >= 2:
+            img = img.reduce(factor)
+        return img
+
+    @property
+    def pil(self) -> Image.Image:
+        """RGB PIL image."""
+        return self._cached("pil", self._decode_rgb)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.pil.size
+
+    @property
+    def rgb(self) -> np.ndarray:
+        """uint8[H, W, 3] RGB array."""
+        return self._cached("rgb", lambda: np.asarray(self.pil))
+
+    @property
+    def bgr(self) -> np.ndarray:
+        """uint8[H, W, 3] BGR array, as cv2.imread returns."""
+        return self._cached("bgr", lambda: np.ascontiguousarray(self.rgb[:, :, ::-1]))
+
+    @property
+    def gray(self) -> np.ndarray:
+        """uint8[H, W] grayscale (ITU-R 601 luma, like cv2.COLOR_BGR2GRAY)."""
+        return self._cached("gray", lambda: np.asarray(self.pil.convert("L")))
+
+    @property
+    def hashes(self) -> Tuple[int, int]:
+        """(dhash, phash) of the decoded image."""
+        from .image_hash import hash_image
+        return self._cached("hashes", lambda: hash_image(self.pil))
+
+    def view(self, key: Hashable, build: Callable[[Image.Image], Any]) -> Any:
+        """Model-specific view of the image, built from `pil` once per key.
+
+        Args:
+            key: Identifies the view, e.g. ("onnx", 256).
+            build: Makes the view from the RGB PIL image.
+        """
+        return self._cached(("view", key), lambda: build(self.pil))
+
+    def stripped_bytes(self) -> bytes:
+        """The image re-encoded in its own format (PNG if unknown) without EXIF or other metadata."""
+        img = self.full
+        out = BytesIO()
+        img.save(out, format=img.format or "PNG")
+        return out.getvalue()
+
+    def release(self) -> None:
+        """Drop the decoded pixels and the encoded bytes (the path stays usable)."""
+        self._full = None
+        self._views.clear()
+        if self.path is not None:
+            self.data = None
+
+
+def load_rgb(source: Any) -> Image.Image:
+    """RGB PIL image for an ImageContext, a PIL image or an image path."""
+    if isinstance(source, ImageContext):
+        return source.pil
+    if isinstance(source, Image.Image):
+        return source if source.mode == "RGB" else source.convert("RGB")
+    return Image.open(source).convert("RGB")
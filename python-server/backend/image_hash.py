@@ -0,0 +1,85 @@
+"""
+Perceptual hashes (dHash and pHash) as 64-bit integers.
+
+Both are computed from an image that is already decoded (the classifiers hash
+the PIL image they just loaded) after an integer box reduction, so hashing
+needs no extra file read and costs ~10-20 ms for a 12 MP photo, small next to
+the image tower.
+
+- dHash: 9x8 grayscale, one bit per horizontal gradient sign
+- pHash: 32x32 grayscale, 2-D DCT, top-left 8x8 low frequencies (DC term
+  replaced by the [0, 8] coefficient) compared against their median
+
+Hamming distance between hashes of the same picture (re-encoded, resized,
+lightly edited) is typically <= 6; unrelated photos land around 32.
+"""
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+_PHASH_SIZE = 32
+_PHASH_LOW = 8
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix, so DCT(x) = D @ x @ D.T for an n x n block."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    d[0] /= np.sqrt(2.0)
+    return d
+
+
+_DCT = _dct_matrix(_PHASH_SIZE)
+_BIT_WEIGHTS = (1 << np.arange(63, -1, -1, dtype=np.uint64)).astype(np.uint64)
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int(np.bitwise_or.reduce(np.where(bits.ravel(), _BIT_WEIGHTS, np.uint64(0))))
+
+
+def _gray_thumbnail(image: Image.Image) -> Image.Image:
+    # Integer box reduction to ~4x the pHash grid: far cheaper than a full resize
+    factor = min(image.size) // (4 * _PHASH_SIZE)
+    small = image.reduce(factor) if factor > 1 else image
+    return small.convert('L')
+
+
+def dhash(image: Image.Image) -> int:
+    return _dhash_gray(_gray_thumbnail(image))
+
+
+def phash(image: Image.Image) -> int:
+    return _phash_gray(_gray_thumbnail(image))
+
+
+def _dhash_gray(gray: Image.Image) -> int:
+    px = np.asarray(gray.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return _pack(px[:, 1:] > px[:, :-1])
+
+
+def _phash_gray(gray: Image.Image) -> int:
+    px = np.asarray(gray.resize((_PHASH_SIZE, _PHASH_SIZE), Image.BILINEAR), dtype=np.float64)
+    coeffs = (_DCT @ px @ _DCT.T)[:_PHASH_LOW, :_PHASH_LOW + 1]
+    # Drop the DC term (overall brightness), keep 64 low-frequency coefficients
+    low = np.concatenate([coeffs[0, 1:], coeffs[1:, :_PHASH_LOW].ravel()])
+    return _pack(low > np.median(low))
+
+
+def hash_image(image: Image.Image) -> Tuple[int, int]:
+    """Return (dhash, phash) of a decoded image, sharing one downscale."""
+    gray = _gray_thumbnail(image)
+    return _dhash_gray(gray), _phash_gray(gray)
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Element-wise popcount(a ^ b) of uint64 arrays."""
+    x = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    # NumPy < 2.0: popcount through a byte lookup table
+    return _POPCOUNT8[x.reshape(-1, 1).view(np.uint8)].sum(axis=1).reshape(x.shape).astype(np.int64)
+
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
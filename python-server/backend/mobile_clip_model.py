@@ -9,10 +9,17 @@ Model comparison:
 - openai/clip-vit-base-patch32: ~600MB, ~170ms/image
 - MobileCLIP-S2: ~70MB, ~80ms/image, 95% accuracy of full CLIP
 """
+import numpy as np
 import torch
-from PIL import Image
 import logging
 
+from . import config as _cfg
+from .autotune import autocast_context
+from .category_tags import match_expected, select_tags
+from .image_context import load_rgb
+from .image_hash import hash_image
+from .text_embedding_cache import get_text_embeddings, softmax_scores
+
 logger = logging.getLogger(__name__)
 
 # Check if open_clip is available
@@ -33,6 +40,19 @@ PHOTO_CATEGORIES = [
     "cartoon, illustration, drawing, mascot, artwork",
 ]
 
+# Clean tag names for PHOTO_CATEGORIES (same order)
+CATEGORY_NAMES = ["people", "animals", "food", "scenery", "document", "illustration"]
+
+# Category-specific thresholds (same as clip_model.py), used by both single and batch
+CATEGORY_THRESHOLDS = {
+    "food": 0.80,
+    "document": 0.70,
+    "animals": 0.70,
+    "people": 0.80,
+    "scenery": 0.70,
+    "illustration": 0.60,
+}
+
 
 class MobileCLIPPhotoClassifier:
     """MobileCLIP-based photo classifier - lightweight alternative to full CLIP."""
@@ -59,6 +79,7 @@ class MobileCLIPPhotoClassifier:
             raise ValueError(f"Invalid model_size. Choose from: {list(self.MODELS.keys())}")
         
         model_name, pretrained = self.MODELS[model_size]
+        self.model_id = f"{model_name}/{pretrained}"
         logger.info(f"Loading MobileCLIP model: {model_name} (pretrained={pretrained})")
         
         # Load MobileCLIP model
@@ -74,11 +95,61 @@ class MobileCLIPPhotoClassifier:
         self.model.to(self.device)
         self.model.eval()
         
-        # Pre-tokenize categories for faster inference
-        self._text_tokens = self.tokenizer(self.categories).to(self.device)
+        # Category prompts are fixed: embed them once (cached on disk across restarts)
+        self.text_features = self.get_text_features(self.categories)
+        self.embedding_dim = self.text_features.shape[1]
         
         logger.info(f"MobileCLIP model loaded on {self.device}")
     
+    def _encode_text(self, prompts: list):
+        """Run the text tower (only on a text embedding cache miss)."""
+        with torch.no_grad():
+            return self.model.encode_text(self.tokenizer(prompts).to(self.device)).float().cpu().numpy()
+    
+    def get_text_features(self, prompts: list) -> np.ndarray:
+        """L2-normalized text embeddings for `prompts`, float32[P, D] (cached)."""
+        return get_text_embeddings(self.model_id, list(prompts), self._encode_text)
+    
+    def embed_text(self, prompts: list) -> np.ndarray:
+        """L2-normalized text embeddings without caching (e.g. search queries)."""
+        emb = self._encode_text(list(prompts))
+        return emb / np.linalg.norm(emb, axis=-1, keepdims=True)
+    
+    def embed_images(self, images: list) -> np.ndarray:
+        """
+        Run only the image tower.
+        Same API as CLIPPhotoClassifier.embed_images()
+        
+        Args:
+            images: PIL images, image file paths or ImageContexts
+            
+        Returns:
+            float32[N, D] L2-normalized image embeddings
+        """
+        images = [load_rgb(im) for im in images]
+        if not images:
+            return np.zeros((0, self.embedding_dim), dtype=np.float32)
+        step = _cfg.CLIP_BATCH_SIZE or len(images)
+        chunks = []
+        with torch.no_grad(), autocast_context(self.device):
+            for start in range(0, len(images), step):
+                image_batch = torch.stack([self.preprocess(im) for im in images[start:start + step]]).to(self.device)
+                image_features = self.model.encode_image(image_batch).float()
+                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+                chunks.append(image_features.cpu().numpy())
+        return np.concatenate(chunks)
+    
+    def score_embeddings(self, embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+        """
+        Score image embeddings against a prompt set (no image tower).
+        Same API as CLIPPhotoClassifier.score_embeddings()
+        
+        Returns:
+            float32[N, P] softmax(100 * cosine similarity) probabilities
+        """
+        text = self.text_features if prompt_set is None else self.get_text_features(prompt_set)
+        return softmax_scores(embeddings, text, 100.0)
+    
     def classify_image(self, image_path: str, confidence_threshold: float = 0.15, max_tags: int = 5,
                       expected_tags: list = None):
         """
@@ -95,31 +166,18 @@ class MobileCLIPPhotoClassifier:
             List of tuples: [(tag, confidence), ...]
         """
         try:
-            # Load and preprocess image
-            image = Image.open(image_path).convert("RGB")
-            image_tensor = self.preprocess(image).unsqueeze(0).to(self.device)
+            # Load image
+            image = load_rgb(image_path)
             
-            # Get predictions
-            with torch.no_grad():
-                image_features = self.model.encode_image(image_tensor)
-                text_features = self.model.encode_text(self._text_tokens)
-                
-                # Normalize features
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                
-                # Calculate similarity
-                similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)[0]
+            # Get predictions (text embeddings are precomputed)
+            probs = self.score_embeddings(self.embed_images([image]))[0]
             
             # Map category indices to clean names
-            category_names = [
-                "people", "animals", "food", "scenery",
-                "document", "illustration"
-            ]
+            category_names = CATEGORY_NAMES
             
             # Build all scores for dynamic threshold adjustment
             all_scores = []
-            for idx, prob in enumerate(similarity):
+            for idx, prob in enumerate(probs):
                 tag_name = category_names[idx] if idx < len(category_names) else "other"
                 if tag_name != "other":
                     all_scores.append((tag_name, float(prob)))
@@ -129,51 +187,16 @@ class MobileCLIPPhotoClassifier:
             
             # If expected_tags provided, try to find them with dynamic thresholds
             if expected_tags:
-                for threshold_attempt in [0.80, 0.70, 0.60, 0.50, 0.40, 0.30, 0.20]:
-                    found_tags = [
-                        (tag, score) for tag, score in all_scores
-                        if score >= threshold_attempt and tag in expected_tags
-                    ]
-                    if found_tags:
-                        logger.info(f"Found expected tags {expected_tags} at threshold {threshold_attempt}: {found_tags}")
-                        return found_tags[:max_tags]
-                
+                match = match_expected(probs, CATEGORY_NAMES, expected_tags, max_tags, "other")
+                if match:
+                    logger.info(f"Found expected tags {expected_tags} at threshold {match[0]}: {match[1]}")
+                    return match[1]
                 logger.warning(f"Expected tags {expected_tags} not found even at threshold 0.20. Top scores: {all_scores[:3]}")
             
-            # Category-specific thresholds (same as clip_model.py)
-            category_thresholds = {
-                "food": 0.80,
-                "document": 0.70,
-                "animals": 0.70,
-                "people": 0.80,
-                "scenery": 0.70,
-                "illustration": 0.60,
-            }
-            
-            # Check for illustration to suppress food false positives
-            illustration_score = next((score for tag, score in all_scores if tag == "illustration"), 0)
-            is_likely_illustration = illustration_score >= 0.40
-            
-            results = []
-            for tag_name, prob in all_scores:
-                if tag_name == "illustration":
-                    continue
-                
-                required_threshold = category_thresholds.get(tag_name, confidence_threshold)
-                
-                if tag_name == "food" and is_likely_illustration:
-                    logger.info(f"Suppressing food (score={prob:.2f}) - looks like illustration (score={illustration_score:.2f})")
-                    continue
-                
-                if prob >= required_threshold:
-                    results.append((tag_name, prob))
-            
-            if not results:
+            results = select_tags(probs, CATEGORY_NAMES, CATEGORY_THRESHOLDS, max_tags, "other",
+                                  confidence_threshold)[0]
+            if results == [("other", 0.0)]:
                 logger.warning(f"No categories matched for {image_path}. Top scores: {all_scores[:3]}")
-                results.append(("other", 0.0))
-            
-            results.sort(key=lambda x: x[1], reverse=True)
-            results = results[:max_tags]
             
             logger.info(f"Classified {image_path}: {[tag for tag, _ in results]}")
             return results
@@ -182,7 +205,8 @@ class MobileCLIPPhotoClassifier:
             logger.error(f"Error classifying {image_path}: {e}")
             return []
     
-    def classify_batch(self, image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 5):
+    def classify_batch(self, image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 5,
+                       scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
         """
         Classify multiple images in batch for better performance.
         Same API as CLIPPhotoClassifier.classify_batch()
@@ -191,94 +215,62 @@ class MobileCLIPPhotoClassifier:
             image_paths: List of image file paths
             confidence_threshold: Minimum confidence score
             max_tags: Maximum tags per image
+            scores_out: If given, extended with one raw probability vector per
+                input path (float32, CATEGORY_NAMES order; None if unreadable)
+            embeddings_out: Same, with the normalized image embedding per path
+            hashes_out: Same, with the (dhash, phash) of the decoded image per path
             
         Returns:
             List of results, one per image: [[(tag, conf), ...], ...]
         """
+        if scores_out is not None:
+            scores_base = len(scores_out)
+            scores_out.extend([None] * len(image_paths))
+        if embeddings_out is not None:
+            embeddings_base = len(embeddings_out)
+            embeddings_out.extend([None] * len(image_paths))
+        if hashes_out is not None:
+            hashes_base = len(hashes_out)
+            hashes_out.extend([None] * len(image_paths))
         try:
             # Load all images
             images = []
             valid_paths = []
-            for path in image_paths:
+            valid_indices = []
+            for path_idx, path in enumerate(image_paths):
                 try:
-                    img = Image.open(path).convert("RGB")
-                    img_tensor = self.preprocess(img)
-                    images.append(img_tensor)
+                    img = load_rgb(path)
+                    images.append(img)
                     valid_paths.append(path)
+                    valid_indices.append(path_idx)
                 except Exception as e:
                     logger.warning(f"Failed to load {path}: {e}")
             
             if not images:
                 return [[] for _ in image_paths]
             
-            # Stack into batch tensor
-            image_batch = torch.stack(images).to(self.device)
-            
-            # Get predictions for all images
-            with torch.no_grad():
-                image_features = self.model.encode_image(image_batch)
-                text_features = self.model.encode_text(self._text_tokens)
-                
-                # Normalize
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                
-                # Calculate similarities for all images
-                similarities = (100.0 * image_features @ text_features.T).softmax(dim=-1)
+            if hashes_out is not None:
+                for img, path_idx in zip(images, valid_indices):
+                    hashes_out[hashes_base + path_idx] = hash_image(img)
             
-            # Map category indices to clean names
-            category_names = [
-                "people", "animals", "food", "scenery",
-                "document", "illustration"
-            ]
+            # Get predictions for all images (text embeddings are precomputed)
+            embeddings = self.embed_images(images)
+            similarities = self.score_embeddings(embeddings)
             
-            category_thresholds = {
-                "food": 0.80,
-                "document": 0.70,
-                "animals": 0.70,
-                "people": 0.80,
-                "scenery": 0.70,
-                "illustration": 0.60,
-            }
+            if embeddings_out is not None:
+                for row, path_idx in zip(embeddings, valid_indices):
+                    embeddings_out[embeddings_base + path_idx] = row
             
-            # Process results for each image
-            batch_results = []
-            for img_idx, image_probs in enumerate(similarities):
-                # Get illustration score for food suppression
-                illustration_score = 0.0
-                for idx, prob in enumerate(image_probs):
-                    tag_name = category_names[idx] if idx < len(category_names) else "other"
-                    if tag_name == "illustration":
-                        illustration_score = float(prob)
-                        break
-                
-                is_likely_illustration = illustration_score >= 0.40
-                
-                results = []
-                for idx, prob in enumerate(image_probs):
-                    tag_name = category_names[idx] if idx < len(category_names) else "other"
-                    
-                    if tag_name in ("other", "illustration"):
-                        continue
-                    
-                    if tag_name == "food" and is_likely_illustration:
-                        logger.info(f"[Batch] Suppressing food (score={float(prob):.2f}) - looks like illustration (score={illustration_score:.2f})")
-                        continue
-                    
-                    required_threshold = category_thresholds.get(tag_name, confidence_threshold)
-                    if prob >= required_threshold:
-                        results.append((tag_name, float(prob)))
-                
-                if not results:
-                    results.append(("other", 0.0))
-                
-                results.sort(key=lambda x: x[1], reverse=True)
-                results = results[:max_tags]
-                batch_results.append(results)
-                
-                if img_idx < len(valid_paths):
-                    logger.info(f"Batch classified {valid_paths[img_idx]}: {[tag for tag, _ in results]}")
+            if scores_out is not None:
+                for row, path_idx in zip(similarities, valid_indices):
+                    scores_out[scores_base + path_idx] = row
             
+            tags = select_tags(similarities, CATEGORY_NAMES, CATEGORY_THRESHOLDS, max_tags, "other",
+                               confidence_threshold)
+            batch_results = [[] for _ in image_paths]
+            for path_idx, results in zip(valid_indices, tags):
+                batch_results[path_idx] = results
+            logger.debug(f"Batch classified {len(valid_paths)} images")
             return batch_results
             
         except Exception as e:
@@ -296,16 +288,12 @@ class MobileCLIPPhotoClassifier:
         return [tag for tag, _ in results]
 
 
-# Singleton instance
-_mobile_clip_classifier = None
-
-
-def get_mobile_clip_model(model_size="s2"):
-    """Get or create MobileCLIP classifier singleton."""
-    global _mobile_clip_classifier
-    if _mobile_clip_classifier is None:
-        _mobile_clip_classifier = MobileCLIPPhotoClassifier(model_size=model_size)
-    return _mobile_clip_classifier
+def get_mobile_clip_model(model_size=None):
+    """Get the shared MobileCLIP classifier (default size: clip_switcher.MOBILE_CLIP_SIZE)."""
+    from .model_registry import get_model
+    if model_size is None:
+        from .clip_switcher import MOBILE_CLIP_SIZE as model_size
+    return get_model(f"mobileclip-{model_size}")
 
 
 def classify_image(image_path: str, confidence_threshold: float = 0.15, max_tags: int = 1,
@@ -326,7 +314,8 @@ def classify_image(image_path: str, confidence_threshold: float = 0.15, max_tags
     return tags
 
 
-def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1):
+def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1,
+                   scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
     """
     Convenience function to classify multiple images.
     Same API as clip_model.classify_batch()
@@ -335,7 +324,8 @@ def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_ta
         List of tag lists: [["people"], ["scenery"], ["food"], ...]
     """
     classifier = get_mobile_clip_model()
-    results = classifier.classify_batch(image_paths, confidence_threshold, max_tags)
+    results = classifier.classify_batch(image_paths, confidence_threshold, max_tags, scores_out=scores_out,
+                                        embeddings_out=embeddings_out, hashes_out=hashes_out)
     cleaned_results = []
     
     for img_results in results:
@@ -345,3 +335,26 @@ def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_ta
         cleaned_results.append(tags)
     
     return cleaned_results
+
+
+def classify_batch_with_scores(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1):
+    """
+    Like classify_batch(), but also returns each image's raw category probabilities
+    (float32 vector in CATEGORY_NAMES order, None if the image couldn't be read).
+    
+    Returns:
+        Tuple of (tag lists, probability vectors)
+    """
+    scores = []
+    tags = classify_batch(image_paths, confidence_threshold, max_tags, scores_out=scores)
+    return tags, scores
+
+
+def embed_images(images: list) -> np.ndarray:
+    """L2-normalized image embeddings (float32[N, D]) for PIL images or paths."""
+    return get_mobile_clip_model().embed_images(images)
+
+
+def score_embeddings(embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+    """Softmax probabilities (float32[N, P]) of embeddings against a prompt set."""
+    return get_mobile_clip_model().score_embeddings(embeddings, prompt_set)
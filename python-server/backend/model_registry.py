@@ -0,0 +1,301 @@
+"""
+Named models loaded on demand, shared across callers, under a RAM budget.
+
+Every model the server can run (CLIP classifiers, their ONNX variants, the
+YOLO detectors) is registered here by name with a loader. `get_model(name)`
+loads it on first use and returns the same instance to every caller after
+that; the per-module getters (clip_model.get_clip_model(), ...) go through it.
+
+Memory:
+- each loaded model's footprint is measured (torch parameters and buffers, the
+  ONNX file size, or the process RSS growth while loading)
+- when the total passes MODEL_MEMORY_BUDGET_MB, least recently used models are
+  unloaded until it fits again; the model just requested is never evicted
+- a background sweeper unloads models unused for MODEL_IDLE_SECONDS
+
+Unloading only drops the registry's reference: a caller still holding the
+instance finishes its request normally and the memory is released when it
+lets go. The next `get_model()` loads a fresh copy.
+"""
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ('model', 'size_mb', 'loaded_at', 'last_used', 'load_ms')
+
+    def __init__(self, model: Any, size_mb: float, load_ms: float):
+        self.model = model
+        self.size_mb = size_mb
+        self.loaded_at = self.last_used = time.time()
+        self.load_ms = load_ms
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _footprint_mb(model: Any) -> Optional[float]:
+    """Weights held by a loaded model, when they can be counted directly."""
+    declared = getattr(model, 'footprint_mb', None)
+    if isinstance(declared, (int, float)):
+        return float(declared)
+    module = getattr(model, 'model', None)
+    if hasattr(module, 'parameters') and hasattr(module, 'buffers'):
+        try:
+            tensors = list(module.parameters()) + list(module.buffers())
+            return sum(t.numel() * t.element_size() for t in tensors) / 2 ** 20
+        except Exception:
+            pass
+    path = getattr(model, 'model_path', None)
+    if isinstance(path, str) and os.path.exists(path):
+        return os.path.getsize(path) / 2 ** 20
+    return None
+
+
+def _release_memory() -> None:
+    gc.collect()
+    try:
+        import sys
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+    try:
+        # Hand freed heap pages back to the OS (glibc only)
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except Exception:
+        pass
+
+
+class ModelRegistry:
+    """LRU cache of named models with a memory budget and idle expiry."""
+
+    def __init__(self, budget_mb: float = 0, idle_seconds: float = 0):
+        """
+        Args:
+            budget_mb: Total MB of loaded models to stay under (0 = unlimited).
+            idle_seconds: Unload models unused this long (0 = never).
+        """
+        self.budget_mb = budget_mb
+        self.idle_seconds = idle_seconds
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._kinds: Dict[str, str] = {}
+        self._sizes: Dict[str, Optional[float]] = {}
+        self._loaded: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._sweeper: Optional[threading.Thread] = None
+        self.loads = 0
+        self.evictions = 0
+
+    def register(self, name: str, loader: Callable[[], Any], kind: str = 'model',
+                 size_mb: Optional[float] = None) -> None:
+        """Make `name` loadable.
+
+        Args:
+            name: Registry name, e.g. "mobileclip-s2".
+            loader: Builds the model (called without arguments, at most once per load).
+            kind: Free-form group such as "classifier" or "detector".
+            size_mb: Expected footprint, used only if it cannot be measured.
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._kinds[name] = kind
+            self._sizes[name] = size_mb
+            self._load_locks.setdefault(name, threading.Lock())
+
+    def names(self, kind: Optional[str] = None) -> List[str]:
+        return [name for name in self._loaders if kind is None or self._kinds[name] == kind]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._loaded
+
+    def get(self, name: str) -> Any:
+        """Return the shared instance of `name`, loading it if needed."""
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is not None:
+                entry.last_used = time.time()
+                self._loaded.move_to_end(name)
+                return entry.model
+            if name not in self._loaders:
+                raise KeyError(f"Unknown model '{name}' (known: {', '.join(self._loaders)})")
+            load_lock = self._load_locks[name]
+        # Loads can take seconds: serialize per name, not registry-wide
+        with load_lock:
+            with self._lock:
+                entry = self._loaded.get(name)
+                if entry is not None:
+                    entry.last_used = time.time()
+                    return entry.model
+            rss_before = _rss_mb()
+            t0 = time.time()
+            model = self._loaders[name]()
+            load_ms = (time.time() - t0) * 1000
+            size_mb = _footprint_mb(model)
+            if size_mb is None:
+                rss_after = _rss_mb()
+                size_mb = (rss_after - rss_before if rss_before is not None and rss_after is not None
+                           else self._sizes.get(name) or 0.0)
+            with self._lock:
+                self._loaded[name] = _Entry(model, max(0.0, size_mb), load_ms)
+                self.loads += 1
+                evicted = self._evict_over_budget(keep=name)
+            logger.info(f"Loaded model '{name}' ({size_mb:.0f} MB) in {load_ms:.0f} ms")
+        if evicted:
+            _release_memory()
+        self._start_sweeper()
+        return model
+
+    def _evict_over_budget(self, keep: str) -> List[str]:
+        if self.budget_mb <= 0:
+            return []
+        evicted = []
+        while self.total_mb() > self.budget_mb:
+            victim = next((n for n in self._loaded if n != keep), None)
+            if victim is None:
+                logger.warning(f"Model '{keep}' alone exceeds MODEL_MEMORY_BUDGET_MB={self.budget_mb}")
+                break
+            del self._loaded[victim]
+            self.evictions += 1
+            evicted.append(victim)
+            logger.info(f"Evicted model '{victim}' (memory budget {self.budget_mb} MB)")
+        return evicted
+
+    def total_mb(self) -> float:
+        return sum(entry.size_mb for entry in self._loaded.values())
+
+    def unload(self, name: str) -> bool:
+        """Drop `name` from memory (it is reloaded on next use)."""
+        with self._lock:
+            entry = self._loaded.pop(name, None)
+        if entry is None:
+            return False
+        del entry
+        _release_memory()
+        logger.info(f"Unloaded model '{name}'")
+        return True
+
+    def evict_idle(self, now: Optional[float] = None) -> List[str]:
+        """Unload every model unused for `idle_seconds`."""
+        if self.idle_seconds <= 0:
+            return []
+        now = time.time() if now is None else now
+        with self._lock:
+            idle = [name for name, entry in self._loaded.items() if now - entry.last_used >= self.idle_seconds]
+            for name in idle:
+                del self._loaded[name]
+                self.evictions += 1
+        if idle:
+            _release_memory()
+            logger.info(f"Unloaded idle models: {idle}")
+        return idle
+
+    def _start_sweeper(self) -> None:
+        if self.idle_seconds <= 0 or self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep, name='model-registry-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def _sweep(self) -> None:
+        while True:
+            time.sleep(max(1.0, min(60.0, self.idle_seconds / 4)))
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception('Idle model sweep failed')
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            loaded = {
+                name: {
+                    'kind': self._kinds[name],
+                    'size_mb': round(entry.size_mb, 1),
+                    'load_ms': round(entry.load_ms),
+                    'idle_seconds': round(now - entry.last_used, 1),
+                }
+                for name, entry in self._loaded.items()
+            }
+        return {
+            'loaded': loaded,
+            'available': {name: self._kinds[name] for name in self._loaders},
+            'total_mb': round(sum(m['size_mb'] for m in loaded.values()), 1),
+            'budget_mb': self.budget_mb,
+            'idle_seconds': self.idle_seconds,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
+
+
+def _register_builtin_models(registry: ModelRegistry) -> None:
+    def clip():
+        from .clip_model import CLIPPhotoClassifier
+        return CLIPPhotoClassifier()
+
+    def mobileclip(size):
+        def load():
+            from .mobile_clip_model import MobileCLIPPhotoClassifier
+            return MobileCLIPPhotoClassifier(model_size=size)
+        return load
+
+    def onnx(backend):
+        def load():
+            from .onnx_mobile_clip_model import OnnxMobileCLIPPhotoClassifier, variant_path
+            return OnnxMobileCLIPPhotoClassifier(model_path=variant_path(_cfg.ONNX_MODEL_PATH, backend))
+        return load
+
+    def cascade():
+        from .cascade_classifier import CascadeClassifier
+        return CascadeClassifier()
+
+    def yolo(weights):
+        def load():
+            from ultralytics import YOLO
+            return YOLO(weights)
+        return load
+
+    registry.register('clip', clip, 'classifier', size_mb=600)
+    for size, size_mb in (('s0', 45), ('s1', 85), ('s2', 140)):
+        registry.register(f'mobileclip-{size}', mobileclip(size), 'classifier', size_mb=size_mb)
+    for backend in ('onnx', 'onnx-int8', 'onnx-int8-dynamic'):
+        registry.register(backend, onnx(backend), 'classifier', size_mb=45)
+    registry.register('cascade', cascade, 'classifier', size_mb=0)
+    registry.register('yolov8n', yolo('yolov8n.pt'), 'detector', size_mb=15)
+    registry.register('yolov8x', yolo('yolov8x.pt'), 'detector', size_mb=280)
+
+
+registry = ModelRegistry(_cfg.MODEL_MEMORY_BUDGET_MB, _cfg.MODEL_IDLE_SECONDS)
+_register_builtin_models(registry)
+
+
+def get_model(name: str) -> Any:
+    """Shared instance of the registered model `name` (loaded on demand)."""
+    return registry.get(name)
+
+
+def unload(name: str) -> bool:
+    return registry.unload(name)
+
+
+def stats() -> Dict[str, Any]:
+    return registry.stats()
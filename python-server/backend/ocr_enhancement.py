@@ -7,6 +7,8 @@ from typing import List, Tuple, Optional
 import numpy as np
 from PIL import Image
 
+from .image_context import ImageContext
+
 logger = logging.getLogger(__name__)
 
 # Lazy load EasyOCR (only when needed)
@@ -77,12 +79,12 @@ APP_PATTERNS = {
 }
 
 
-def extract_text_from_image(image_path: str) -> List[str]:
+def extract_text_from_image(image_path) -> List[str]:
     """
     Extract text from image using OCR.
     
     Args:
-        image_path: Path to image file
+        image_path: Path to image file, or an ImageContext (its decoded pixels are reused)
         
     Returns:
         List of detected text strings (lowercase)
@@ -92,8 +94,8 @@ def extract_text_from_image(image_path: str) -> List[str]:
         return []
     
     try:
-        # Run OCR
-        results = reader.readtext(image_path)
+        # Run OCR (EasyOCR takes an RGB array as it would have loaded the file)
+        results = reader.readtext(image_path.rgb if isinstance(image_path, ImageContext) else image_path)
         
         # Extract text and convert to lowercase
         detected_texts = [text.lower() for (bbox, text, conf) in results if conf > 0.3]
@@ -138,12 +140,12 @@ def detect_game_or_app(detected_texts: List[str]) -> Optional[str]:
     return None
 
 
-def enhance_screenshot_tag(image_path: str, base_tag: str) -> Tuple[str, Optional[str]]:
+def enhance_screenshot_tag(image_path, base_tag: str) -> Tuple[str, Optional[str]]:
     """
     Enhance screenshot classification with OCR detection.
     
     Args:
-        image_path: Path to image
+        image_path: Path to image, or its ImageContext
         base_tag: Base tag from CLIP (e.g., "gaming", "social-media")
         
     Returns:
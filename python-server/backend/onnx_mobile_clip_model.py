@@ -0,0 +1,334 @@
+"""
+ONNX Runtime serving backend for MobileCLIP (no PyTorch at runtime).
+
+Runs the same files the Flutter app ships, so server and on-device tags agree:
+- `onnx_models/mobileclip_image_encoder_256.onnx`: MobileCLIP-S0 image tower
+  with L2-normalized output (see export_mobileclip_onnx.py)
+- `onnx_models/category_embeddings.npy`: the 6 precomputed, normalized
+  category text embeddings
+
+Preprocessing mirrors lib/services/semantic_tag_service.dart: stretch to the
+model's input size with nearest-neighbour sampling (the `img.copyResize`
+default), RGB scaled to [0, 1], NCHW, no mean/std normalization.
+
+Same classify_image / classify_batch contract as mobile_clip_model.py; the
+sixth category ("a photo of an object or thing") acts as the "other" label.
+Batches run in chunks of ONNX_BATCH_SIZE when the graph has a dynamic batch
+dimension, and one image per run when it was exported with a fixed batch of 1.
+
+INT8 variants made by quantize_onnx_model.py sit next to the fp32 file
+(`<name>.int8.onnx`, `<name>.int8-dynamic.onnx`) and are selected with
+CLIP_BACKEND=onnx-int8 / onnx-int8-dynamic.
+"""
+import hashlib
+import logging
+import os
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from . import config as _cfg
+from .category_tags import match_expected, select_tags
+from .image_context import ImageContext, load_rgb
+from .image_hash import hash_image
+from .text_embedding_cache import softmax_scores
+
+logger = logging.getLogger(__name__)
+
+try:
+    import onnxruntime as ort
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+    logger.warning("onnxruntime not installed. Run: pip install onnxruntime")
+
+# Prompts behind onnx_models/category_embeddings.npy (export_mobileclip_onnx.py), same order
+PHOTO_CATEGORIES = [
+    "a photo of a person or people",
+    "a photo of an animal or pet",
+    "a photo of food or a meal",
+    "a photo of scenery or landscape",
+    "a photo of a document or text",
+    "a photo of an object or thing",
+]
+
+CATEGORY_NAMES = ["people", "animals", "food", "scenery", "document", "other"]
+
+# Same thresholds as mobile_clip_model.py; "other" never passes, it is the fallback
+CATEGORY_THRESHOLDS = {
+    "food": 0.80,
+    "document": 0.70,
+    "animals": 0.70,
+    "people": 0.80,
+    "scenery": 0.70,
+    "other": float("inf"),
+}
+
+# img.copyResize in the app samples nearest-neighbour by default
+_RESIZE_FILTER = Image.NEAREST
+_DEFAULT_INPUT_SIZE = 256
+
+# CLIP_BACKEND value -> suffix of the model file next to ONNX_MODEL_PATH
+ONNX_VARIANTS = {
+    "onnx": "",
+    "onnx-int8": ".int8",
+    "onnx-int8-dynamic": ".int8-dynamic",
+}
+
+_GRAPH_OPTIMIZATION = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def variant_path(model_path: str, backend: str) -> str:
+    """Model file for a CLIP_BACKEND value, e.g. encoder.onnx -> encoder.int8.onnx."""
+    base, ext = os.path.splitext(model_path)
+    return base + ONNX_VARIANTS.get(backend, "") + ext
+
+
+def preprocess_image(image: Image.Image, size: int) -> np.ndarray:
+    """float32[3, size, size] in [0, 1], exactly as the app builds its input tensor."""
+    resized = image.convert("RGB").resize((size, size), _RESIZE_FILTER)
+    return (np.asarray(resized, dtype=np.float32) / 255.0).transpose(2, 0, 1)
+
+
+class OnnxMobileCLIPPhotoClassifier:
+    """MobileCLIP image tower on ONNX Runtime, scored against precomputed category embeddings."""
+
+    def __init__(self, model_path: str = None, embeddings_path: str = None):
+        """
+        Create the inference session.
+
+        Args:
+            model_path: Image encoder .onnx (default: the CLIP_BACKEND variant of ONNX_MODEL_PATH)
+            embeddings_path: Category embeddings .npy (default ONNX_CATEGORY_EMBEDDINGS)
+        """
+        if not ONNXRUNTIME_AVAILABLE:
+            raise ImportError("onnxruntime is required. Run: pip install onnxruntime")
+
+        self.model_path = model_path or variant_path(_cfg.ONNX_MODEL_PATH, _cfg.CLIP_BACKEND)
+        if not os.path.exists(self.model_path):
+            raise FileNotFoundError(f"{self.model_path} not found (INT8 variants are made by quantize_onnx_model.py)")
+        embeddings_path = embeddings_path or _cfg.ONNX_CATEGORY_EMBEDDINGS
+
+        options = ort.SessionOptions()
+        level = _GRAPH_OPTIMIZATION.get(_cfg.ONNX_GRAPH_OPTIMIZATION, "ORT_ENABLE_ALL")
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, level)
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if _cfg.ONNX_INTRA_OP_THREADS > 0:
+            options.intra_op_num_threads = _cfg.ONNX_INTRA_OP_THREADS
+        if _cfg.ONNX_INTER_OP_THREADS > 0:
+            options.inter_op_num_threads = _cfg.ONNX_INTER_OP_THREADS
+        if _cfg.ONNX_OPTIMIZED_MODEL_PATH:
+            # Save the optimized graph so it can be served directly next time
+            options.optimized_model_filepath = _cfg.ONNX_OPTIMIZED_MODEL_PATH
+
+        logger.info(f"Loading ONNX MobileCLIP encoder: {self.model_path} (optimization={level})")
+        self.session = ort.InferenceSession(self.model_path, sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        shape = model_input.shape
+        self.input_size = shape[2] if isinstance(shape[2], int) else _DEFAULT_INPUT_SIZE
+        self.dynamic_batch = not isinstance(shape[0], int) or shape[0] != 1
+
+        self.categories = PHOTO_CATEGORIES
+        self.text_features = np.ascontiguousarray(np.load(embeddings_path), dtype=np.float32)
+        self.text_features /= np.linalg.norm(self.text_features, axis=1, keepdims=True)
+        if len(self.text_features) != len(CATEGORY_NAMES):
+            raise ValueError(f"{embeddings_path} has {len(self.text_features)} categories, "
+                             f"expected {len(CATEGORY_NAMES)}")
+        self.embedding_dim = self.text_features.shape[1]
+        self.model_id = f"onnx:{os.path.basename(self.model_path)}@{_file_digest(self.model_path)}"
+        self.model_name = self.model_id
+
+        logger.info(f"ONNX MobileCLIP ready: input {self.input_size}px, "
+                    f"{'dynamic' if self.dynamic_batch else 'fixed (1)'} batch, "
+                    f"threads intra={options.intra_op_num_threads} inter={options.inter_op_num_threads}")
+
+    def preprocess(self, image) -> np.ndarray:
+        """Input tensor for a PIL image, path or ImageContext (cached on the context)."""
+        if isinstance(image, ImageContext):
+            return image.view(("onnx", self.input_size), self.preprocess)
+        return preprocess_image(load_rgb(image), self.input_size)
+
+    def get_text_features(self, prompts: list) -> np.ndarray:
+        """Only the shipped category prompts have embeddings (there is no text tower)."""
+        if list(prompts) != self.categories:
+            raise NotImplementedError("The ONNX backend has no text encoder; only its category prompts are available")
+        return self.text_features
+
+    def embed_text(self, prompts: list) -> np.ndarray:
+        raise NotImplementedError("The ONNX backend has no text encoder")
+
+    def embed_images(self, images: list) -> np.ndarray:
+        """
+        Run only the image tower.
+        Same API as CLIPPhotoClassifier.embed_images()
+
+        Args:
+            images: PIL images, image file paths or ImageContexts
+
+        Returns:
+            float32[N, D] L2-normalized image embeddings
+        """
+        out = np.zeros((len(images), self.embedding_dim), dtype=np.float32)
+        step = max(1, _cfg.ONNX_BATCH_SIZE) if self.dynamic_batch else 1
+        for start in range(0, len(images), step):
+            batch = np.stack([self.preprocess(im) for im in images[start:start + step]])
+            out[start:start + len(batch)] = self.session.run(None, {self.input_name: batch})[0]
+        # The exported graph already normalizes; renormalize against float drift
+        out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out
+
+    def score_embeddings(self, embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+        """
+        Score image embeddings against the category embeddings (no image tower).
+
+        Returns:
+            float32[N, P] softmax(100 * cosine similarity) probabilities
+        """
+        text = self.text_features if prompt_set is None else self.get_text_features(prompt_set)
+        return softmax_scores(embeddings, text, 100.0)
+
+    def _tags(self, probs: np.ndarray, max_tags: int) -> List[List[tuple]]:
+        return select_tags(probs, CATEGORY_NAMES, CATEGORY_THRESHOLDS, max_tags, "other")
+
+    def classify_image(self, image_path: str, confidence_threshold: float = 0.15, max_tags: int = 5,
+                       expected_tags: list = None):
+        """
+        Classify image and return relevant tags.
+        Same API as CLIPPhotoClassifier.classify_image()
+
+        Returns:
+            List of tuples: [(tag, confidence), ...]
+        """
+        try:
+            probs = self.score_embeddings(self.embed_images([image_path]))
+            if expected_tags:
+                match = match_expected(probs[0], CATEGORY_NAMES, expected_tags, max_tags, "other")
+                if match:
+                    logger.info(f"Found expected tags {expected_tags} at threshold {match[0]}: {match[1]}")
+                    return match[1]
+                logger.warning(f"Expected tags {expected_tags} not found even at threshold 0.20")
+            results = self._tags(probs, max_tags)[0]
+            logger.info(f"Classified {image_path}: {[tag for tag, _ in results]}")
+            return results
+        except Exception as e:
+            logger.error(f"Error classifying {image_path}: {e}")
+            return []
+
+    def classify_batch(self, image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 5,
+                       scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
+        """
+        Classify multiple images in batch.
+        Same API (and output hooks) as MobileCLIPPhotoClassifier.classify_batch()
+
+        Returns:
+            List of results, one per image: [[(tag, conf), ...], ...]
+        """
+        for out in (scores_out, embeddings_out, hashes_out):
+            if out is not None:
+                out.extend([None] * len(image_paths))
+        base = {id(out): len(out) - len(image_paths) for out in (scores_out, embeddings_out, hashes_out)
+                if out is not None}
+        try:
+            images, valid_indices = [], []
+            for path_idx, path in enumerate(image_paths):
+                try:
+                    images.append(load_rgb(path))
+                    valid_indices.append(path_idx)
+                except Exception as e:
+                    logger.warning(f"Failed to load {path}: {e}")
+            if not images:
+                return [[] for _ in image_paths]
+
+            # Contexts keep their preprocessed tensor for later passes over the same upload
+            embeddings = self.embed_images([image_paths[i] if isinstance(image_paths[i], ImageContext) else img
+                                            for img, i in zip(images, valid_indices)])
+            probs = self.score_embeddings(embeddings)
+            for out, rows in ((scores_out, probs), (embeddings_out, embeddings)):
+                if out is not None:
+                    for row, path_idx in zip(rows, valid_indices):
+                        out[base[id(out)] + path_idx] = row
+            if hashes_out is not None:
+                for img, path_idx in zip(images, valid_indices):
+                    hashes_out[base[id(hashes_out)] + path_idx] = hash_image(img)
+
+            batch_results = [[] for _ in image_paths]
+            for path_idx, results in zip(valid_indices, self._tags(probs, max_tags)):
+                batch_results[path_idx] = results
+            return batch_results
+        except Exception as e:
+            logger.error(f"Error in batch classification: {e}")
+            return [[] for _ in image_paths]
+
+    def get_tags_only(self, image_path: str, confidence_threshold: float = 0.15, max_tags: int = 5):
+        results = self.classify_image(image_path, confidence_threshold, max_tags)
+        return [tag for tag, _ in results]
+
+
+def get_onnx_mobile_clip_model():
+    """Get the shared ONNX MobileCLIP classifier for CLIP_BACKEND (loaded by model_registry)."""
+    from .model_registry import get_model
+    return get_model(_cfg.CLIP_BACKEND if _cfg.CLIP_BACKEND in ONNX_VARIANTS else "onnx")
+
+
+def classify_image(image_path: str, confidence_threshold: float = 0.15, max_tags: int = 1,
+                   expected_tags: list = None):
+    """
+    Convenience function to classify a single image.
+    Same API as mobile_clip_model.classify_image()
+    """
+    results = get_onnx_mobile_clip_model().classify_image(image_path, confidence_threshold, max_tags, expected_tags)
+    tags = [tag for tag, _ in results]
+    if len(tags) > 1 and "other" in tags:
+        tags = [t for t in tags if t != "other"]
+    return tags
+
+
+def classify_batch(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1,
+                   scores_out: list = None, embeddings_out: list = None, hashes_out: list = None):
+    """
+    Convenience function to classify multiple images.
+    Same API as mobile_clip_model.classify_batch()
+    """
+    results = get_onnx_mobile_clip_model().classify_batch(image_paths, confidence_threshold, max_tags,
+                                                          scores_out=scores_out, embeddings_out=embeddings_out,
+                                                          hashes_out=hashes_out)
+    cleaned_results = []
+    for img_results in results:
+        tags = [tag for tag, _ in img_results]
+        if len(tags) > 1 and "other" in tags:
+            tags = [t for t in tags if t != "other"]
+        cleaned_results.append(tags)
+    return cleaned_results
+
+
+def classify_batch_with_scores(image_paths: list, confidence_threshold: float = 0.15, max_tags: int = 1):
+    """Like classify_batch(), but also returns each image's raw category probabilities."""
+    scores = []
+    tags = classify_batch(image_paths, confidence_threshold, max_tags, scores_out=scores)
+    return tags, scores
+
+
+def embed_images(images: list) -> np.ndarray:
+    """L2-normalized image embeddings (float32[N, D]) for PIL images or paths."""
+    return get_onnx_mobile_clip_model().embed_images(images)
+
+
+def score_embeddings(embeddings: np.ndarray, prompt_set: list = None) -> np.ndarray:
+    """Softmax probabilities (float32[N, P]) of embeddings against the category embeddings."""
+    return get_onnx_mobile_clip_model().score_embeddings(embeddings, prompt_set)
@@ -0,0 +1,341 @@
+"""
+Online grouping of near-identical shots (bursts, retakes) for "Cleanup →
+similar photos".
+
+Two photos are linked when they were captured within SIMILAR_TIME_WINDOW_SECONDS
+of each other and their image embeddings (embedding_store.py) have cosine
+similarity >= SIMILAR_MIN_SIMILARITY; groups are the connected components.
+
+Each insert is incremental instead of re-clustering the library:
+- the timeline is bucketed by window-sized time slots, so the photos inside
+  the window are in the new photo's slot and its two neighbours, and an insert
+  is an O(1) append (a sorted list would shift O(n) entries per insert)
+- at most SIMILAR_MAX_NEIGHBORS of them (closest in time) are compared against
+  the new embedding, read from the memory-mapped embedding store
+- links are recorded in a union-find with path compression, so a photo that
+  arrives out of order and bridges two groups simply merges them
+
+Photos without a capture time are never grouped. A re-classified photo keeps
+its existing links (union-find cannot split groups); its embedding still
+counts for later photos.
+
+Per tenant the state is a small `.npz` next to the tags DB (photo IDs, capture
+times, union-find parents).
+"""
+import logging
+import math
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+_EXIF_IFD = 0x8769
+_EXIF_DATETIME_ORIGINAL = 36867
+_EXIF_DATETIME = 306
+
+
+def parse_capture_time(value: Any) -> Optional[float]:
+    """Seconds since the epoch from a client value.
+
+    Accepts epoch seconds or milliseconds (numbers above 1e11 are taken as ms)
+    and ISO-8601 strings; naive timestamps are treated as UTC.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+        return seconds / 1000.0 if seconds > 1e11 else seconds
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def exif_capture_time(path: str) -> Optional[float]:
+    """DateTimeOriginal (or DateTime) from the file's EXIF header, without decoding pixels.
+
+    EXIF times carry no zone and are read as UTC; only differences between
+    shots from the same camera matter here.
+    """
+    try:
+        from PIL import Image
+        with Image.open(path) as img:
+            exif = img.getexif()
+            value = exif.get_ifd(_EXIF_IFD).get(_EXIF_DATETIME_ORIGINAL) or exif.get(_EXIF_DATETIME)
+        if not value:
+            return None
+        dt = datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+        return dt.replace(tzinfo=timezone.utc).timestamp()
+    except Exception:
+        return None
+
+
+class PhotoClusters:
+    """Union-find over photos linked by capture-time proximity and embedding similarity."""
+
+    def __init__(self, path: str, window_seconds: float, min_similarity: float, max_neighbors: int,
+                 flush_interval: float = 30.0):
+        self.path = path
+        self.window_seconds = window_seconds
+        self.min_similarity = min_similarity
+        self.max_neighbors = max_neighbors
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._ids: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._times: List[float] = []
+        self._parent: List[int] = []
+        # Time slot (capture time // window) -> [(capture time, row), ...]
+        self._timeline: Dict[int, List[Tuple[float, int]]] = {}
+        self._slot_seconds = window_seconds if window_seconds > 0 else 1.0
+        self._dirty = False
+        self._last_save = time.time()
+        # Set while out of the open-store cache: writes then flush immediately
+        self.evicted = False
+        self._load()
+
+    # --- persistence ---
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self._ids = [str(x) for x in data['photo_ids']]
+                self._times = data['times'].astype(np.float64).tolist()
+                self._parent = data['parent'].astype(np.int64).tolist()
+            self._index = {pid: i for i, pid in enumerate(self._ids)}
+            self._timeline = {}
+            for row, captured in enumerate(self._times):
+                if not math.isnan(captured):
+                    self._place(row, captured)
+            logger.info(f"Loaded similar-photo links for {len(self._ids)} photos from {self.path}")
+        except Exception:
+            logger.exception(f"Failed to read {self.path}; starting empty")
+
+    def flush(self) -> bool:
+        """Write the state to disk if it changed (atomic replace)."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                np.savez(tmp, photo_ids=np.array(self._ids, dtype=str),
+                         times=np.array(self._times, dtype=np.float64),
+                         parent=np.array(self._parent, dtype=np.int64))
+                os.replace(tmp, self.path)
+            except Exception:
+                logger.exception(f"Failed to write {self.path}")
+                return False
+            self._dirty = False
+            self._last_save = time.time()
+            return True
+
+    # --- union-find ---
+
+    def _find(self, row: int) -> int:
+        parent = self._parent
+        root = row
+        while parent[root] != root:
+            root = parent[root]
+        while parent[row] != root:
+            parent[row], row = root, parent[row]
+        return root
+
+    def _union(self, a: int, b: int) -> None:
+        ra, rb = self._find(a), self._find(b)
+        if ra != rb:
+            # Lower row wins so roots are stable across reloads
+            self._parent[max(ra, rb)] = min(ra, rb)
+
+    # --- writes ---
+
+    def add_many(self, records: Dict[str, Tuple[np.ndarray, Optional[float]]],
+                 lookup: Callable[[str], Optional[np.ndarray]]) -> int:
+        """Place newly embedded photos into groups.
+
+        Args:
+            records: photoID -> (normalized embedding, capture time in epoch
+                seconds or None).
+            lookup: Returns the stored embedding of an existing photoID.
+
+        Returns:
+            Number of new links made.
+        """
+        links = 0
+        with self._lock:
+            # Oldest first, so a burst uploaded in one batch chains in order
+            for photo_id, (embedding, captured) in sorted(
+                    records.items(), key=lambda item: item[1][1] if item[1][1] is not None else math.inf):
+                row = self._index.get(photo_id)
+                if row is None:
+                    row = len(self._ids)
+                    self._ids.append(photo_id)
+                    self._index[photo_id] = row
+                    self._times.append(math.nan)
+                    self._parent.append(row)
+                if captured is None:
+                    continue
+                links += self._link(row, np.asarray(embedding, dtype=np.float32), captured, lookup)
+                if math.isnan(self._times[row]):
+                    self._times[row] = captured
+                    self._place(row, captured)
+            self._dirty = True
+            due = self.evicted or time.time() - self._last_save >= self.flush_interval
+        if due:
+            self.flush()
+        return links
+
+    def _slot(self, captured: float) -> int:
+        return math.floor(captured / self._slot_seconds)
+
+    def _place(self, row: int, captured: float) -> None:
+        self._timeline.setdefault(self._slot(captured), []).append((captured, row))
+
+    def _link(self, row: int, embedding: np.ndarray, captured: float,
+              lookup: Callable[[str], Optional[np.ndarray]]) -> int:
+        slot = self._slot(captured)
+        window = [(abs(t - captured), other)
+                  for s in (slot - 1, slot, slot + 1) for t, other in self._timeline.get(s, ())
+                  if other != row and abs(t - captured) <= self.window_seconds]
+        if not window:
+            return 0
+        if len(window) > self.max_neighbors:
+            window.sort()
+            window = window[:self.max_neighbors]
+        neighbors, vectors = [], []
+        for _, other in window:
+            vector = lookup(self._ids[other])
+            if vector is not None:
+                neighbors.append(other)
+                vectors.append(vector)
+        if not neighbors:
+            return 0
+        similarity = np.stack(vectors).astype(np.float32) @ embedding
+        links = 0
+        for other, sim in zip(neighbors, similarity):
+            if sim >= self.min_similarity:
+                self._union(row, other)
+                links += 1
+        return links
+
+    # --- reads ---
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def groups(self, min_size: int = 2) -> List[Dict[str, Any]]:
+        """Groups of at least `min_size` photos, largest first; members in capture order."""
+        with self._lock:
+            members: Dict[int, List[int]] = {}
+            for row in range(len(self._ids)):
+                members.setdefault(self._find(row), []).append(row)
+            out = []
+            for rows in members.values():
+                if len(rows) < min_size:
+                    continue
+                rows.sort(key=lambda r: self._times[r])
+                out.append({
+                    'photoIDs': [self._ids[r] for r in rows],
+                    'start': self._times[rows[0]],
+                    'end': self._times[rows[-1]],
+                })
+        out.sort(key=lambda g: (-len(g['photoIDs']), g['start']))
+        return out
+
+
+_clusters: 'OrderedDict[str, PhotoClusters]' = OrderedDict()
+_clusters_lock = threading.Lock()
+# Every instance still referenced anywhere, open or evicted
+_held: 'weakref.WeakValueDictionary' = weakref.WeakValueDictionary()
+
+
+def clusters_path_for(tags_path: str) -> str:
+    """Similar-photo state file that sits next to a tags DB file (or SQLite DB)."""
+    return os.path.splitext(tags_path)[0] + '.clusters.npz'
+
+
+def get_clusters(tenant: Optional[str] = None) -> PhotoClusters:
+    """Return the similar-photo groups paired with `tenant`'s tags DB shard."""
+    from . import tags_db
+
+    path = clusters_path_for(tags_db.get_store(tenant).path)
+    with _clusters_lock:
+        clusters = _clusters.get(path)
+        if clusters is None:
+            # Reuse evicted groups a request still holds instead of loading a second copy
+            clusters = _held.get(path)
+            if clusters is None:
+                clusters = _held[path] = PhotoClusters(
+                    path, _cfg.SIMILAR_TIME_WINDOW_SECONDS, _cfg.SIMILAR_MIN_SIMILARITY,
+                    _cfg.SIMILAR_MAX_NEIGHBORS, _cfg.SCORE_STORE_FLUSH_INTERVAL)
+            clusters.evicted = False
+            _clusters[path] = clusters
+        _clusters.move_to_end(path)
+        evicted = []
+        while len(_clusters) > max(1, _cfg.TAGS_DB_MAX_OPEN_SHARDS):
+            old = _clusters.popitem(last=False)[1]
+            old.evicted = True
+            evicted.append(old)
+    for old in evicted:
+        old.flush()
+    return clusters
+
+
+def record_photos(embeddings: Dict[str, np.ndarray], capture_times: Dict[str, Optional[float]],
+                  tenant: Optional[str] = None, classifier_name: Optional[str] = None) -> None:
+    """Best-effort: add a batch of embedded photos to the similar-photo groups.
+
+    Must run after embedding_store.record_embeddings for the same batch, since
+    neighbours' embeddings are read back from the store. Groups are built from
+    the deployed classifier's embeddings only; batches classified by another
+    one are skipped.
+    """
+    if not _cfg.SIMILAR_GROUPS_ENABLED or not embeddings:
+        return
+    try:
+        from .clip_switcher import DEFAULT_CLASSIFIER, get_classifier
+        from .embedding_store import get_embedding_store
+
+        if (classifier_name or DEFAULT_CLASSIFIER) != DEFAULT_CLASSIFIER:
+            return
+        clf = get_classifier(classifier_name)
+        store = get_embedding_store(clf.embedding_dim, clf.model_id, tenant)
+        records = {pid: (emb, capture_times.get(pid)) for pid, emb in embeddings.items()}
+        get_clusters(tenant).add_many(records, store.get)
+    except Exception:
+        logger.exception('Failed to update similar-photo groups')
+
+
+def similar_groups(tenant: Optional[str] = None, min_size: int = 2, limit: Optional[int] = None) -> Dict[str, Any]:
+    t0 = time.time()
+    clusters = get_clusters(tenant)
+    groups = clusters.groups(max(2, min_size))
+    return {
+        'groups': groups[:limit] if limit else groups,
+        'total_groups': len(groups),
+        'photos': len(clusters),
+        'window_seconds': clusters.window_seconds,
+        'min_similarity': clusters.min_similarity,
+        'elapsed_ms': round((time.time() - t0) * 1000, 1),
+    }
+
+
+def flush() -> None:
+    with _clusters_lock:
+        clusters = list(_held.values())
+    for c in clusters:
+        c.flush()
@@ -0,0 +1,247 @@
+"""
+Composite version of the tagging pipeline.
+
+Tags in `tags_db` depend on more than "the model": the classifier backend,
+the prompt set, the per-category thresholds, the tag suppression rules and
+(in hybrid mode) the YOLO class mapping all change what a photo gets tagged. Each of those is hashed
+separately, and the short composite id is stamped on every entry as
+`model_version`. The full description behind each id is kept in
+`pipeline_versions.json`, so an old entry's version can later be compared
+component by component with the current one.
+
+`impact(old_version)` turns that comparison into "which entries need
+re-tagging":
+- classifier or prompt changes (softmax couples all categories) -> all
+- suppression rule changes (category_tags) -> all
+- a threshold raised / YOLO mapping narrowed for category C -> only entries
+  tagged C can lose it
+- a threshold lowered / mapping widened -> any photo could gain C -> all
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from . import category_tags
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_VERSIONS_PATH = os.path.join(os.path.dirname(__file__), 'pipeline_versions.json')
+COMPONENTS = ('classifier', 'prompts', 'thresholds', 'rules', 'yolo')
+# Rules in force before they were recorded in the description
+_LEGACY_RULES = {'illustration_food_cutoff': 0.40, 'people_suppresses_document': True}
+
+_lock = threading.Lock()
+_current: Dict[str, Dict[str, Any]] = {}
+_registry: Optional[Dict[str, Any]] = None
+_impact_cache: Dict[str, Dict[str, Any]] = {}
+
+
+def _digest(value: Any) -> str:
+    raw = json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:12]
+
+
+def describe_pipeline(classifier_name: Optional[str] = None) -> Dict[str, Any]:
+    """Collect the settings that determine tagging output, grouped by component.
+
+    Args:
+        classifier_name: model_registry classifier (default: the deployed one).
+    """
+    from . import clip_switcher
+
+    name = classifier_name or clip_switcher.DEFAULT_CLASSIFIER
+    if name == 'cascade':
+        from . import mobile_clip_model as clf
+        classifier = {
+            'backend': 'cascade',
+            'model': _cfg.CASCADE_STAGES,
+            'min_top': _cfg.CASCADE_MIN_TOP_PROB,
+            'min_margin': _cfg.CASCADE_MIN_MARGIN,
+        }
+        thresholds = {'single': clf.CATEGORY_THRESHOLDS, 'batch': clf.CATEGORY_THRESHOLDS}
+    elif name in clip_switcher.ONNX_BACKENDS:
+        from . import onnx_mobile_clip_model as clf
+        classifier = {'backend': name, 'model': clip_switcher.get_classifier(name).model_id}
+        thresholds = {'single': clf.CATEGORY_THRESHOLDS, 'batch': clf.CATEGORY_THRESHOLDS}
+    elif name.startswith('mobileclip-'):
+        from . import mobile_clip_model as clf
+        model_name, pretrained = clf.MobileCLIPPhotoClassifier.MODELS[name.split('-', 1)[1]]
+        classifier = {'backend': 'mobileclip', 'model': f"{model_name}/{pretrained}"}
+        thresholds = {'single': clf.CATEGORY_THRESHOLDS, 'batch': clf.CATEGORY_THRESHOLDS}
+    else:
+        from . import clip_model as clf
+        classifier = {'backend': 'clip', 'model': 'openai/clip-vit-base-patch32'}
+        thresholds = {'single': clf.CATEGORY_THRESHOLDS, 'batch': clf.BATCH_CATEGORY_THRESHOLDS}
+    # Bumping TAGS_MODEL_VERSION forces a full rescan
+    classifier['epoch'] = _cfg.TAGS_MODEL_VERSION
+    if _cfg.IMAGE_DECODE_MAX_SIDE:
+        classifier['decode_max_side'] = _cfg.IMAGE_DECODE_MAX_SIDE
+
+    yolo: Dict[str, Any] = {'enabled': bool(_cfg.USE_HYBRID_CLASSIFICATION)}
+    if yolo['enabled']:
+        from . import yolo_clip_hybrid as hybrid
+        mapping: Dict[str, list] = {}
+        for class_id, category in hybrid.YOLO_TO_CATEGORY.items():
+            mapping.setdefault(category, []).append(class_id)
+        yolo.update({
+            'model': hybrid.HYBRID_YOLO_MODEL,
+            'min_box_percent': _cfg.MIN_BOX_PERCENT,
+            'min_person_percent': _cfg.MIN_PERSON_PERCENT,
+            'mapping': {category: sorted(ids) for category, ids in mapping.items()},
+            'min_confidence': {
+                'people': hybrid.PEOPLE_MIN_CONFIDENCE,
+                'animals': hybrid.ANIMAL_MIN_CONFIDENCE,
+                'food': hybrid.FOOD_RELATED_MIN_CONFIDENCE,
+                'document': hybrid.YOLO_MIN_CONFIDENCE,
+            },
+        })
+
+    return {
+        'classifier': classifier,
+        'prompts': dict(zip(clf.CATEGORY_NAMES, clf.PHOTO_CATEGORIES)),
+        'thresholds': thresholds,
+        'rules': {**category_tags.describe(), 'other_label': clip_switcher.other_label_for(name)},
+        'yolo': yolo,
+    }
+
+
+def _component(description: Dict[str, Any], name: str) -> Any:
+    if name == 'rules' and 'rules' not in description:
+        backend = description.get('classifier', {}).get('backend')
+        return {**_LEGACY_RULES, 'other_label': 'Other' if backend == 'clip' else 'other'}
+    return description.get(name)
+
+
+def _load_registry() -> Dict[str, Any]:
+    global _registry
+    if _registry is None:
+        try:
+            with open(PIPELINE_VERSIONS_PATH, 'r', encoding='utf-8') as f:
+                _registry = json.load(f)
+        except FileNotFoundError:
+            _registry = {}
+        except Exception:
+            logger.exception('Failed to read pipeline versions; starting a new registry')
+            _registry = {}
+    return _registry
+
+
+def _register(version: str, description: Dict[str, Any]) -> None:
+    registry = _load_registry()
+    if version in registry:
+        return
+    registry[version] = description
+    # Merge with what other workers may have written, then replace atomically
+    try:
+        with open(PIPELINE_VERSIONS_PATH, 'r', encoding='utf-8') as f:
+            on_disk = json.load(f)
+        registry.update({k: v for k, v in on_disk.items() if k not in registry})
+    except Exception:
+        pass
+    tmp = f"{PIPELINE_VERSIONS_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(registry, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, PIPELINE_VERSIONS_PATH)
+        logger.info(f"Registered pipeline version {version}")
+    except Exception:
+        logger.exception('Failed to persist pipeline version registry')
+
+
+def current(classifier_name: Optional[str] = None) -> Dict[str, Any]:
+    """Return `{'version', 'components': {name: digest}, 'description'}` for the running pipeline.
+
+    Args:
+        classifier_name: Pipeline with this model_registry classifier instead of
+            the deployed one (per-request / per-tier classification).
+    """
+    key = classifier_name or ''
+    cur = _current.get(key)
+    if cur is None:
+        with _lock:
+            cur = _current.get(key)
+            if cur is None:
+                description = describe_pipeline(classifier_name)
+                components = {name: _digest(description[name]) for name in COMPONENTS}
+                version = 'p' + _digest(components)[:10]
+                _register(version, description)
+                cur = _current[key] = {'version': version, 'components': components, 'description': description}
+    return cur
+
+
+def current_version(classifier_name: Optional[str] = None) -> str:
+    return current(classifier_name)['version']
+
+
+def _changed_categories(old: Dict[str, float], new: Dict[str, float], narrowed: set, widened: set) -> None:
+    for category in set(old) | set(new):
+        if category not in old or category not in new:
+            widened.add(category)
+        elif new[category] > old[category]:
+            narrowed.add(category)
+        elif new[category] < old[category]:
+            widened.add(category)
+
+
+def impact(old_version: Optional[str]) -> Dict[str, Any]:
+    """Describe which entries tagged under `old_version` need re-tagging now.
+
+    Args:
+        old_version: `model_version` recorded on an entry.
+
+    Returns:
+        Dict with `all` (every entry of that version is stale), `categories`
+        (if not `all`: entries carrying one of these tags are stale) and
+        `changed` (component names that differ).
+    """
+    cur = current()
+    if old_version == cur['version']:
+        return {'all': False, 'categories': [], 'changed': []}
+    cached = _impact_cache.get(old_version)
+    if cached is not None:
+        return cached
+
+    old = _load_registry().get(old_version)
+    if old is None:
+        result = {'all': True, 'categories': [], 'changed': list(COMPONENTS), 'reason': 'unknown version'}
+    else:
+        new = cur['description']
+        changed = [name for name in COMPONENTS if _digest(_component(old, name)) != cur['components'][name]]
+        narrowed, widened = set(), set()
+        full = 'classifier' in changed or 'prompts' in changed or 'rules' in changed
+        if 'thresholds' in changed:
+            for table in set(old['thresholds']) | set(new['thresholds']):
+                _changed_categories(old['thresholds'].get(table, {}), new['thresholds'].get(table, {}),
+                                    narrowed, widened)
+        if 'yolo' in changed:
+            old_yolo, new_yolo = old['yolo'], new['yolo']
+            scalars = ('enabled', 'model', 'min_box_percent', 'min_person_percent')
+            if any(old_yolo.get(k) != new_yolo.get(k) for k in scalars):
+                full = True
+            else:
+                old_map, new_map = old_yolo.get('mapping', {}), new_yolo.get('mapping', {})
+                for category in set(old_map) | set(new_map):
+                    before, after = set(old_map.get(category, [])), set(new_map.get(category, []))
+                    if after - before:
+                        widened.add(category)
+                    elif before - after:
+                        narrowed.add(category)
+                _changed_categories(old_yolo.get('min_confidence', {}), new_yolo.get('min_confidence', {}),
+                                    narrowed, widened)
+        # A category that got easier to reach can appear on any photo
+        full = full or bool(widened)
+        result = {'all': full, 'categories': [] if full else sorted(narrowed), 'changed': changed}
+    _impact_cache[old_version] = result
+    return result
+
+
+def is_stale(old_version: Optional[str], tags: Optional[list]) -> bool:
+    """True if an entry with this version and these tags would be tagged differently now."""
+    info = impact(old_version)
+    if info['all']:
+        return True
+    return bool(info['categories']) and any(tag in info['categories'] for tag in (tags or ()))
@@ -0,0 +1,195 @@
+"""
+Re-apply classification thresholds to the whole library without inference.
+
+Uses the raw scores kept by score_store.py and reproduces the batch
+post-processing with vectorized NumPy:
+- CLIP: category_tags.select_tags, the classifiers' own post-processor
+- YOLO (hybrid mode): class -> category mapping, per-category confidence
+  floors, minimum box size, dominant category by priority then weighted score
+
+Typical uses:
+- dry run with candidate thresholds to see how many photos would change
+- after deploying new thresholds, `apply=True` rewrites only the affected
+  entries and stamps them with the current pipeline version
+
+Scores are stored as float16, so a probability within ~5e-4 of a threshold
+may land on the other side of it compared to the original run.
+"""
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from . import config as _cfg
+from .category_tags import select_tags
+
+logger = logging.getLogger(__name__)
+
+# Priority: people > animals > food > document (see map_yolo_detections_to_categories)
+YOLO_CATEGORY_PRIORITY = {"people": 4, "animals": 3, "food": 2, "document": 1}
+
+
+def clip_tags(probs: np.ndarray, categories: List[str], thresholds: Dict[str, float], max_tags: int,
+              other_label: str, default_threshold: float = 0.15) -> List[List[str]]:
+    """Tag names per row, exactly as the classifiers' batch path would return them.
+
+    Args:
+        probs: float[N, C] probabilities in `categories` order.
+        categories: Clean category names.
+        thresholds: Per-category thresholds (missing ones use `default_threshold`).
+        max_tags: Maximum tags per photo.
+        other_label: Tag used when no category passes.
+
+    Returns:
+        One tag list per row.
+    """
+    return [[tag for tag, _ in row]
+            for row in select_tags(probs, categories, thresholds, max_tags, other_label, default_threshold)]
+
+
+def yolo_tags(n: int, det_row: np.ndarray, det_class: np.ndarray, det_conf: np.ndarray, det_box: np.ndarray,
+              mapping: Dict[str, List[int]], min_confidence: Dict[str, float], default_confidence: float,
+              min_box_percent: float, min_person_percent: float) -> List[Optional[str]]:
+    """Vectorized equivalent of map_yolo_detections_to_categories.
+
+    Returns:
+        Dominant category per row, or None when no detection maps to a category.
+    """
+    categories = sorted(mapping, key=lambda c: -YOLO_CATEGORY_PRIORITY.get(c, 0))
+    cat_of_class = np.full(256, -1, dtype=np.int64)
+    conf_of_class = np.full(256, np.inf, dtype=np.float32)
+    for k, category in enumerate(categories):
+        for class_id in mapping[category]:
+            cat_of_class[class_id] = k
+            conf_of_class[class_id] = min_confidence.get(category, default_confidence)
+    size_of_class = np.full(256, min_box_percent, dtype=np.float32)
+    size_of_class[0] = min_person_percent
+
+    cat = cat_of_class[det_class]
+    ok = (cat >= 0) & (det_conf >= conf_of_class[det_class]) & (det_box >= size_of_class[det_class])
+    present = np.zeros((n, len(categories)), dtype=bool)
+    scores = np.zeros((n, len(categories)), dtype=np.float64)
+    present[det_row[ok], cat[ok]] = True
+    np.add.at(scores, (det_row[ok], cat[ok]), det_conf[ok].astype(np.float64) * det_box[ok])
+
+    priority = np.array([YOLO_CATEGORY_PRIORITY.get(c, 0) for c in categories], dtype=np.float64)
+    # Weighted scores are bounded by the detection count, so this keeps priority first
+    key = np.where(present, priority * 1e6 + scores, -np.inf)
+    best = key.argmax(axis=1) if len(categories) else np.zeros(n, dtype=np.int64)
+    has_any = present.any(axis=1)
+    return [categories[best[i]] if has_any[i] else None for i in range(n)]
+
+
+def compute_tags(arrays: Dict[str, Any], categories: List[str], thresholds: Dict[str, float], max_tags: int,
+                 other_label: str, yolo: Optional[Dict[str, Any]] = None) -> List[Optional[List[str]]]:
+    """Re-tag every row of `score_store.ScoreStore.arrays()`.
+
+    Args:
+        yolo: Pipeline YOLO description (`enabled`, `mapping`, `min_confidence`,
+            `min_box_percent`, `min_person_percent`); hybrid mode when enabled.
+
+    Returns:
+        Tag list per row, or None where the row would need inference (e.g.
+        YOLO no longer answers and CLIP never scored the photo).
+    """
+    probs = arrays['probs']
+    n = len(probs)
+    has_clip = ~np.isnan(probs).all(axis=1) if n else np.zeros(0, dtype=bool)
+    clip = clip_tags(np.nan_to_num(probs, nan=-1.0), categories, thresholds, max_tags, other_label)
+
+    if not yolo or not yolo.get('enabled'):
+        return [clip[i] if has_clip[i] else None for i in range(n)]
+
+    dominant = yolo_tags(n, arrays['det_row'], arrays['det_class'], arrays['det_conf'], arrays['det_box'],
+                         yolo.get('mapping', {}), yolo.get('min_confidence', {}),
+                         yolo.get('min_confidence', {}).get('document', 0.60),
+                         yolo.get('min_box_percent', 0.0), yolo.get('min_person_percent', 0.0))
+    has_yolo = arrays['has_yolo']
+    out: List[Optional[List[str]]] = []
+    for i in range(n):
+        if has_yolo[i] and dominant[i] is not None:
+            out.append([dominant[i]][:max_tags])
+        elif has_clip[i]:
+            out.append(clip[i])
+        else:
+            out.append(None)
+    return out
+
+
+def retag_library(tenant: Optional[str] = None, thresholds: Optional[Dict[str, float]] = None,
+                  yolo_min_confidence: Optional[Dict[str, float]] = None, apply: bool = False,
+                  limit: int = 100) -> Dict[str, Any]:
+    """Recompute tags for every photo with stored scores.
+
+    Args:
+        tenant: Tenant shard (None for the global store).
+        thresholds: Candidate CLIP thresholds for a dry run (merged over the
+            deployed batch thresholds).
+        yolo_min_confidence: Candidate YOLO confidence floors for a dry run.
+        apply: Write changed entries (and re-stamp stale ones) to the tags DB.
+            Only allowed with the deployed settings, so the stamped pipeline
+            version matches what produced the tags.
+        limit: Max example changes to return.
+
+    Returns:
+        Summary with counts and up to `limit` example changes.
+    """
+    from . import pipeline_version, tags_db
+    from .score_store import get_score_store
+
+    if apply and (thresholds or yolo_min_confidence):
+        raise ValueError('apply=True re-tags with the deployed thresholds; overrides are for dry runs only')
+
+    t0 = time.time()
+    description = pipeline_version.current()['description']
+    version = pipeline_version.current_version()
+    clip_thresholds = dict(description['thresholds']['batch'])
+    clip_thresholds.update(thresholds or {})
+    yolo = dict(description['yolo'])
+    if yolo_min_confidence:
+        yolo['min_confidence'] = {**yolo.get('min_confidence', {}), **yolo_min_confidence}
+    categories = list(description['prompts'])
+    other_label = 'Other' if description['classifier']['backend'] == 'clip' else 'other'
+    max_tags = _cfg.AUTO_TAG_MAX if _cfg.AUTO_TAG_MAX is not None else 5
+
+    arrays = get_score_store(tenant).arrays()
+    new_tags = compute_tags(arrays, categories, clip_thresholds, max_tags, other_label, yolo)
+    t_compute = time.time()
+
+    photo_ids = arrays['photo_ids']
+    store = tags_db.get_store(tenant)
+    current = store.lookup(photo_ids, ('tags', 'all_detections', 'content_hash', 'model_version'))
+    changed, examples, writes = 0, [], []
+    needs_inference = sum(1 for t in new_tags if t is None)
+    for photo_id, tags in zip(photo_ids, new_tags):
+        fields = current.get(photo_id)
+        if tags is None or fields is None:
+            continue
+        old_tags, all_detections, content_hash, old_version = fields
+        if tags != old_tags:
+            changed += 1
+            if len(examples) < limit:
+                examples.append({'photoID': photo_id, 'old': old_tags, 'new': tags})
+        if apply and (tags != old_tags or old_version != version):
+            # all_detections mirrors the tags for CLIP-only results
+            if not all_detections or all_detections == old_tags:
+                all_detections = tags
+            writes.append((photo_id, tags, all_detections, content_hash))
+    if writes:
+        tags_db.set_tags_many(writes, tenant=tenant)
+
+    result = {
+        'scored': len(photo_ids),
+        'changed': changed,
+        'needs_inference': needs_inference,
+        'written': len(writes),
+        'pipeline_version': version,
+        'thresholds': clip_thresholds,
+        'examples': examples,
+        'compute_ms': round((t_compute - t0) * 1000, 1),
+        'elapsed_ms': round((time.time() - t0) * 1000, 1),
+    }
+    logger.info(f"Retag {'apply' if apply else 'dry run'}: {len(photo_ids)} scored, {changed} changed, "
+                f"{needs_inference} need inference, {len(writes)} written in {result['elapsed_ms']}ms")
+    return result
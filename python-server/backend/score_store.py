@@ -0,0 +1,281 @@
+"""
+Dense per-photo classifier scores, kept so the library can be re-thresholded
+without running inference again (see retag.py).
+
+For every tagged photo we keep:
+- the CLIP probability vector (float16[C], in CATEGORY_NAMES order; NaN row
+  when CLIP never ran for that photo, e.g. YOLO answered in hybrid mode)
+- the YOLO detections as (class_id uint8, confidence float16, box fraction
+  float16) slices into shared pools; length -1 when YOLO didn't run
+
+Everything lives in a handful of NumPy arrays (~12 bytes of probabilities
+plus ~5 bytes per detection per photo) saved as one `.npz` next to the
+photo's tags DB file. The file is a cache: a photo without scores is simply
+reported as needing inference.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+_NO_DETECTIONS = -1
+
+
+class ScoreStore:
+    """photoID -> (CLIP probabilities, YOLO detections) backed by dense arrays."""
+
+    def __init__(self, path: str, categories: List[str], flush_interval: float = 30.0):
+        self.path = path
+        self.categories = list(categories)
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._index: Dict[str, int] = {}
+        self._ids: List[str] = []
+        c = len(self.categories)
+        self._probs = np.full((0, c), np.nan, dtype=np.float16)
+        self._det_off = np.zeros(0, dtype=np.int64)
+        self._det_len = np.zeros(0, dtype=np.int32)
+        self._det_class = np.zeros(0, dtype=np.uint8)
+        self._det_conf = np.zeros(0, dtype=np.float16)
+        self._det_box = np.zeros(0, dtype=np.float16)
+        self._det_used = 0
+        self._dirty = False
+        self._last_save = time.time()
+        # Set while out of the open-store cache: writes then flush immediately
+        self.evicted = False
+        self._load()
+
+    # --- persistence ---
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if list(data['categories']) != self.categories:
+                    logger.warning(f"Score store {self.path} has categories {list(data['categories'])}, "
+                                   f"expected {self.categories}; ignoring it")
+                    return
+                self._ids = [str(x) for x in data['photo_ids']]
+                self._index = {pid: i for i, pid in enumerate(self._ids)}
+                self._probs = data['probs'].astype(np.float16)
+                self._det_off = data['det_off'].astype(np.int64)
+                self._det_len = data['det_len'].astype(np.int32)
+                self._det_class = data['det_class'].astype(np.uint8)
+                self._det_conf = data['det_conf'].astype(np.float16)
+                self._det_box = data['det_box'].astype(np.float16)
+                self._det_used = len(self._det_class)
+            logger.info(f"Loaded scores for {len(self._ids)} photos from {self.path}")
+        except Exception:
+            logger.exception(f"Failed to read score store {self.path}; starting empty")
+
+    def flush(self) -> bool:
+        """Write the store to disk if it changed (atomic replace)."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            n = len(self._ids)
+            used = self._det_used
+            tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                np.savez(tmp, categories=np.array(self.categories),
+                         photo_ids=np.array(self._ids, dtype=str),
+                         probs=self._probs[:n], det_off=self._det_off[:n], det_len=self._det_len[:n],
+                         det_class=self._det_class[:used], det_conf=self._det_conf[:used],
+                         det_box=self._det_box[:used])
+                os.replace(tmp, self.path)
+            except Exception:
+                logger.exception(f"Failed to write score store {self.path}")
+                return False
+            self._dirty = False
+            self._last_save = time.time()
+            return True
+
+    # --- writes ---
+
+    def _grow(self, rows: int, dets: int) -> None:
+        n = len(self._ids)
+        if n + rows > len(self._probs):
+            cap = max(1024, 2 * (n + rows))
+            probs = np.full((cap, len(self.categories)), np.nan, dtype=np.float16)
+            probs[:n] = self._probs[:n]
+            self._probs = probs
+            self._det_off = np.resize(self._det_off, cap)
+            self._det_len = np.resize(self._det_len, cap)
+        if self._det_used + dets > len(self._det_class):
+            self._compact_detections()
+            cap = max(4096, 2 * (self._det_used + dets))
+            for name in ('_det_class', '_det_conf', '_det_box'):
+                setattr(self, name, np.resize(getattr(self, name)[:self._det_used], cap))
+
+    def _compact_detections(self) -> None:
+        # Drop detection slices that were overwritten by later puts
+        n = len(self._ids)
+        lengths = np.maximum(self._det_len[:n], 0)
+        if lengths.sum() == self._det_used:
+            return
+        keep = np.concatenate([np.arange(o, o + l) for o, l in zip(self._det_off[:n], lengths) if l]
+                              or [np.zeros(0, dtype=np.int64)])
+        self._det_class = self._det_class[keep]
+        self._det_conf = self._det_conf[keep]
+        self._det_box = self._det_box[keep]
+        self._det_off[:n] = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if n else self._det_off[:n]
+        self._det_used = len(keep)
+
+    def put_many(self, records: Dict[str, Tuple[Optional[np.ndarray], Optional[np.ndarray]]]) -> None:
+        """Record scores for many photos.
+
+        Args:
+            records: photoID -> (clip_probs, yolo_detections). `clip_probs` is a
+                vector in `categories` order or None; `yolo_detections` is a
+                (k, 3) array of (class_id, confidence, box_fraction) or None
+                when YOLO didn't run. A None part keeps nothing from earlier puts.
+        """
+        if not records:
+            return
+        with self._lock:
+            new_dets = sum(len(d) for _, d in records.values() if d is not None)
+            self._grow(len(records), new_dets)
+            for photo_id, (probs, dets) in records.items():
+                row = self._index.get(photo_id)
+                if row is None:
+                    row = len(self._ids)
+                    self._ids.append(photo_id)
+                    self._index[photo_id] = row
+                self._probs[row] = np.nan if probs is None else np.asarray(probs, dtype=np.float16)
+                if dets is None:
+                    self._det_off[row], self._det_len[row] = 0, _NO_DETECTIONS
+                else:
+                    dets = np.asarray(dets, dtype=np.float32).reshape(-1, 3)
+                    start, k = self._det_used, len(dets)
+                    self._det_class[start:start + k] = dets[:, 0].astype(np.uint8)
+                    self._det_conf[start:start + k] = dets[:, 1]
+                    self._det_box[start:start + k] = dets[:, 2]
+                    self._det_off[row], self._det_len[row] = start, k
+                    self._det_used += k
+            self._dirty = True
+            due = self.evicted or time.time() - self._last_save >= self.flush_interval
+        if due:
+            self.flush()
+
+    # --- reads ---
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get(self, photo_id: str) -> Optional[Tuple[Optional[np.ndarray], Optional[np.ndarray]]]:
+        with self._lock:
+            row = self._index.get(photo_id)
+            if row is None:
+                return None
+            probs = self._probs[row].astype(np.float32)
+            length = int(self._det_len[row])
+            dets = None
+            if length != _NO_DETECTIONS:
+                s = slice(int(self._det_off[row]), int(self._det_off[row]) + length)
+                dets = np.stack([self._det_class[s].astype(np.float32), self._det_conf[s].astype(np.float32),
+                                 self._det_box[s].astype(np.float32)], axis=1)
+            return (None if np.isnan(probs).all() else probs), dets
+
+    def arrays(self) -> Dict[str, Any]:
+        """Point-in-time copy of the columns for vectorized re-tagging.
+
+        Returns:
+            Dict with `photo_ids`, `probs` (float32[N, C], NaN rows = no CLIP),
+            `det_row`/`det_class`/`det_conf`/`det_box` (one item per detection)
+            and `has_yolo` (bool[N]).
+        """
+        with self._lock:
+            n = len(self._ids)
+            lengths = self._det_len[:n]
+            has_yolo = lengths != _NO_DETECTIONS
+            counts = np.maximum(lengths, 0)
+            starts = self._det_off[:n]
+            idx = (np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+                   + np.arange(counts.sum())) if n else np.zeros(0, dtype=np.int64)
+            return {
+                'photo_ids': list(self._ids),
+                'probs': self._probs[:n].astype(np.float32),
+                'has_yolo': has_yolo.copy(),
+                'det_row': np.repeat(np.arange(n), counts),
+                'det_class': self._det_class[idx].astype(np.int64),
+                'det_conf': self._det_conf[idx].astype(np.float32),
+                'det_box': self._det_box[idx].astype(np.float32),
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        n = len(self._ids)
+        return {
+            'photos': n,
+            'with_clip': int((~np.isnan(self._probs[:n]).all(axis=1)).sum()) if n else 0,
+            'with_yolo': int((self._det_len[:n] != _NO_DETECTIONS).sum()),
+            'detections': int(np.maximum(self._det_len[:n], 0).sum()),
+            'bytes': int(self._probs.nbytes + self._det_off.nbytes + self._det_len.nbytes
+                         + self._det_class.nbytes + self._det_conf.nbytes + self._det_box.nbytes),
+            'path': self.path,
+        }
+
+
+_stores: 'OrderedDict[str, ScoreStore]' = OrderedDict()
+_stores_lock = threading.Lock()
+# Every store still referenced anywhere, open or evicted
+_held: 'weakref.WeakValueDictionary' = weakref.WeakValueDictionary()
+
+
+def score_path_for(tags_path: str) -> str:
+    """Score file that sits next to a tags DB file (or SQLite DB)."""
+    return os.path.splitext(tags_path)[0] + '.scores.npz'
+
+
+def get_score_store(tenant: Optional[str] = None) -> ScoreStore:
+    """Return the score store paired with `tenant`'s tags DB shard."""
+    from . import tags_db
+    from .clip_switcher import CATEGORY_NAMES
+
+    path = score_path_for(tags_db.get_store(tenant).path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            # Reuse an evicted store a request still holds instead of loading a second copy
+            store = _held.get(path)
+            if store is None:
+                store = _held[path] = ScoreStore(path, CATEGORY_NAMES, _cfg.SCORE_STORE_FLUSH_INTERVAL)
+            store.evicted = False
+            _stores[path] = store
+        _stores.move_to_end(path)
+        evicted = []
+        while len(_stores) > max(1, _cfg.TAGS_DB_MAX_OPEN_SHARDS):
+            old = _stores.popitem(last=False)[1]
+            old.evicted = True
+            evicted.append(old)
+    for old in evicted:
+        old.flush()
+    return store
+
+
+def record_scores(records: Dict[str, Tuple[Optional[np.ndarray], Optional[np.ndarray]]],
+                  tenant: Optional[str] = None) -> None:
+    """Best-effort: keep classifier scores for a batch of photoIDs."""
+    if not _cfg.SCORE_STORE_ENABLED or not records:
+        return
+    try:
+        get_score_store(tenant).put_many(records)
+    except Exception:
+        logger.exception('Failed to record classifier scores')
+
+
+def flush() -> None:
+    with _stores_lock:
+        stores = list(_held.values())
+    for store in stores:
+        store.flush()
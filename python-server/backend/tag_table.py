@@ -0,0 +1,349 @@
+"""
+Compact in-memory table for tags DB entries.
+
+A plain dict of dicts repeats the same few dozen tag/source strings and a
+fresh ISO timestamp string for every photo, which costs several hundred bytes
+per entry and adds up to gigabytes at 1M photos. `CompactTagTable` keeps the
+same Mapping interface (photoID -> entry dict) but stores entries in columns:
+
+- photoIDs map to a row number (one dict + one list)
+- tag, detection and source strings are interned to integer IDs
+- tags / all_detections are (offset, length) slices into shared int32 pools
+- last_updated is an int64 of microseconds since the epoch
+- short per-photo string fields (content_hash, model_version) live in plain
+  list columns instead of a per-row dict
+
+Entries are materialized back into the usual
+`{'tags', 'last_updated', 'source', 'all_detections'}` dict on read, so callers
+don't notice the difference. Anything that doesn't fit the columns (legacy
+list entries, extra keys, non-standard timestamps) is kept verbatim in a side
+dict, so round trips are lossless.
+"""
+import sys
+from array import array
+from collections.abc import MutableMapping
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+_EPOCH = datetime(1970, 1, 1)
+NO_TIMESTAMP = _NO_TIMESTAMP = -(2 ** 63)
+_ABSENT = -1  # slice length meaning "key not present" (vs. an empty list)
+_COLUMN_KEYS = ('tags', 'last_updated', 'source', 'all_detections')
+_SCALAR_KEYS = ('content_hash', 'model_version')
+
+
+def _parse_timestamp(value: Any) -> Optional[int]:
+    """Return microseconds since epoch if `value` is exactly `_now_iso()` format."""
+    if not isinstance(value, str) or not value.endswith('Z'):
+        return None
+    try:
+        dt = datetime.fromisoformat(value[:-1])
+    except ValueError:
+        return None
+    if dt.tzinfo is not None or dt.isoformat() + 'Z' != value:
+        return None
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _format_timestamp(micros: int) -> str:
+    dt = datetime.fromtimestamp(micros // 1000000, tz=timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=micros % 1000000).isoformat() + 'Z'
+
+
+class CompactTagTable(MutableMapping):
+    """Mapping of photoID -> entry dict backed by interned, array-based columns."""
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        self._index: Dict[str, int] = {}
+        self._ids: List[Optional[str]] = []
+        self._free: List[int] = []
+
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+
+        self._ts = array('q')
+        self._source = array('i')
+        self._tag_off = array('I')
+        self._tag_len = array('i')
+        self._det_off = array('I')
+        self._det_len = array('i')
+        self._pool = array('i')
+        self._pool_garbage = 0
+        # key -> per-row string (None = absent)
+        self._scalars: Dict[str, List[Optional[str]]] = {key: [] for key in _SCALAR_KEYS}
+
+        # row -> dict of keys that couldn't be stored in columns, or the raw
+        # value for entries that aren't dicts at all (legacy lists)
+        self._extras: Dict[int, Any] = {}
+        self._raw_rows = set()
+
+        if data:
+            self.update(data)
+
+    # --- interning ---
+
+    def _intern(self, value: str) -> int:
+        sid = self._string_ids.get(value)
+        if sid is None:
+            sid = len(self._strings)
+            self._strings.append(value)
+            self._string_ids[value] = sid
+        return sid
+
+    def _store_list(self, values: Any):
+        """Append a list of strings to the pool; returns (offset, length) or None."""
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            return None
+        offset = len(self._pool)
+        self._pool.extend(self._intern(v) for v in values)
+        return offset, len(values)
+
+    def _load_list(self, offset: int, length: int) -> List[str]:
+        strings = self._strings
+        return [strings[i] for i in self._pool[offset:offset + length]]
+
+    # --- rows ---
+
+    def _alloc_row(self, photo_id: str) -> int:
+        if self._free:
+            row = self._free.pop()
+            self._ids[row] = photo_id
+        else:
+            row = len(self._ids)
+            self._ids.append(photo_id)
+            self._ts.append(_NO_TIMESTAMP)
+            self._source.append(-1)
+            self._tag_off.append(0)
+            self._tag_len.append(_ABSENT)
+            self._det_off.append(0)
+            self._det_len.append(_ABSENT)
+            for col in self._scalars.values():
+                col.append(None)
+        self._index[photo_id] = row
+        return row
+
+    def _release_slices(self, row: int) -> None:
+        self._pool_garbage += max(self._tag_len[row], 0) + max(self._det_len[row], 0)
+        self._tag_len[row] = _ABSENT
+        self._det_len[row] = _ABSENT
+        for col in self._scalars.values():
+            col[row] = None
+        self._extras.pop(row, None)
+        self._raw_rows.discard(row)
+
+    def _maybe_compact_pool(self) -> None:
+        # Rewrite the pool once more than half of it is unreferenced
+        if self._pool_garbage < 4096 or self._pool_garbage * 2 < len(self._pool):
+            return
+        pool = array('i')
+        for row in self._index.values():
+            for off_col, len_col in ((self._tag_off, self._tag_len), (self._det_off, self._det_len)):
+                length = len_col[row]
+                if length > 0:
+                    offset = off_col[row]
+                    off_col[row] = len(pool)
+                    pool.extend(self._pool[offset:offset + length])
+        self._pool = pool
+        self._pool_garbage = 0
+
+    # --- Mapping interface ---
+
+    def __getitem__(self, photo_id: str) -> Any:
+        row = self._index[photo_id]
+        if row in self._raw_rows:
+            return self._extras[row]
+        entry: Dict[str, Any] = {}
+        if self._tag_len[row] != _ABSENT:
+            entry['tags'] = self._load_list(self._tag_off[row], self._tag_len[row])
+        if self._ts[row] != _NO_TIMESTAMP:
+            entry['last_updated'] = _format_timestamp(self._ts[row])
+        if self._source[row] >= 0:
+            entry['source'] = self._strings[self._source[row]]
+        if self._det_len[row] != _ABSENT:
+            entry['all_detections'] = self._load_list(self._det_off[row], self._det_len[row])
+        for key, col in self._scalars.items():
+            if col[row] is not None:
+                entry[key] = col[row]
+        extras = self._extras.get(row)
+        if extras:
+            entry.update(extras)
+        return entry
+
+    def __setitem__(self, photo_id: str, entry: Any) -> None:
+        row = self._index.get(photo_id)
+        if row is None:
+            row = self._alloc_row(photo_id)
+        else:
+            self._release_slices(row)
+        self._ts[row] = _NO_TIMESTAMP
+        self._source[row] = -1
+
+        if not isinstance(entry, dict):
+            self._extras[row] = entry
+            self._raw_rows.add(row)
+            return
+
+        extras = {}
+        for key, value in entry.items():
+            if key in ('tags', 'all_detections'):
+                stored = self._store_list(value)
+                if stored is None:
+                    extras[key] = value
+                    continue
+                off_col, len_col = (self._tag_off, self._tag_len) if key == 'tags' else (self._det_off, self._det_len)
+                off_col[row], len_col[row] = stored
+            elif key == 'last_updated':
+                micros = _parse_timestamp(value)
+                if micros is None:
+                    extras[key] = value
+                else:
+                    self._ts[row] = micros
+            elif key == 'source' and isinstance(value, str):
+                self._source[row] = self._intern(value)
+            elif key in self._scalars and isinstance(value, str):
+                # sys.intern shares the handful of distinct model versions
+                self._scalars[key][row] = sys.intern(value)
+            else:
+                extras[key] = value
+        # Keys stored in columns are re-emitted in canonical order; keep the
+        # whole entry verbatim if that would reorder keys of an odd entry.
+        if extras and any(k in _COLUMN_KEYS for k in extras):
+            self._release_slices(row)
+            self._ts[row] = _NO_TIMESTAMP
+            self._source[row] = -1
+            self._extras[row] = dict(entry)
+            self._raw_rows.add(row)
+        elif extras:
+            self._extras[row] = extras
+        self._maybe_compact_pool()
+
+    def __delitem__(self, photo_id: str) -> None:
+        row = self._index.pop(photo_id)
+        self._release_slices(row)
+        self._ids[row] = None
+        self._free.append(row)
+        self._maybe_compact_pool()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, photo_id: object) -> bool:
+        return photo_id in self._index
+
+    def clear(self) -> None:
+        self.__init__()
+
+    # --- helpers ---
+
+    def get_list(self, photo_id: str, key: str) -> Optional[List[str]]:
+        """Return `tags` or `all_detections` for a photo without materializing the
+        whole entry. None if the photo or key is missing."""
+        row = self._index.get(photo_id)
+        if row is None:
+            return None
+        if row in self._raw_rows or key in self._extras.get(row, ()):
+            value = self[photo_id]
+            return value.get(key) if isinstance(value, dict) else None
+        off_col, len_col = (self._tag_off, self._tag_len) if key == 'tags' else (self._det_off, self._det_len)
+        if len_col[row] == _ABSENT:
+            return None
+        return self._load_list(off_col[row], len_col[row])
+
+    def get_scalar(self, photo_id: str, key: str) -> Optional[str]:
+        """Return a short string field (e.g. `content_hash`) for a photo without
+        materializing the entry. None if the photo or field is missing."""
+        row = self._index.get(photo_id)
+        if row is None:
+            return None
+        col = self._scalars.get(key)
+        if col is not None and col[row] is not None:
+            return col[row]
+        extras = self._extras.get(row)
+        return extras.get(key) if isinstance(extras, dict) else None
+
+    def copy(self) -> 'CompactTagTable':
+        """Cheap point-in-time copy (array memcpy, no entry materialization)."""
+        other = CompactTagTable.__new__(CompactTagTable)
+        other._index = dict(self._index)
+        other._ids = list(self._ids)
+        other._free = list(self._free)
+        other._strings = list(self._strings)
+        other._string_ids = dict(self._string_ids)
+        for name in ('_ts', '_source', '_tag_off', '_tag_len', '_det_off', '_det_len', '_pool'):
+            setattr(other, name, array(getattr(self, name).typecode, getattr(self, name)))
+        other._pool_garbage = self._pool_garbage
+        other._scalars = {key: list(col) for key, col in self._scalars.items()}
+        other._extras = dict(self._extras)
+        other._raw_rows = set(self._raw_rows)
+        return other
+
+    @classmethod
+    def from_columns(cls, photo_ids: List[str], strings: List[str], has_tags, tag_offsets, tag_ids,
+                     has_detections, det_offsets, det_ids, timestamps, source_ids,
+                     extras: Optional[Dict[int, Any]] = None, raw_rows=()) -> 'CompactTagTable':
+        """Build a table directly from column arrays (e.g. a columnar snapshot)
+        without materializing per-entry dicts.
+
+        `*_offsets` have len(photo_ids) + 1 items; `tag_ids`/`det_ids`/`source_ids`
+        index into `strings`; `timestamps` are microseconds (ignored where None
+        is signalled by `_NO_TIMESTAMP`). Sequences may be lists or NumPy arrays.
+        """
+        table = cls()
+        n = len(photo_ids)
+        table._ids = list(photo_ids)
+        table._index = dict(zip(table._ids, range(n)))
+        table._strings = list(strings)
+        table._string_ids = {v: i for i, v in enumerate(table._strings)}
+
+        def lengths(offsets, present):
+            offs = list(offsets)
+            return [offs[i + 1] - offs[i] if present[i] else _ABSENT for i in range(n)], offs[:n]
+
+        tag_len, tag_off = lengths(tag_offsets, list(has_tags))
+        det_len, det_off = lengths(det_offsets, list(has_detections))
+        # One pool: tags first, then detections shifted past them
+        shift = len(tag_ids)
+        table._pool = array('i', list(tag_ids) + list(det_ids))
+        table._tag_off = array('I', tag_off)
+        table._tag_len = array('i', tag_len)
+        table._det_off = array('I', (o + shift for o in det_off))
+        table._det_len = array('i', det_len)
+        table._ts = array('q', list(timestamps))
+        table._source = array('i', list(source_ids))
+        table._scalars = {key: [None] * n for key in _SCALAR_KEYS}
+        table._extras = dict(extras or {})
+        table._raw_rows = set(raw_rows)
+        # Hoist scalar fields out of the per-row extras dicts
+        for row, row_extras in list(table._extras.items()):
+            if row in table._raw_rows or not isinstance(row_extras, dict):
+                continue
+            for key, col in table._scalars.items():
+                if isinstance(row_extras.get(key), str):
+                    col[row] = sys.intern(row_extras.pop(key))
+            if not row_extras:
+                del table._extras[row]
+        if len(table._index) != n:
+            # Duplicate photoIDs: fall back to the slow path so the last one wins
+            return cls(table.to_dict())
+        return table
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {photo_id: self[photo_id] for photo_id in self._index}
+
+    def memory_stats(self) -> Dict[str, int]:
+        """Approximate bytes held by the columnar arrays and interned strings."""
+        column_bytes = sum(a.itemsize * len(a) for a in (
+            self._ts, self._source, self._tag_off, self._tag_len, self._det_off, self._det_len, self._pool))
+        return {
+            'rows': len(self._ids),
+            'free_rows': len(self._free),
+            'interned_strings': len(self._strings),
+            'pool_refs': len(self._pool),
+            'pool_garbage': self._pool_garbage,
+            'column_bytes': column_bytes + sum(8 * len(col) for col in self._scalars.values()),
+            'extras_rows': len(self._extras),
+        }
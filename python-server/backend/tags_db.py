@@ -1,8 +1,23 @@
+import atexit
+import contextlib
+import hashlib
 import json
+import logging
 import os
-from typing import Dict, List, Any
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Any, Optional, Tuple
 from datetime import datetime
 
+from . import config as _cfg
+from .tag_table import CompactTagTable
+
+logger = logging.getLogger(__name__)
+
 TAGS_DB_PATH = os.path.join(os.path.dirname(__file__), 'tags_db.json')
 
 
@@ -10,14 +25,14 @@ def _now_iso() -> str:
     return datetime.utcnow().isoformat() + 'Z'
 
 
-def _load_tags_db() -> Dict[str, Any]:
-    """Load tags DB. Supports legacy format (photoID -> [tags]) and new format
-    (photoID -> {tags, last_updated, source}). If legacy format is detected,
-    perform an in-place upgrade with a backup file.
+def _read_tags_file(path: str) -> Dict[str, Any]:
+    """Read a tags DB file from disk. Supports legacy format (photoID -> [tags])
+    and new format (photoID -> {tags, last_updated, source}). If legacy format is
+    detected, perform an in-place upgrade with a backup file.
     """
     try:
-        if os.path.exists(TAGS_DB_PATH):
-            with open(TAGS_DB_PATH, 'r', encoding='utf-8') as f:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
                 raw = json.load(f)
             # Detect legacy format: values are lists of strings
             needs_migrate = False
@@ -27,7 +42,7 @@ def _load_tags_db() -> Dict[str, Any]:
                     break
             if needs_migrate:
                 # Backup current file
-                backup_path = TAGS_DB_PATH + '.bak'
+                backup_path = path + '.bak'
                 try:
                     with open(backup_path, 'w', encoding='utf-8') as bf:
                         json.dump(raw, bf, ensure_ascii=False, indent=2)
@@ -45,51 +60,963 @@ def _load_tags_db() -> Dict[str, Any]:
                         }
                     else:
                         new[k] = v
-                _save_tags_db(new)
+                _write_tags_file(path, new)
                 return new
             return raw
     except Exception:
-        pass
+        logger.exception(f"Failed to read tags DB from {path}")
     return {}
 
 
-def _save_tags_db(db: Dict[str, Any]) -> None:
+def _write_tags_file(path: str, db: Dict[str, Any]) -> None:
+    """Atomically replace `path` with the JSON encoding of `db`.
+
+    The data is written to a temp file in the same directory, fsynced and then
+    swapped in with `os.replace`, so a crash mid-write leaves the previous file
+    intact instead of a truncated one.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        with open(TAGS_DB_PATH, 'w', encoding='utf-8') as f:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(db, f, ensure_ascii=False, indent=2)
-    except Exception:
-        # Best-effort only; don't crash
-        pass
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
 
 
-def get_tags(photo_id: str) -> List[str]:
-    db = _load_tags_db()
-    entry = db.get(photo_id)
-    if not entry:
-        return []
+def _list_field(entry: Any, field: str) -> Optional[List[str]]:
     if isinstance(entry, list):
         # legacy
+        return entry if field == 'tags' else None
+    return entry.get(field) if isinstance(entry, dict) else None
+
+
+class TagStore:
+    """In-memory tags DB with write-behind persistence.
+
+    The JSON file is parsed once on first access. Writes update the in-memory
+    dict and mark the photoID dirty; dirty entries are flushed together when
+    the flush interval elapses or the dirty count reaches the threshold, so a
+    burst of requests costs one file write instead of one per request.
+    With durability 'sync' every write is flushed before returning.
+    """
+
+    def __init__(self, path: str, durability: str = 'write-behind',
+                 flush_interval: float = 2.0, flush_threshold: int = 500, compact_memory: bool = True):
+        if durability not in ('sync', 'write-behind'):
+            raise ValueError(f"Invalid durability: {durability!r}. Use 'sync' or 'write-behind'")
+        self.path = path
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        # Hold entries in a CompactTagTable (interned, array-backed) instead of a dict of dicts
+        self.compact_memory = compact_memory
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._db: Optional[Dict[str, Any]] = None
+        self._dirty = set()
+        self._cleared = False
+        self._first_dirty_at: Optional[float] = None
+        self._timer: Optional[threading.Timer] = None
+
+        self._stats = {
+            'load_ms': 0.0,
+            'flush_count': 0,
+            'flush_errors': 0,
+            'last_flush_at': None,
+            'last_flush_ms': 0.0,
+            'last_flush_entries': 0,
+            'max_flush_lag_ms': 0.0,
+        }
+
+    # --- loading ---
+
+    def _ensure_loaded(self) -> Dict[str, Any]:
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    t0 = time.time()
+                    self._db = self._new_table(_read_tags_file(self.path))
+                    self._stats['load_ms'] = round((time.time() - t0) * 1000, 1)
+                    logger.info(f"Loaded {len(self._db)} tag entries from {self.path} in {self._stats['load_ms']}ms")
+        return self._db
+
+    def _new_table(self, data: Dict[str, Any]):
+        if isinstance(data, CompactTagTable):
+            return data if self.compact_memory else data.to_dict()
+        return CompactTagTable(data) if self.compact_memory else dict(data)
+
+    @staticmethod
+    def _as_dict(table) -> Dict[str, Any]:
+        return table.to_dict() if isinstance(table, CompactTagTable) else table
+
+    # --- reads ---
+
+    def get(self, photo_id: str) -> Any:
+        # CompactTagTable rewrites slices in place, so reads must not interleave with writes
+        with self._lock:
+            return self._ensure_loaded().get(photo_id)
+
+    def get_list(self, photo_id: str, field: str) -> Optional[List[str]]:
+        """One list field ('tags' / 'all_detections') of an entry, or None if absent."""
+        with self._lock:
+            db = self._ensure_loaded()
+            if isinstance(db, CompactTagTable):
+                return db.get_list(photo_id, field)
+            entry = db.get(photo_id)
+        return _list_field(entry, field)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a copy of the whole DB (safe to iterate while writes continue)."""
+        with self._lock:
+            db = self._ensure_loaded()
+            data = db.copy()
+        return self._as_dict(data)
+
+    def __len__(self) -> int:
+        with self._lock:
+            db = self._ensure_loaded()
+            return len(db)
+
+    def lookup(self, photo_ids: Iterable[str], fields: Tuple[str, ...]) -> Dict[str, Tuple]:
+        """Return {photo_id: (field values...)} for the photoIDs that exist.
+
+        Only the requested scalar fields are read, so checking a whole library
+        doesn't materialize every entry.
+        """
+        found = {}
+        with self._lock:
+            db = self._ensure_loaded()
+            if isinstance(db, CompactTagTable):
+                getters = [(lambda pid, f=f: db.get_list(pid, f)) if f in ('tags', 'all_detections')
+                           else (lambda pid, f=f: db.get_scalar(pid, f)) for f in fields]
+                for photo_id in photo_ids:
+                    if photo_id in db:
+                        found[photo_id] = tuple(get(photo_id) for get in getters)
+            else:
+                for photo_id in photo_ids:
+                    entry = db.get(photo_id)
+                    if entry is not None or photo_id in db:
+                        found[photo_id] = tuple(entry.get(f) if isinstance(entry, dict) else None
+                                                for f in fields)
+        return found
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            db = self._ensure_loaded()
+            return list(db.keys())
+
+    # --- writes ---
+
+    def put(self, photo_id: str, entry: Any) -> None:
+        with self._lock:
+            db = self._ensure_loaded()
+            db[photo_id] = entry
+            self._mark_dirty(photo_id)
+        self._after_write()
+
+    def put_many(self, entries: Dict[str, Any]) -> None:
+        """Apply several entries under one lock and at most one flush."""
+        if not entries:
+            return
+        with self._lock:
+            db = self._ensure_loaded()
+            for photo_id, entry in entries.items():
+                db[photo_id] = entry
+                self._mark_dirty(photo_id)
+        self._after_write()
+
+    def pop(self, photo_id: str) -> Any:
+        with self._lock:
+            db = self._ensure_loaded()
+            entry = db.pop(photo_id, None)
+            if entry is not None:
+                self._mark_dirty(photo_id)
+        self._after_write()
+        return entry
+
+    def move(self, old_photo_id: str, new_photo_id: str, now: str) -> bool:
+        """Re-key an entry (updating last_updated). Returns False if it did not exist."""
+        with self._lock:
+            db = self._ensure_loaded()
+            entry = self._rekey(db, old_photo_id, new_photo_id, now)
+            if entry is None:
+                return False
+            self._mark_dirty(old_photo_id)
+            self._mark_dirty(new_photo_id)
+        # Flush outside _lock: flush takes _flush_lock first, then _lock
+        self._after_write()
+        return True
+
+    @staticmethod
+    def _rekey(db, old_photo_id: str, new_photo_id: str, now: str) -> Any:
+        # Caller holds self._lock
+        entry = db.pop(old_photo_id, None)
+        if entry is None:
+            return None
+        if isinstance(entry, dict):
+            entry = dict(entry, last_updated=now)
+        db[new_photo_id] = entry
+        return entry
+
+    def replace_all(self, new_db: Dict[str, Any]) -> None:
+        """Replace the whole DB (e.g. clear) and flush immediately."""
+        with self._lock:
+            self._db = self._new_table(new_db)
+            self._cleared = True
+            if self._first_dirty_at is None:
+                self._first_dirty_at = time.time()
+        self.flush()
+
+    def _mark_dirty(self, photo_id: str) -> None:
+        self._dirty.add(photo_id)
+        if self._first_dirty_at is None:
+            self._first_dirty_at = time.time()
+
+    def _after_write(self) -> None:
+        if self.durability == 'sync' or len(self._dirty) >= self.flush_threshold:
+            self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        # One pending timer coalesces every write that lands before it fires.
+        with self._lock:
+            if self._timer is not None or not (self._dirty or self._cleared):
+                return
+            self._timer = threading.Timer(self.flush_interval, self._timer_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timer_flush(self) -> None:
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    # --- persistence ---
+
+    def flush(self) -> bool:
+        """Write pending changes to disk. Returns True if a write happened."""
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if self._db is None or not (self._dirty or self._cleared):
+                    return False
+                data = self._db.copy()
+                flushed_entries = len(self._dirty)
+                first_dirty_at = self._first_dirty_at
+                self._dirty = set()
+                self._cleared = False
+                self._first_dirty_at = None
+
+            t0 = time.time()
+            try:
+                _write_tags_file(self.path, self._as_dict(data))
+            except Exception:
+                self._stats['flush_errors'] += 1
+                logger.exception(f"Failed to flush tags DB to {self.path}")
+                # Put the work back so the next flush retries it
+                with self._lock:
+                    self._cleared = True
+                    if self._first_dirty_at is None:
+                        self._first_dirty_at = first_dirty_at
+                self._schedule_flush()
+                return False
+            t1 = time.time()
+
+            self._stats['flush_count'] += 1
+            self._stats['last_flush_at'] = _now_iso()
+            self._stats['last_flush_ms'] = round((t1 - t0) * 1000, 1)
+            self._stats['last_flush_entries'] = flushed_entries
+            if first_dirty_at is not None:
+                lag_ms = round((t1 - first_dirty_at) * 1000, 1)
+                self._stats['max_flush_lag_ms'] = max(self._stats['max_flush_lag_ms'], lag_ms)
+            return True
+
+    def close(self) -> None:
+        """Flush and drop the in-memory copy (used when a tenant shard is evicted).
+        The store reloads from disk if it's used again."""
+        self.flush()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not (self._dirty or self._cleared):
+                self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending_lag_ms = 0.0
+            if self._first_dirty_at is not None:
+                pending_lag_ms = round((time.time() - self._first_dirty_at) * 1000, 1)
+            return {
+                'mode': 'snapshot',
+                'path': self.path,
+                'entries': len(self._db) if self._db is not None else None,
+                'durability': self.durability,
+                'flush_interval_s': self.flush_interval,
+                'flush_threshold': self.flush_threshold,
+                'dirty': len(self._dirty),
+                'pending_flush_lag_ms': pending_lag_ms,
+                'compact_memory': self.compact_memory,
+                **(self._db.memory_stats() if isinstance(self._db, CompactTagTable) else {}),
+                **self._stats,
+            }
+
+
+class JournaledTagStore(TagStore):
+    """Log-structured tags DB: snapshot file plus an append-only JSONL journal.
+
+    Every write appends one record per photoID to the journal, so write cost no
+    longer depends on DB size. On load the snapshot is read and the journal is
+    replayed on top of it. A background thread compacts periodically: it
+    rotates the journal, writes a fresh snapshot atomically and then deletes
+    the rotated journal. Replaying records is idempotent, so a crash at any
+    point of a compaction recovers to the same state.
+
+    fsync policy:
+    - 'always': fsync after every write call (one fsync per batch)
+    - 'interval': fsync from the background thread every `flush_interval` seconds
+    - 'never': leave it to the OS
+    """
+
+    def __init__(self, path: str, fsync: str = 'interval', flush_interval: float = 2.0,
+                 compact_records: int = 100000, compact_interval: float = 300.0, compact_memory: bool = True):
+        super().__init__(path, durability='write-behind', flush_interval=flush_interval, compact_memory=compact_memory)
+        if fsync not in ('always', 'interval', 'never'):
+            raise ValueError(f"Invalid fsync policy: {fsync!r}. Use 'always', 'interval' or 'never'")
+        base, _ = os.path.splitext(path)
+        self.journal_path = base + '.journal.jsonl'
+        self.fsync = fsync
+        self.compact_records = compact_records
+        self.compact_interval = compact_interval
+
+        self._journal = None
+        self._journal_records = 0
+        self._unsynced = False
+        self._last_compact = time.time()
+        self._wake = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+        self._stats.update({
+            'replay_ms': 0.0,
+            'replayed_records': 0,
+            'compactions': 0,
+            'last_compact_ms': 0.0,
+            'fsyncs': 0,
+        })
+
+    # --- loading ---
+
+    def _ensure_loaded(self) -> Dict[str, Any]:
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    t0 = time.time()
+                    db = self._new_table(_read_tags_file(self.path))
+                    t1 = time.time()
+                    replayed = 0
+                    # A leftover rotated journal means a compaction was interrupted
+                    for jpath in (self.journal_path + '.compacting', self.journal_path):
+                        replayed += self._replay(jpath, db)
+                    self._stats['load_ms'] = round((t1 - t0) * 1000, 1)
+                    self._stats['replay_ms'] = round((time.time() - t1) * 1000, 1)
+                    self._stats['replayed_records'] = replayed
+                    self._journal_records = replayed
+                    self._journal = open(self.journal_path, 'a', encoding='utf-8')
+                    if self._journal.tell() > 0 and not self._ends_with_newline(self.journal_path):
+                        # Terminate a torn record so the next append starts on its own line
+                        self._journal.write('\n')
+                    self._db = db
+                    logger.info(f"Loaded {len(db)} tag entries from {self.path} in {self._stats['load_ms']}ms "
+                                f"(+{replayed} journal records in {self._stats['replay_ms']}ms)")
+                    self._start_worker()
+        return self._db
+
+    @staticmethod
+    def _replay(jpath: str, db: Dict[str, Any]) -> int:
+        if not os.path.exists(jpath):
+            return 0
+        count = 0
+        loads = json.loads
+        with open(jpath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = loads(line)
+                except ValueError:
+                    # Torn final line from a crash mid-append; everything before it is valid
+                    continue
+                op = rec.get('op')
+                if op == 'set':
+                    db[rec['id']] = rec['entry']
+                elif op == 'del':
+                    db.pop(rec['id'], None)
+                elif op == 'clear':
+                    db.clear()
+                count += 1
+        return count
+
+    @staticmethod
+    def _ends_with_newline(jpath: str) -> bool:
+        with open(jpath, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    # --- writes ---
+
+    def _append(self, records: List[Dict[str, Any]]) -> None:
+        # Caller holds self._lock
+        dumps = json.dumps
+        self._journal.write(''.join(dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n' for r in records))
+        self._journal.flush()
+        if self.fsync == 'always':
+            os.fsync(self._journal.fileno())
+            self._stats['fsyncs'] += 1
+        else:
+            self._unsynced = True
+        self._journal_records += len(records)
+        if self._first_dirty_at is None:
+            self._first_dirty_at = time.time()
+        if self._journal_records >= self.compact_records:
+            self._wake.set()
+
+    def put(self, photo_id: str, entry: Any) -> None:
+        self.put_many({photo_id: entry})
+
+    def put_many(self, entries: Dict[str, Any]) -> None:
+        if not entries:
+            return
+        with self._lock:
+            db = self._ensure_loaded()
+            self._append([{'op': 'set', 'id': k, 'entry': v} for k, v in entries.items()])
+            db.update(entries)
+
+    def pop(self, photo_id: str) -> Any:
+        with self._lock:
+            db = self._ensure_loaded()
+            entry = db.pop(photo_id, None)
+            if entry is not None:
+                self._append([{'op': 'del', 'id': photo_id}])
         return entry
-    return entry.get('tags', [])
 
+    def move(self, old_photo_id: str, new_photo_id: str, now: str) -> bool:
+        with self._lock:
+            db = self._ensure_loaded()
+            entry = self._rekey(db, old_photo_id, new_photo_id, now)
+            if entry is None:
+                return False
+            self._append([{'op': 'del', 'id': old_photo_id}, {'op': 'set', 'id': new_photo_id, 'entry': entry}])
+        return True
+
+    def replace_all(self, new_db: Dict[str, Any]) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            self._append([{'op': 'clear'}] + [{'op': 'set', 'id': k, 'entry': v} for k, v in new_db.items()])
+            self._db = self._new_table(new_db)
+        self.compact()
+
+    # --- persistence ---
+
+    def _sync_journal(self) -> None:
+        with self._lock:
+            if self._journal is not None and self._unsynced:
+                os.fsync(self._journal.fileno())
+                self._unsynced = False
+                self._stats['fsyncs'] += 1
+
+    def compact(self) -> bool:
+        """Write a fresh snapshot and drop the journal records it covers."""
+        with self._flush_lock:
+            with self._lock:
+                if self._db is None or self._journal_records == 0:
+                    return False
+                # Rotate: new writes go to a fresh journal while the snapshot is written
+                rotated = self.journal_path + '.compacting'
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._journal.close()
+                os.replace(self.journal_path, rotated)
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+                self._unsynced = False
+                data = self._db.copy()
+                compacted = self._journal_records
+                first_dirty_at = self._first_dirty_at
+                self._journal_records = 0
+                self._first_dirty_at = None
+
+            t0 = time.time()
+            try:
+                _write_tags_file(self.path, self._as_dict(data))
+                os.remove(rotated)
+            except Exception:
+                self._stats['flush_errors'] += 1
+                logger.exception(f"Failed to compact tags journal into {self.path}")
+                # The rotated journal is kept and replayed on next load; retry later
+                with self._lock:
+                    self._journal_records += compacted
+                    if self._first_dirty_at is None:
+                        self._first_dirty_at = first_dirty_at
+                return False
+            t1 = time.time()
+
+            self._last_compact = t1
+            self._stats['compactions'] += 1
+            self._stats['flush_count'] += 1
+            self._stats['last_flush_at'] = _now_iso()
+            self._stats['last_compact_ms'] = self._stats['last_flush_ms'] = round((t1 - t0) * 1000, 1)
+            self._stats['last_flush_entries'] = compacted
+            if first_dirty_at is not None:
+                lag_ms = round((t1 - first_dirty_at) * 1000, 1)
+                self._stats['max_flush_lag_ms'] = max(self._stats['max_flush_lag_ms'], lag_ms)
+            logger.info(f"Compacted {compacted} journal records into {self.path} in {self._stats['last_compact_ms']}ms")
+            return True
+
+    def flush(self) -> bool:
+        """Make every journaled write durable and fold the journal into the snapshot."""
+        self._sync_journal()
+        return self.compact()
+
+    def _start_worker(self) -> None:
+        if self._worker is None:
+            self._closed = False
+            self._worker = threading.Thread(target=self._background_loop, name='tags-db-compactor', daemon=True)
+            self._worker.start()
+
+    def _background_loop(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._closed:
+                break
+            try:
+                if self.fsync == 'interval':
+                    self._sync_journal()
+                due = time.time() - self._last_compact >= self.compact_interval
+                if self._journal_records >= self.compact_records or (due and self._journal_records):
+                    self.compact()
+            except Exception:
+                logger.exception('Tags DB background compaction failed')
+
+    def close(self) -> None:
+        self.flush()
+        self._closed = True
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+            self._worker = None
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        with self._lock:
+            data.update({
+                'mode': 'journal',
+                'journal_path': self.journal_path,
+                'journal_records': self._journal_records,
+                'fsync': self.fsync,
+                'compact_records': self.compact_records,
+                'compact_interval_s': self.compact_interval,
+                'dirty': self._journal_records,
+            })
+        return data
+
+
+class SQLiteTagStore(TagStore):
+    """Tags DB in SQLite (WAL mode), safe to share between worker processes.
+
+    Each process (and thread) keeps its own connection; every write is its own
+    short transaction, so concurrent `set_tags` calls from several uvicorn
+    workers or hosts on a shared volume never lose updates. WAL lets readers
+    run concurrently with the single active writer, so a write only blocks
+    other writes for the duration of its transaction. Entries are stored as
+    JSON text keyed by photoID, so the entry format matches the JSON stores.
+
+    On first use an existing tags_db.json is imported once (guarded by a meta
+    row so parallel workers don't import it twice).
+    """
+
+    def __init__(self, path: str, json_path: Optional[str] = None, durability: str = 'write-behind',
+                 busy_timeout: float = 30.0):
+        super().__init__(path, durability=durability)
+        self.json_path = json_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._initialized = False
+        self._stats.update({
+            'writes': 0,
+            'write_ms_total': 0.0,
+        })
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: we issue BEGIN/COMMIT ourselves
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=' + ('FULL' if self.durability == 'sync' else 'NORMAL'))
+            self._local.conn = conn
+        if not self._initialized:
+            self._initialize(conn)
+        return conn
 
-def set_tags(photo_id: str, tags: List[str], source: str = 'classifier', all_detections: List[str] = None) -> None:
-    db = _load_tags_db()
+    def _initialize(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if self._initialized:
+                return
+            t0 = time.time()
+            conn.execute('CREATE TABLE IF NOT EXISTS tags (photo_id TEXT PRIMARY KEY, entry TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            if self.json_path and os.path.exists(self.json_path):
+                with self._transaction(conn):
+                    done = conn.execute("SELECT value FROM meta WHERE key = 'imported_json'").fetchone()
+                    if done is None:
+                        legacy = _read_tags_file(self.json_path)
+                        conn.executemany('INSERT OR IGNORE INTO tags (photo_id, entry) VALUES (?, ?)',
+                                         ((k, json.dumps(v, ensure_ascii=False)) for k, v in legacy.items()))
+                        conn.execute("INSERT INTO meta (key, value) VALUES ('imported_json', ?)", (_now_iso(),))
+                        logger.info(f"Imported {len(legacy)} tag entries from {self.json_path} into {self.path}")
+            self._stats['load_ms'] = round((time.time() - t0) * 1000, 1)
+            self._initialized = True
+
+    @contextlib.contextmanager
+    def _transaction(self, conn: sqlite3.Connection):
+        # IMMEDIATE takes the write lock up front so read-modify-write sequences
+        # (pop/move) can't interleave with another process's writes.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _record_write(self, t0: float) -> None:
+        self._stats['writes'] += 1
+        self._stats['write_ms_total'] = round(self._stats['write_ms_total'] + (time.time() - t0) * 1000, 1)
+
+    # --- reads ---
+
+    def get(self, photo_id: str) -> Any:
+        row = self._conn().execute('SELECT entry FROM tags WHERE photo_id = ?', (photo_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_list(self, photo_id: str, field: str) -> Optional[List[str]]:
+        return _list_field(self.get(photo_id), field)
+
+    def snapshot(self) -> Dict[str, Any]:
+        rows = self._conn().execute('SELECT photo_id, entry FROM tags').fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def __len__(self) -> int:
+        return self._conn().execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+
+    def lookup(self, photo_ids: Iterable[str], fields: Tuple[str, ...]) -> Dict[str, Tuple]:
+        conn = self._conn()
+        ids = list(photo_ids)
+        found = {}
+        # Stay under SQLite's bound-parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(f"SELECT photo_id, entry FROM tags WHERE photo_id IN ({','.join('?' * len(chunk))})",
+                                chunk).fetchall()
+            for photo_id, raw in rows:
+                entry = json.loads(raw)
+                found[photo_id] = tuple(entry.get(f) if isinstance(entry, dict) else None for f in fields)
+        return found
+
+    def keys(self) -> List[str]:
+        return [row[0] for row in self._conn().execute('SELECT photo_id FROM tags')]
+
+    # --- writes ---
+
+    def put(self, photo_id: str, entry: Any) -> None:
+        self.put_many({photo_id: entry})
+
+    def put_many(self, entries: Dict[str, Any]) -> None:
+        if not entries:
+            return
+        conn = self._conn()
+        t0 = time.time()
+        with self._transaction(conn):
+            conn.executemany('INSERT OR REPLACE INTO tags (photo_id, entry) VALUES (?, ?)',
+                             ((k, json.dumps(v, ensure_ascii=False)) for k, v in entries.items()))
+        self._record_write(t0)
+
+    def pop(self, photo_id: str) -> Any:
+        conn = self._conn()
+        t0 = time.time()
+        with self._transaction(conn):
+            row = conn.execute('SELECT entry FROM tags WHERE photo_id = ?', (photo_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM tags WHERE photo_id = ?', (photo_id,))
+        self._record_write(t0)
+        return json.loads(row[0])
+
+    def move(self, old_photo_id: str, new_photo_id: str, now: str) -> bool:
+        conn = self._conn()
+        t0 = time.time()
+        with self._transaction(conn):
+            row = conn.execute('SELECT entry FROM tags WHERE photo_id = ?', (old_photo_id,)).fetchone()
+            if row is None:
+                return False
+            entry = json.loads(row[0])
+            if isinstance(entry, dict):
+                entry['last_updated'] = now
+            conn.execute('DELETE FROM tags WHERE photo_id = ?', (old_photo_id,))
+            conn.execute('INSERT OR REPLACE INTO tags (photo_id, entry) VALUES (?, ?)',
+                         (new_photo_id, json.dumps(entry, ensure_ascii=False)))
+        self._record_write(t0)
+        return True
+
+    def replace_all(self, new_db: Dict[str, Any]) -> None:
+        conn = self._conn()
+        t0 = time.time()
+        with self._transaction(conn):
+            conn.execute('DELETE FROM tags')
+            conn.executemany('INSERT INTO tags (photo_id, entry) VALUES (?, ?)',
+                             ((k, json.dumps(v, ensure_ascii=False)) for k, v in new_db.items()))
+        self._record_write(t0)
+
+    # --- persistence ---
+
+    def flush(self) -> bool:
+        # Every write is committed in its own transaction; nothing is pending.
+        return False
+
+    def close(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        # Other threads' connections are released with their thread-local slot
+        self._local = threading.local()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'mode': 'sqlite',
+            'path': self.path,
+            'entries': len(self),
+            'durability': self.durability,
+            'pid': os.getpid(),
+            'load_ms': self._stats['load_ms'],
+            'writes': self._stats['writes'],
+            'write_ms_total': self._stats['write_ms_total'],
+        }
+
+
+def _create_store(path: str) -> TagStore:
+    """Build the tag store configured in `config` (snapshot, journal or sqlite)."""
+    if _cfg.TAGS_DB_BACKEND == 'sqlite':
+        return SQLiteTagStore(
+            os.path.splitext(path)[0] + '.sqlite3',
+            json_path=path,
+            durability=_cfg.TAGS_DB_DURABILITY,
+        )
+    if _cfg.TAGS_DB_MODE == 'journal':
+        return JournaledTagStore(
+            path,
+            fsync=_cfg.TAGS_DB_JOURNAL_FSYNC,
+            flush_interval=_cfg.TAGS_DB_FLUSH_INTERVAL,
+            compact_records=_cfg.TAGS_DB_COMPACT_RECORDS,
+            compact_interval=_cfg.TAGS_DB_COMPACT_INTERVAL,
+            compact_memory=_cfg.TAGS_DB_COMPACT_MEMORY,
+        )
+    return TagStore(
+        path,
+        durability=_cfg.TAGS_DB_DURABILITY,
+        flush_interval=_cfg.TAGS_DB_FLUSH_INTERVAL,
+        flush_threshold=_cfg.TAGS_DB_FLUSH_THRESHOLD,
+        compact_memory=_cfg.TAGS_DB_COMPACT_MEMORY,
+    )
+
+
+_store = _create_store(TAGS_DB_PATH)
+
+# Per-tenant shards (device ID / upload token -> its own store file), created on
+# first use and closed again when idle or when too many are open.
+TAGS_DB_SHARDS_DIR = os.path.join(os.path.dirname(__file__), 'tags_db_shards')
+_shards: 'OrderedDict[str, TagStore]' = OrderedDict()
+_shard_last_used: Dict[str, float] = {}
+# Every shard store still referenced anywhere, open or evicted
+_shard_stores: 'weakref.WeakValueDictionary[str, TagStore]' = weakref.WeakValueDictionary()
+_shards_lock = threading.Lock()
+
+
+def _shard_path(tenant: str) -> str:
+    # Hash the tenant key: it may be an upload token and must not leak into file names
+    digest = hashlib.sha256(tenant.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(TAGS_DB_SHARDS_DIR, f'tags_db_{digest}.json')
+
+
+def _collect_evictions(now: float, keep: Optional[str] = None) -> List[TagStore]:
+    # Caller holds _shards_lock. Oldest-used shards come first in _shards.
+    evicted = []
+    for tenant in list(_shards):
+        if tenant == keep:
+            continue
+        idle = now - _shard_last_used.get(tenant, now) >= _cfg.TAGS_DB_SHARD_IDLE_SECONDS
+        over_budget = len(_shards) > _cfg.TAGS_DB_MAX_OPEN_SHARDS
+        if not (idle or over_budget):
+            break
+        evicted.append(_shards.pop(tenant))
+        _shard_last_used.pop(tenant, None)
+    return evicted
+
+
+def get_store(tenant: Optional[str] = None) -> TagStore:
+    """Return the tag store for `tenant` (the global store when tenant is None)."""
+    if not tenant:
+        return _store
+    now = time.time()
+    with _shards_lock:
+        store = _shards.get(tenant)
+        if store is None:
+            # A request may still hold an evicted shard: reopen that instance (it
+            # reloads lazily) rather than a second store over the same file
+            store = _shard_stores.get(tenant)
+            if store is None:
+                os.makedirs(TAGS_DB_SHARDS_DIR, exist_ok=True)
+                store = _shard_stores[tenant] = _create_store(_shard_path(tenant))
+            _shards[tenant] = store
+        else:
+            _shards.move_to_end(tenant)
+        _shard_last_used[tenant] = now
+        evicted = _collect_evictions(now, keep=tenant)
+    for old in evicted:
+        try:
+            old.close()
+        except Exception:
+            logger.exception(f"Failed to close evicted tags DB shard {old.path}")
+    return store
+
+
+def evict_idle_shards() -> int:
+    """Close shards that have been idle longer than TAGS_DB_SHARD_IDLE_SECONDS."""
+    with _shards_lock:
+        evicted = _collect_evictions(time.time())
+    for old in evicted:
+        old.close()
+    return len(evicted)
+
+
+def _flush_all() -> None:
+    _store.flush()
+    with _shards_lock:
+        # Evicted shards still held by a request may have taken writes since
+        shards = list(_shard_stores.values())
+    for shard in shards:
+        shard.flush()
+
+
+# Force pending writes out on interpreter exit (uvicorn shutdown also calls flush()).
+atexit.register(_flush_all)
+
+
+def _load_tags_db(tenant: Optional[str] = None) -> Dict[str, Any]:
+    """Return a snapshot of the whole tags DB (served from memory)."""
+    return get_store(tenant).snapshot()
+
+
+def _save_tags_db(db: Dict[str, Any], tenant: Optional[str] = None) -> None:
+    try:
+        get_store(tenant).replace_all(db)
+    except Exception:
+        # Best-effort only; don't crash
+        pass
+
+
+def flush() -> bool:
+    """Force pending tag writes to disk for every open store (call on shutdown)."""
+    wrote = _store.flush()
+    with _shards_lock:
+        shards = list(_shard_stores.values())
+    for shard in shards:
+        wrote = shard.flush() or wrote
+    evict_idle_shards()
+    return wrote
+
+
+def get_stats(tenant: Optional[str] = None) -> Dict[str, Any]:
+    """Cache and flush metrics: entries, dirty count, flush lag and timings."""
+    stats = get_store(tenant).stats()
+    with _shards_lock:
+        stats['open_shards'] = len(_shards)
+    return stats
+
+
+def get_tags(photo_id: str, tenant: Optional[str] = None) -> List[str]:
+    # Reads only the tag slice, without building the whole entry dict
+    return get_store(tenant).get_list(photo_id, 'tags') or []
+
+
+def current_model_version() -> str:
+    """Composite pipeline version stamped on new entries (see pipeline_version)."""
+    from . import pipeline_version
+    return pipeline_version.current_version()
+
+
+def _make_entry(tags: List[str], source: str, all_detections: Optional[List[str]], now: str,
+                content_hash: Optional[str] = None, model_version: Optional[str] = None) -> Dict[str, Any]:
     entry = {
         'tags': tags,
-        'last_updated': _now_iso(),
+        'last_updated': now,
         'source': source,
     }
     if all_detections:
         entry['all_detections'] = all_detections
-    db[photo_id] = entry
-    _save_tags_db(db)
+    entry['model_version'] = model_version or current_model_version()
+    if content_hash:
+        entry['content_hash'] = content_hash
+    return entry
+
+
+def set_tags(photo_id: str, tags: List[str], source: str = 'classifier', all_detections: List[str] = None,
+             tenant: Optional[str] = None, content_hash: Optional[str] = None) -> None:
+    get_store(tenant).put(photo_id, _make_entry(tags, source, all_detections, _now_iso(), content_hash))
+
+
+def set_tags_many(entries: Iterable[Tuple], source: str = 'classifier', tenant: Optional[str] = None,
+                  model_version: Optional[str] = None) -> int:
+    """Set tags for many photoIDs in one batch (one flush instead of one per photo).
 
+    Args:
+        entries: Iterable of (photo_id, tags[, all_detections[, content_hash]]) tuples.
+            Later entries win if a photoID repeats.
+        source: Source recorded on every entry.
+        tenant: Tenant shard to write to (None for the global store).
+        model_version: Pipeline version to stamp (default: the deployed pipeline's).
 
-def get_all_detections(photo_id: str) -> List[str]:
+    Returns:
+        Number of entries written.
+    """
+    now = _now_iso()
+    batch = {}
+    for item in entries:
+        photo_id, tags = item[0], item[1]
+        all_detections = item[2] if len(item) > 2 else None
+        content_hash = item[3] if len(item) > 3 else None
+        batch[photo_id] = _make_entry(tags, source, all_detections, now, content_hash, model_version)
+    get_store(tenant).put_many(batch)
+    return len(batch)
+
+
+def get_all_detections(photo_id: str, tenant: Optional[str] = None) -> List[str]:
     """Get all detections for a photo (detailed objects for search)."""
-    db = _load_tags_db()
-    entry = db.get(photo_id)
+    entry = get_store(tenant).get(photo_id)
     if not entry:
         return []
     if isinstance(entry, dict):
@@ -97,12 +1024,152 @@ def get_all_detections(photo_id: str) -> List[str]:
     return []
 
 
-def move_tags(old_photo_id: str, new_photo_id: str) -> None:
-    db = _load_tags_db()
-    if old_photo_id in db:
-        db[new_photo_id] = db.pop(old_photo_id)
-        # update last_updated when moved
-        entry = db.get(new_photo_id)
-        if isinstance(entry, dict):
-            entry['last_updated'] = _now_iso()
-        _save_tags_db(db)
+def move_tags(old_photo_id: str, new_photo_id: str, tenant: Optional[str] = None) -> None:
+    # update last_updated when moved
+    get_store(tenant).move(old_photo_id, new_photo_id, _now_iso())
+
+
+class ScanPlanTooLarge(ValueError):
+    """A /scan-plan/ body over SCAN_PLAN_MAX_BYTES (decompressed) or SCAN_PLAN_MAX_IDS photoIDs."""
+
+
+def parse_scan_request(body: bytes, gzipped: bool = False, max_bytes: Optional[int] = None,
+                       max_ids: Optional[int] = None) -> Tuple[List[str], Dict[str, str], Optional[str]]:
+    """Decode a /scan-plan/ request body.
+
+    Args:
+        body: JSON, or gzip-compressed JSON when `gzipped` or the gzip magic is present.
+        max_bytes: Cap on the (decompressed) JSON size (default SCAN_PLAN_MAX_BYTES).
+        max_ids: Cap on the number of photoIDs (default SCAN_PLAN_MAX_IDS).
+
+    Returns:
+        (photo_ids, content_hashes, model_version) for `plan_scan`.
+
+    Raises:
+        ScanPlanTooLarge: The body exceeds one of the caps.
+        ValueError: The body is not a valid scan plan request.
+    """
+    max_bytes = _cfg.SCAN_PLAN_MAX_BYTES if max_bytes is None else max_bytes
+    max_ids = _cfg.SCAN_PLAN_MAX_IDS if max_ids is None else max_ids
+    if gzipped or body[:2] == b'\x1f\x8b':
+        # Bounded inflate: a small gzip bomb must not expand past max_bytes
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = inflater.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise ValueError(f"invalid gzip body: {e}")
+        if len(data) > max_bytes or inflater.unconsumed_tail:
+            raise ScanPlanTooLarge(f"decompressed body exceeds {max_bytes} bytes")
+        if not inflater.eof:
+            raise ValueError('truncated gzip body')
+        body = data
+    elif len(body) > max_bytes:
+        raise ScanPlanTooLarge(f"body exceeds {max_bytes} bytes")
+    payload = json.loads(body)
+    if not isinstance(payload, dict):
+        raise ValueError('body must be a JSON object')
+    photo_ids = payload.get('photoIDs')
+    if not isinstance(photo_ids, list):
+        raise ValueError('photoIDs must be a JSON array')
+    if len(photo_ids) > max_ids:
+        raise ScanPlanTooLarge(f"{len(photo_ids)} photoIDs exceed the limit of {max_ids}")
+    photo_ids = [str(p) for p in photo_ids]
+    hashes = payload.get('contentHashes') or {}
+    if isinstance(hashes, list):
+        hashes = {pid: h for pid, h in zip(photo_ids, hashes) if h}
+    elif not isinstance(hashes, dict):
+        raise ValueError('contentHashes must be an object or array')
+    model_version = payload.get('modelVersion')
+    return photo_ids, hashes, str(model_version) if model_version is not None else None
+
+
+def plan_scan(photo_ids: List[str], content_hashes: Optional[Dict[str, str]] = None,
+              model_version: Optional[str] = None, tenant: Optional[str] = None) -> Dict[str, Any]:
+    """Diff a client's photoID list against the tags DB.
+
+    Args:
+        photo_ids: Every photoID the client knows about.
+        content_hashes: Optional photoID -> content hash. A photo is stale when
+            both sides have a hash and they differ.
+        model_version: Version the client wants tags from. When omitted, an
+            entry is stale only if the pipeline changed in a way that affects
+            it (see pipeline_version.impact). When passed explicitly, any other
+            version, or none recorded, counts as stale.
+        tenant: Tenant shard to check (None for the global store).
+
+    Returns:
+        Dict with `missing` and `stale` photoID lists (in request order) plus counts.
+    """
+    t0 = time.time()
+    strict = model_version is not None
+    wanted = model_version if strict else current_model_version()
+    content_hashes = content_hashes or {}
+    found = get_store(tenant).lookup(photo_ids, ('model_version', 'content_hash', 'tags'))
+    if not strict:
+        from . import pipeline_version
+
+    missing, stale = [], []
+    for photo_id in photo_ids:
+        fields = found.get(photo_id)
+        if fields is None:
+            missing.append(photo_id)
+            continue
+        version, stored_hash, tags = fields
+        client_hash = content_hashes.get(photo_id)
+        if strict:
+            outdated = version != wanted
+        else:
+            outdated = version is not None and version != wanted and pipeline_version.is_stale(version, tags)
+        if outdated or (client_hash and stored_hash and client_hash != stored_hash):
+            stale.append(photo_id)
+    return {
+        'missing': missing,
+        'stale': stale,
+        'requested': len(photo_ids),
+        'up_to_date': len(photo_ids) - len(missing) - len(stale),
+        'model_version': wanted,
+        'elapsed_ms': round((time.time() - t0) * 1000, 1),
+    }
+
+
+def find_stale(tenant: Optional[str] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+    """Find entries whose pipeline version changed in a way that affects their tags.
+
+    Args:
+        tenant: Tenant shard to check (None for the global store).
+        limit: Max photoIDs to return in `stale` (counts always cover everything).
+
+    Returns:
+        Dict with the current version and component digests, the stale
+        photoIDs, and a per-version breakdown of what changed.
+    """
+    from . import pipeline_version
+
+    t0 = time.time()
+    cur = pipeline_version.current()
+    store = get_store(tenant)
+    found = store.lookup(store.keys(), ('model_version', 'tags'))
+    stale = []
+    by_version: Dict[str, Dict[str, Any]] = {}
+    unversioned = 0
+    for photo_id, (version, tags) in found.items():
+        if version is None:
+            unversioned += 1
+            continue
+        info = by_version.get(version)
+        if info is None:
+            info = by_version[version] = {'entries': 0, 'stale': 0, 'impact': pipeline_version.impact(version)}
+        info['entries'] += 1
+        if pipeline_version.is_stale(version, tags):
+            info['stale'] += 1
+            stale.append(photo_id)
+    return {
+        'current_version': cur['version'],
+        'components': cur['components'],
+        'total': len(found),
+        'stale_count': len(stale),
+        'stale': stale[:limit] if limit is not None else stale,
+        'unversioned': unversioned,
+        'by_version': by_version,
+        'elapsed_ms': round((time.time() - t0) * 1000, 1),
+    }
@@ -0,0 +1,341 @@
+"""
+Columnar snapshot export/import for the tags DB.
+
+Backing up or analysing tags_db.json means parsing one big pretty-printed JSON
+document. A `.tagsnap` file stores the same data as flat, 64-byte aligned
+columns that can be memory-mapped and read with NumPy without parsing:
+
+    b'TAGSNAP1' | uint64 header length | JSON header | aligned column buffers
+
+Columns (N entries, S interned strings):
+- photo_id_offsets int64[N+1], photo_id_data uint8   (NUL-separated UTF-8)
+- string_offsets   int64[S+1], string_data   uint8   (tag/detection/source dictionary)
+- flags            uint8[N]   (which fields are present, see FLAG_*)
+- source_ids       int32[N]   (-1 = none)
+- timestamps       int64[N]   (last_updated, microseconds since epoch)
+- tag_offsets      int64[N+1], tag_ids int32[...]
+- det_offsets      int64[N+1], det_ids int32[...]  (all_detections)
+- extra_rows       int64[E],   extra_offsets int64[E+1], extra_data uint8
+  (JSON for anything that doesn't fit the columns, so round trips are lossless)
+
+Usage:
+    python -m backend.tags_snapshot export tags.tagsnap [--tenant TENANT]
+    python -m backend.tags_snapshot import tags.tagsnap [--tenant TENANT]
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .tag_table import NO_TIMESTAMP, CompactTagTable, _format_timestamp, _parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TAGSNAP1'
+ALIGN = 64
+
+FLAG_TAGS = 1
+FLAG_DETECTIONS = 2
+FLAG_TIMESTAMP = 4
+FLAG_SOURCE = 8
+FLAG_RAW = 16  # whole entry stored as JSON in the extras column
+
+
+def _pack_strings(values: List[str]):
+    """UTF-8 encode `values` into (offsets, data) with a NUL after each string."""
+    encoded = [v.encode('utf-8') + b'\x00' for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def _unpack_strings(offsets: np.ndarray, data: np.ndarray) -> List[str]:
+    if len(offsets) <= 1:
+        return []
+    text = data.tobytes().decode('utf-8')
+    parts = text.split('\x00')
+    if len(parts) - 1 == len(offsets) - 1:
+        return parts[:-1]
+    # A value contained a NUL itself; fall back to offset slicing
+    raw = data.tobytes()
+    return [raw[offsets[i]:offsets[i + 1] - 1].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def export_snapshot(db: Dict[str, Any], path: str) -> Dict[str, Any]:
+    """Write `db` (photoID -> entry) to `path` as a columnar snapshot. Returns summary info."""
+    t0 = time.time()
+    n = len(db)
+    string_ids: Dict[str, int] = {}
+    strings: List[str] = []
+
+    def intern(value: str) -> int:
+        sid = string_ids.get(value)
+        if sid is None:
+            sid = string_ids[value] = len(strings)
+            strings.append(value)
+        return sid
+
+    photo_ids = list(db.keys())
+    flags = np.zeros(n, dtype=np.uint8)
+    source_ids = np.full(n, -1, dtype=np.int32)
+    timestamps = np.zeros(n, dtype=np.int64)
+    tag_lens = np.zeros(n, dtype=np.int64)
+    det_lens = np.zeros(n, dtype=np.int64)
+    tag_ids: List[int] = []
+    det_ids: List[int] = []
+    extra_rows: List[int] = []
+    extra_blobs: List[str] = []
+
+    for i, photo_id in enumerate(photo_ids):
+        entry = db[photo_id]
+        if not isinstance(entry, dict):
+            flags[i] = FLAG_RAW
+            extra_rows.append(i)
+            extra_blobs.append(json.dumps(entry, ensure_ascii=False))
+            continue
+        f = 0
+        extras = {}
+        for key, value in entry.items():
+            if key in ('tags', 'all_detections') and isinstance(value, list) and all(isinstance(v, str) for v in value):
+                ids = [intern(v) for v in value]
+                if key == 'tags':
+                    tag_ids.extend(ids)
+                    tag_lens[i] = len(ids)
+                    f |= FLAG_TAGS
+                else:
+                    det_ids.extend(ids)
+                    det_lens[i] = len(ids)
+                    f |= FLAG_DETECTIONS
+            elif key == 'last_updated' and _parse_timestamp(value) is not None:
+                timestamps[i] = _parse_timestamp(value)
+                f |= FLAG_TIMESTAMP
+            elif key == 'source' and isinstance(value, str):
+                source_ids[i] = intern(value)
+                f |= FLAG_SOURCE
+            else:
+                extras[key] = value
+        if extras:
+            extra_rows.append(i)
+            extra_blobs.append(json.dumps(extras, ensure_ascii=False))
+        flags[i] = f
+
+    def offsets_from(lengths: np.ndarray) -> np.ndarray:
+        out = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=out[1:])
+        return out
+
+    photo_id_offsets, photo_id_data = _pack_strings(photo_ids)
+    string_offsets, string_data = _pack_strings(strings)
+    extra_offsets, extra_data = _pack_strings(extra_blobs)
+    columns = {
+        'photo_id_offsets': photo_id_offsets,
+        'photo_id_data': photo_id_data,
+        'string_offsets': string_offsets,
+        'string_data': string_data,
+        'flags': flags,
+        'source_ids': source_ids,
+        'timestamps': timestamps,
+        'tag_offsets': offsets_from(tag_lens),
+        'tag_ids': np.asarray(tag_ids, dtype=np.int32),
+        'det_offsets': offsets_from(det_lens),
+        'det_ids': np.asarray(det_ids, dtype=np.int32),
+        'extra_rows': np.asarray(extra_rows, dtype=np.int64),
+        'extra_offsets': extra_offsets,
+        'extra_data': extra_data,
+    }
+
+    # Lay out column buffers after the header, each aligned for mmap views
+    header = {'version': 1, 'count': n, 'columns': {}}
+    offset = 0
+    for name, arr in columns.items():
+        header['columns'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in columns.items():
+            f.seek(data_start + header['columns'][name]['offset'])
+            f.write(arr.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    info = {
+        'path': path,
+        'entries': n,
+        'strings': len(strings),
+        'bytes': os.path.getsize(path),
+        'export_ms': round((time.time() - t0) * 1000, 1),
+    }
+    logger.info(f"Exported tags snapshot: {info}")
+    return info
+
+
+class TagSnapshot:
+    """Memory-mapped view of a `.tagsnap` file. Columns are zero-copy NumPy arrays."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a tags snapshot")
+        (header_len,) = struct.unpack_from('<Q', self._mm, len(MAGIC))
+        header_end = len(MAGIC) + 8 + header_len
+        self.header = json.loads(self._mm[len(MAGIC) + 8:header_end].decode('utf-8'))
+        if self.header.get('version') != 1:
+            self.close()
+            raise ValueError(f"Unsupported tags snapshot version: {self.header.get('version')}")
+        data_start = -(-header_end // ALIGN) * ALIGN
+        self.columns: Dict[str, np.ndarray] = {}
+        for name, spec in self.header['columns'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape'])) if spec['shape'] else 1
+            self.columns[name] = np.frombuffer(self._mm, dtype=dtype, count=count,
+                                               offset=data_start + spec['offset']).reshape(spec['shape'])
+
+    def __len__(self) -> int:
+        return self.header['count']
+
+    def close(self) -> None:
+        self.columns = {}
+        try:
+            self._mm.close()
+        except (BufferError, ValueError):
+            # Still referenced by an outstanding array view; released with it
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def photo_ids(self) -> List[str]:
+        return _unpack_strings(self.columns['photo_id_offsets'], self.columns['photo_id_data'])
+
+    def strings(self) -> List[str]:
+        return _unpack_strings(self.columns['string_offsets'], self.columns['string_data'])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Materialize the snapshot as photoID -> entry dicts (same as tags_db.json)."""
+        c = self.columns
+        strings = self.strings()
+        photo_ids = self.photo_ids()
+        flags = c['flags'].tolist()
+        sources = c['source_ids'].tolist()
+        timestamps = c['timestamps'].tolist()
+        tag_off = c['tag_offsets'].tolist()
+        tag_ids = c['tag_ids'].tolist()
+        det_off = c['det_offsets'].tolist()
+        det_ids = c['det_ids'].tolist()
+        extras = dict(zip(c['extra_rows'].tolist(),
+                          (json.loads(x) for x in _unpack_strings(c['extra_offsets'], c['extra_data']))))
+
+        # Batched writes share one timestamp, so formatting is memoized
+        ts_cache: Dict[int, str] = {}
+        db: Dict[str, Any] = {}
+        for i, photo_id in enumerate(photo_ids):
+            f = flags[i]
+            if f & FLAG_RAW:
+                db[photo_id] = extras[i]
+                continue
+            entry: Dict[str, Any] = {}
+            if f & FLAG_TAGS:
+                entry['tags'] = [strings[j] for j in tag_ids[tag_off[i]:tag_off[i + 1]]]
+            if f & FLAG_TIMESTAMP:
+                ts = timestamps[i]
+                formatted = ts_cache.get(ts)
+                if formatted is None:
+                    formatted = ts_cache[ts] = _format_timestamp(ts)
+                entry['last_updated'] = formatted
+            if f & FLAG_SOURCE:
+                entry['source'] = strings[sources[i]]
+            if f & FLAG_DETECTIONS:
+                entry['all_detections'] = [strings[j] for j in det_ids[det_off[i]:det_off[i + 1]]]
+            if i in extras:
+                entry.update(extras[i])
+            db[photo_id] = entry
+        return db
+
+    def to_table(self) -> CompactTagTable:
+        """Load the snapshot straight into a CompactTagTable (no per-entry dicts)."""
+        c = self.columns
+        flags = c['flags']
+        extras = dict(zip(c['extra_rows'].tolist(),
+                          (json.loads(x) for x in _unpack_strings(c['extra_offsets'], c['extra_data']))))
+        raw_rows = np.flatnonzero(flags & FLAG_RAW).tolist()
+        timestamps = np.where(flags & FLAG_TIMESTAMP, c['timestamps'], NO_TIMESTAMP)
+        sources = np.where(flags & FLAG_SOURCE, c['source_ids'], -1)
+        return CompactTagTable.from_columns(
+            self.photo_ids(), self.strings(),
+            (flags & FLAG_TAGS).astype(bool).tolist(), c['tag_offsets'].tolist(), c['tag_ids'].tolist(),
+            (flags & FLAG_DETECTIONS).astype(bool).tolist(), c['det_offsets'].tolist(), c['det_ids'].tolist(),
+            timestamps.tolist(), sources.tolist(), extras=extras, raw_rows=raw_rows,
+        )
+
+
+def load_snapshot(path: str) -> Dict[str, Any]:
+    """Read a `.tagsnap` file into a photoID -> entry dict."""
+    with TagSnapshot(path) as snap:
+        return snap.to_dict()
+
+
+def export_tags_db(path: str, tenant: Optional[str] = None) -> Dict[str, Any]:
+    """Export the live tags DB (or a tenant shard) to `path`."""
+    from . import tags_db
+    return export_snapshot(tags_db._load_tags_db(tenant), path)
+
+
+def import_tags_db(path: str, tenant: Optional[str] = None) -> Dict[str, Any]:
+    """Replace the live tags DB (or a tenant shard) with the contents of `path`."""
+    from . import tags_db
+    t0 = time.time()
+    store = tags_db.get_store(tenant)
+    with TagSnapshot(path) as snap:
+        # Compact stores take the columns directly; others get plain dicts
+        db = snap.to_table() if getattr(store, 'compact_memory', False) else snap.to_dict()
+    t1 = time.time()
+    store.replace_all(db)
+    info = {
+        'path': path,
+        'entries': len(db),
+        'load_ms': round((t1 - t0) * 1000, 1),
+        'import_ms': round((time.time() - t0) * 1000, 1),
+    }
+    logger.info(f"Imported tags snapshot: {info}")
+    return info
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description="Export/import the tags DB as a columnar snapshot")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="Snapshot file (.tagsnap)")
+    parser.add_argument("--tenant", default=None, help="Tenant shard key (e.g. device:<id>); default: global DB")
+    args = parser.parse_args()
+    if args.command == "export":
+        print(export_tags_db(args.path, args.tenant))
+    else:
+        print(import_tags_db(args.path, args.tenant))
+        from . import tags_db
+        tags_db.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import importlib.metadata
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import backend
+from backend import autotune
+
+
+@pytest.fixture
+def host(tmp_path, monkeypatch):
+    monkeypatch.setattr(autotune._cfg, 'AUTOTUNE_FILE', str(tmp_path / 'autotune.json'))
+    monkeypatch.setattr(autotune._cfg, 'AUTOTUNE', 'apply')
+    # clip_switcher needs torch; the fingerprint only reads the classifier name
+    switcher = SimpleNamespace(DEFAULT_CLASSIFIER='mobileclip-s0')
+    monkeypatch.setitem(sys.modules, 'backend.clip_switcher', switcher)
+    monkeypatch.setattr(backend, 'clip_switcher', switcher, raising=False)
+    monkeypatch.delenv('CLIP_BATCH_SIZE', raising=False)
+    installed = {'torch': '2.3.1', 'ultralytics': '8.2.0'}
+
+    def version(name):
+        if name not in installed:
+            raise importlib.metadata.PackageNotFoundError(name)
+        return installed[name]
+
+    monkeypatch.setattr(autotune.importlib.metadata, 'version', version)
+    return installed
+
+
+def test_cli_and_server_startup_use_the_same_profile(host, monkeypatch):
+    # `python -m backend.autotune` fingerprints before any model library is imported
+    for name in ('torch', 'onnxruntime', 'ultralytics'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    cli = autotune.host_fingerprint()
+    autotune.save_profile(cli, {'CLIP_BATCH_SIZE': 16}, [])
+
+    # The server has imported them (with whatever __version__ they report) by startup
+    monkeypatch.setitem(sys.modules, 'torch', SimpleNamespace(__version__='2.3.1+cpu'))
+    monkeypatch.setitem(sys.modules, 'ultralytics', SimpleNamespace(__version__='8.2.0'))
+    monkeypatch.setattr(autotune._cfg, 'CLIP_BATCH_SIZE', 8, raising=False)
+    monkeypatch.setattr(autotune, 'apply_torch_threads', lambda *a, **k: None)
+
+    assert autotune.fingerprint_key(autotune.host_fingerprint()) == autotune.fingerprint_key(cli)
+    assert autotune.startup() == {'CLIP_BATCH_SIZE': 16}
+    assert cli['versions'] == {'torch': '2.3.1', 'ultralytics': '8.2.0'}
+
+
+def test_a_library_upgrade_changes_the_key(host):
+    before = autotune.fingerprint_key(autotune.host_fingerprint())
+    host['torch'] = '2.4.0'
+    assert autotune.fingerprint_key(autotune.host_fingerprint()) != before
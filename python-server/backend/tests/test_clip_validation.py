@@ -0,0 +1,70 @@
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import backend
+from backend import yolo_clip_hybrid as hybrid
+from backend.category_tags import match_expected, select_tags
+
+CATEGORIES = ["people", "animals", "food", "scenery", "document", "illustration"]
+# Full CLIP's tables (clip_model.py): batch classification is stricter on people
+SINGLE_THRESHOLDS = {"food": 0.80, "document": 0.70, "animals": 0.70, "people": 0.60, "scenery": 0.70,
+                     "illustration": 0.60}
+BATCH_THRESHOLDS = {**SINGLE_THRESHOLDS, "people": 0.80}
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    """clip_model's classify_image / classify_batch over fixed probabilities (the real ones need torch)."""
+    probs = {}
+
+    def classify_image(path, confidence_threshold=0.15, max_tags=1, expected_tags=None):
+        if expected_tags:
+            match = match_expected(probs[path], CATEGORIES, expected_tags, max_tags, "Other")
+            if match:
+                return [tag for tag, _ in match[1]]
+        return [tag for tag, _ in select_tags(probs[path], CATEGORIES, SINGLE_THRESHOLDS, max_tags, "Other",
+                                              confidence_threshold)[0]]
+
+    def classify_batch(paths, confidence_threshold=0.15, max_tags=1, scores_out=None):
+        if scores_out is not None:
+            scores_out.extend(probs[p] for p in paths)
+        return [[tag for tag, _ in row]
+                for row in select_tags(np.stack([probs[p] for p in paths]), CATEGORIES, BATCH_THRESHOLDS,
+                                       max_tags, "Other", confidence_threshold)]
+
+    switcher = SimpleNamespace(category_names_for=lambda name=None: CATEGORIES,
+                               category_thresholds_for=lambda name=None: SINGLE_THRESHOLDS,
+                               other_label_for=lambda name=None: "Other")
+    monkeypatch.setitem(sys.modules, 'backend.clip_switcher', switcher)
+    monkeypatch.setattr(backend, 'clip_switcher', switcher, raising=False)
+    return SimpleNamespace(probs=probs, classify_image=classify_image, classify_batch=classify_batch)
+
+
+def _without_timing(result):
+    return {k: v for k, v in result.items() if k != 'clip_time_ms'}
+
+
+@pytest.mark.parametrize('clip_threshold', [0.5, 0.7])
+def test_batch_validation_matches_the_per_image_path(classifier, clip_threshold):
+    rng = np.random.default_rng(5)
+    paths, yolo_tags = [], []
+    for i in range(400):
+        probs = rng.dirichlet(np.ones(len(CATEGORIES)) * 0.4).astype(np.float32)
+        if i % 3 == 0:
+            # People between the single-image and batch thresholds
+            probs = np.full(len(CATEGORIES), 0.0, dtype=np.float32)
+            probs[0] = rng.uniform(0.6, 0.8)
+            probs[1 + rng.integers(len(CATEGORIES) - 1)] = 1 - probs[0]
+        path = f"img{i}.jpg"
+        classifier.probs[path] = probs
+        paths.append(path)
+        yolo_tags.append(sorted(set(rng.choice(CATEGORIES[:5], int(rng.integers(1, 3))))))
+
+    got = hybrid.validate_batch_with_clip(paths, yolo_tags, classifier.classify_batch, clip_threshold)
+    expected = [hybrid.validate_yolo_with_clip(p, y, classifier.classify_image, clip_threshold)
+                for p, y in zip(paths, yolo_tags)]
+    assert [_without_timing(r) for r in got] == [_without_timing(r) for r in expected]
+    assert any(r['clip_tags'] == ['people'] and classifier.probs[p][0] < 0.8 for r, p in zip(got, paths))
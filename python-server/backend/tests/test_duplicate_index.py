@@ -0,0 +1,101 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from backend import duplicate_index, tags_db
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(tags_db, 'TAGS_DB_SHARDS_DIR', str(tmp_path))
+    monkeypatch.setattr(tags_db, '_shards', OrderedDict())
+    monkeypatch.setattr(tags_db, '_shard_last_used', {})
+    monkeypatch.setattr(tags_db, '_shard_stores', tags_db.weakref.WeakValueDictionary())
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_BACKEND', 'json')
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_MODE', 'snapshot')
+    monkeypatch.setattr(duplicate_index._cfg, 'DUPLICATE_HASHES_ENABLED', True)
+    monkeypatch.setattr(duplicate_index, '_stores', OrderedDict())
+    monkeypatch.setattr(duplicate_index, '_held', duplicate_index.weakref.WeakValueDictionary())
+
+
+def _flip(rng, value, bits):
+    for bit in rng.choice(64, bits, replace=False):
+        value ^= 1 << int(bit)
+    return value
+
+
+def _library(rng, n):
+    """Random hashes plus near copies at every distance, some of them chained."""
+    hashes = [int(h) for h in rng.integers(0, 2 ** 64, size=n, dtype=np.uint64)]
+    for _ in range(n // 2):
+        base = hashes[int(rng.integers(len(hashes)))]
+        hashes.append(_flip(rng, base, int(rng.integers(0, 13))))
+    return np.array(hashes, dtype=np.uint64)
+
+
+def _brute_force_pairs(hashes, max_distance):
+    pairs = {}
+    values = [int(h) for h in hashes]
+    for a in range(len(values)):
+        for b in range(a + 1, len(values)):
+            d = bin(values[a] ^ values[b]).count('1')
+            if d <= max_distance:
+                pairs[(a, b)] = d
+    return pairs
+
+
+def _brute_force_groups(n, pairs):
+    neighbours = {}
+    for a, b in pairs:
+        neighbours.setdefault(a, set()).add(b)
+        neighbours.setdefault(b, set()).add(a)
+    seen, groups = set(), []
+    for start in sorted(neighbours):
+        if start in seen:
+            continue
+        group, todo = set(), [start]
+        while todo:
+            x = todo.pop()
+            if x not in group:
+                group.add(x)
+                todo.extend(neighbours[x] - group)
+        seen |= group
+        groups.append(sorted(group))
+    return sorted(groups, key=lambda g: (-len(g), g[0]))
+
+
+@pytest.mark.parametrize('max_distance', range(12))
+def test_near_pairs_matches_brute_force(max_distance):
+    hashes = _library(np.random.default_rng(max_distance), 400)
+    i, j, distance = duplicate_index.near_pairs(hashes, max_distance)
+
+    got = dict(zip(zip(i.tolist(), j.tolist()), distance.tolist()))
+    assert len(got) == len(i)
+    assert got == _brute_force_pairs(hashes, max_distance)
+
+
+@pytest.mark.parametrize('max_distance', [0, 6, 11])
+def test_find_duplicates_groups_match_brute_force(shards, max_distance):
+    rng = np.random.default_rng(21)
+    hashes = _library(rng, 300)
+    # Exact copies, so distance 0 has groups to find
+    hashes = np.concatenate([hashes, hashes[rng.integers(len(hashes), size=40)]])
+    photo_ids = [f"p{x}" for x in range(len(hashes))]
+    duplicate_index.record_hashes({pid: (0, int(h)) for pid, h in zip(photo_ids, hashes)}, tenant='t')
+
+    result = duplicate_index.find_duplicates('t', max_distance=max_distance)
+    pairs = _brute_force_pairs(hashes, max_distance)
+    expected = [[photo_ids[x] for x in group] for group in _brute_force_groups(len(hashes), pairs)]
+    assert result['pairs'] == len(pairs)
+    assert result['groups'] == expected
+    assert expected
+    if max_distance == 0:
+        assert all(len({int(hashes[photo_ids.index(pid)]) for pid in group}) == 1 for group in result['groups'])
+
+
+def test_find_duplicates_rejects_bad_arguments(shards):
+    with pytest.raises(ValueError):
+        duplicate_index.find_duplicates('t', max_distance=12)
+    with pytest.raises(ValueError):
+        duplicate_index.find_duplicates('t', kind='ahash')
@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+from backend import embedding_store
+from backend.ann_index import IVFPQIndex
+from backend.embedding_store import EmbeddingStore
+
+DIM = 32
+
+
+def _normalized(x):
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def _clustered(rng, n, clusters=40):
+    centers = rng.standard_normal((clusters, DIM))
+    return _normalized(centers[rng.integers(clusters, size=n)] + 0.3 * rng.standard_normal((n, DIM)))
+
+
+def _brute_force(store, query, k):
+    ids = list(store._ids)
+    matrix = np.stack([store.get(photo_id) for photo_id in ids])
+    scores = matrix @ query
+    return [ids[i] for i in np.argsort(-scores, kind='stable')[:k]]
+
+
+@pytest.fixture
+def index_everything(monkeypatch):
+    monkeypatch.setattr(embedding_store._cfg, 'ANN_INDEX_ENABLED', True)
+    monkeypatch.setattr(embedding_store._cfg, 'ANN_INDEX_MIN_ROWS', 0)
+    monkeypatch.setattr(embedding_store._cfg, 'ANN_INDEX_PQ_M', 8)
+    monkeypatch.setattr(embedding_store._cfg, 'ANN_INDEX_NPROBE', 8)
+    monkeypatch.setattr(embedding_store._cfg, 'ANN_INDEX_RERANK', 10)
+
+
+def test_overwrite_flush_and_reload(tmp_path):
+    rng = np.random.default_rng(3)
+    base = str(tmp_path / 'emb')
+    store = EmbeddingStore(base, DIM, 'model')
+    model = {}
+    # Enough rows to grow the memmap past its initial capacity
+    for _ in range(40):
+        ids = [f"p{i}" for i in rng.integers(0, 1500, size=100)]
+        ids = list(dict.fromkeys(ids))
+        vectors = _normalized(rng.standard_normal((len(ids), DIM)))
+        store.add_many(ids, vectors)
+        model.update(zip(ids, vectors.astype(np.float16).astype(np.float32)))
+
+    def check(s):
+        assert len(s) == len(model)
+        for photo_id, vector in model.items():
+            np.testing.assert_array_equal(s.get(photo_id), vector)
+        assert s.get('missing') is None
+
+    check(store)
+    store.flush()
+    check(EmbeddingStore(base, DIM, 'model'))
+    # A store for another model or dimension does not reuse the rows
+    assert len(EmbeddingStore(base, DIM, 'other-model')) == 0
+
+
+def test_exact_search_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(5)
+    store = EmbeddingStore(str(tmp_path / 'emb'), DIM, 'model')
+    vectors = _clustered(rng, 3000)
+    store.add_many([f"p{i}" for i in range(len(vectors))], vectors)
+    for query in _clustered(rng, 20):
+        # Small blocks exercise the block boundaries
+        got = store.search_exact(query, k=10, block_rows=257)
+        assert [photo_id for photo_id, _ in got] == _brute_force(store, query, 10)
+        assert all(a[1] >= b[1] for a, b in zip(got, got[1:]))
+
+
+def _recall(store, queries, k=10):
+    hits = 0
+    for query in queries:
+        approx = {photo_id for photo_id, _ in store.search(query, k)}
+        hits += len(approx & {photo_id for photo_id, _ in store.search(query, k, exact=True)})
+    return hits / (k * len(queries))
+
+
+def test_index_recall_against_exact_search(tmp_path, index_everything):
+    rng = np.random.default_rng(9)
+    store = EmbeddingStore(str(tmp_path / 'emb'), DIM, 'model')
+    vectors = _clustered(rng, 4000)
+    store.add_many([f"p{i}" for i in range(len(vectors))], vectors)
+    store.build_index(nlist=32)
+    assert store.uses_index()
+    queries = _clustered(rng, 30)
+
+    assert _recall(store, queries) >= 0.9
+    # Scores come from the stored rows, not the PQ approximation
+    for photo_id, score in store.search(queries[0], 5):
+        assert score == pytest.approx(float(store.get(photo_id) @ queries[0]), abs=1e-5)
+
+
+def test_index_reload_covers_rows_added_after_its_save(tmp_path, index_everything):
+    rng = np.random.default_rng(13)
+    base = str(tmp_path / 'emb')
+    store = EmbeddingStore(base, DIM, 'model')
+    vectors = _clustered(rng, 3000)
+    store.add_many([f"p{i}" for i in range(2500)], vectors[:2500])
+    store.build_index(nlist=16)
+    # Appended and overwritten rows after the index was saved, flushed without it
+    store.add_many([f"p{i}" for i in range(2500, 3000)], vectors[2500:])
+    store.add_many(['p0'], vectors[2999:])
+    store.flush(index=False)
+    queries = _clustered(rng, 20)
+    before = [store.search(q, 10) for q in queries]
+
+    reloaded = EmbeddingStore(base, DIM, 'model')
+    assert reloaded.index_stats()['covered_rows'] == 3000
+    assert reloaded.index_stats()['entries'] == 3000
+    assert [reloaded.search(q, 10) for q in queries] == before
+    assert reloaded.search(vectors[2999], 2)[0][1] == pytest.approx(1.0, abs=1e-3)
+
+
+def test_index_save_and_load_round_trip(tmp_path):
+    rng = np.random.default_rng(17)
+    vectors = _clustered(rng, 2000)
+    index = IVFPQIndex(DIM, 16, 8)
+    index.train(vectors)
+    index.add(np.arange(len(vectors)), vectors)
+    base = str(tmp_path / 'idx')
+    index.save(base)
+    index.save(base)  # a second generation replaces the first
+
+    loaded = IVFPQIndex.load(base)
+    assert loaded.generation == 2 and len(loaded) == len(index)
+    for query in vectors[:10]:
+        rows, scores = index.search(query, 10, nprobe=4)
+        got_rows, got_scores = loaded.search(query, 10, nprobe=4)
+        np.testing.assert_array_equal(np.sort(got_rows), np.sort(rows))
+        np.testing.assert_allclose(np.sort(got_scores), np.sort(scores), rtol=1e-6)
+    assert not any('.ivfpq.1.' in p.name for p in tmp_path.iterdir())
@@ -0,0 +1,146 @@
+import sys
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from backend import embedding_store, photo_clusters, tags_db
+from backend.photo_clusters import PhotoClusters
+
+DIM = 16
+WINDOW = 10.0
+MIN_SIMILARITY = 0.9
+
+
+def _normalized(x):
+    return (x / np.linalg.norm(x, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def _library(rng, n):
+    """Bursts of near-identical shots plus unrelated photos, some without a time."""
+    embeddings, times = {}, {}
+    t = 1.7e9
+    while len(embeddings) < n:
+        t += float(rng.exponential(40.0))
+        base = rng.standard_normal(DIM)
+        for _ in range(int(rng.integers(1, 6))):
+            photo_id = f"p{len(embeddings)}"
+            embeddings[photo_id] = _normalized(base + float(rng.choice([0.1, 0.5])) * rng.standard_normal(DIM))
+            times[photo_id] = None if rng.random() < 0.05 else t + float(rng.uniform(0, 2 * WINDOW))
+    return embeddings, times
+
+
+def _brute_force_groups(embeddings, times):
+    ids = list(embeddings)
+    parent = {pid: pid for pid in ids}
+
+    def find(x):
+        while parent[x] != x:
+            x = parent[x]
+        return x
+
+    for a in ids:
+        for b in ids:
+            if a < b and times[a] is not None and times[b] is not None \
+                    and abs(times[a] - times[b]) <= WINDOW and embeddings[a] @ embeddings[b] >= MIN_SIMILARITY:
+                parent[find(a)] = find(b)
+    groups = {}
+    for pid in ids:
+        groups.setdefault(find(pid), set()).add(pid)
+    return sorted(sorted(g) for g in groups.values() if len(g) >= 2)
+
+
+def _add_in_batches(clusters, rng, embeddings, times, batch_size=7):
+    ids = list(embeddings)
+    rng.shuffle(ids)  # arrival order differs from capture order
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        clusters.add_many({pid: (embeddings[pid], times[pid]) for pid in batch}, embeddings.get)
+
+
+def _groups(clusters):
+    return sorted(sorted(g['photoIDs']) for g in clusters.groups())
+
+
+def test_groups_match_brute_force(tmp_path):
+    rng = np.random.default_rng(4)
+    embeddings, times = _library(rng, 400)
+    clusters = PhotoClusters(str(tmp_path / 'c.npz'), WINDOW, MIN_SIMILARITY, max_neighbors=1000)
+    _add_in_batches(clusters, rng, embeddings, times)
+
+    expected = _brute_force_groups(embeddings, times)
+    assert expected
+    assert _groups(clusters) == expected
+    for group in clusters.groups():
+        captured = [times[pid] for pid in group['photoIDs']]
+        assert captured == sorted(captured)
+        assert (group['start'], group['end']) == (captured[0], captured[-1])
+
+
+def test_only_the_closest_neighbors_in_time_are_compared(tmp_path):
+    same = _normalized(np.ones(DIM))
+    clusters = PhotoClusters(str(tmp_path / 'c.npz'), WINDOW, MIN_SIMILARITY, max_neighbors=2)
+    clusters.add_many({'a': (same, 100.0), 'b': (same, 108.0), 'c': (same, 109.0)}, lambda pid: same)
+    # d sees a, b and c in its window but only compares b and c (closest in time)
+    assert clusters.add_many({'d': (same, 109.5)}, lambda pid: same) == 2
+    # Across slot boundaries, and at exactly the window
+    assert clusters.add_many({'e': (same, 119.5)}, lambda pid: same) == 1
+    assert clusters.add_many({'f': (same, 129.6)}, lambda pid: same) == 0
+
+
+def test_groups_survive_a_reload(tmp_path):
+    rng = np.random.default_rng(8)
+    embeddings, times = _library(rng, 200)
+    path = str(tmp_path / 'c.npz')
+    clusters = PhotoClusters(path, WINDOW, MIN_SIMILARITY, max_neighbors=1000)
+    first = dict(list(embeddings.items())[:100])
+    _add_in_batches(clusters, rng, first, times)
+    assert clusters.flush()
+    assert not clusters.flush()
+
+    reloaded = PhotoClusters(path, WINDOW, MIN_SIMILARITY, max_neighbors=1000)
+    assert len(reloaded) == 100 and _groups(reloaded) == _groups(clusters)
+    # The rebuilt timeline links later photos to the reloaded ones
+    _add_in_batches(reloaded, rng, dict(list(embeddings.items())[100:]), times)
+    assert _groups(reloaded) == _brute_force_groups(embeddings, times)
+
+
+@pytest.fixture
+def shard(tmp_path, monkeypatch):
+    monkeypatch.setattr(tags_db, 'TAGS_DB_SHARDS_DIR', str(tmp_path))
+    monkeypatch.setattr(tags_db, '_shards', OrderedDict())
+    monkeypatch.setattr(tags_db, '_shard_last_used', {})
+    monkeypatch.setattr(tags_db, '_shard_stores', tags_db.weakref.WeakValueDictionary())
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_BACKEND', 'json')
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_MODE', 'snapshot')
+    monkeypatch.setattr(photo_clusters._cfg, 'SIMILAR_GROUPS_ENABLED', True)
+    monkeypatch.setattr(photo_clusters._cfg, 'SEMANTIC_SEARCH_ENABLED', True)
+    for module, name in ((photo_clusters, '_clusters'), (embedding_store, '_stores')):
+        monkeypatch.setattr(module, name, OrderedDict())
+        monkeypatch.setattr(module, '_held', module.weakref.WeakValueDictionary())
+    # The classifiers need torch; only their names and embedding spaces matter here
+    loaded = []
+    models = {'deployed': SimpleNamespace(embedding_dim=DIM, model_id='deployed-model'),
+              'other': SimpleNamespace(embedding_dim=DIM, model_id='other-model')}
+
+    def get_classifier(name=None):
+        loaded.append(name or 'deployed')
+        return models[name or 'deployed']
+
+    monkeypatch.setitem(sys.modules, 'backend.clip_switcher',
+                        SimpleNamespace(DEFAULT_CLASSIFIER='deployed', get_classifier=get_classifier))
+    return loaded
+
+
+def test_record_photos_only_groups_the_deployed_classifiers_embeddings(shard):
+    same = _normalized(np.ones(DIM))
+    batch = {'a': same, 'b': same}
+    captured = {'a': 100.0, 'b': 101.0}
+    embedding_store.record_embeddings(batch, tenant='t', classifier_name='other')
+    photo_clusters.record_photos(batch, captured, tenant='t', classifier_name='other')
+    assert shard == ['other'] and len(photo_clusters.get_clusters('t')) == 0
+
+    embedding_store.record_embeddings(batch, tenant='t', classifier_name='deployed')
+    photo_clusters.record_photos(batch, captured, tenant='t', classifier_name='deployed')
+    assert photo_clusters.similar_groups('t')['groups'][0]['photoIDs'] == ['a', 'b']
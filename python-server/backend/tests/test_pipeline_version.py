@@ -0,0 +1,48 @@
+import pytest
+
+from backend import category_tags, pipeline_version
+
+
+def _description():
+    return {
+        'classifier': {'backend': 'onnx-s0', 'model': 'mobileclip_s0', 'epoch': 1},
+        'prompts': {'people': 'a photo of people', 'food': 'a photo of food'},
+        'thresholds': {'single': {'people': 0.6}, 'batch': {'people': 0.6}},
+        'rules': {**category_tags.describe(), 'other_label': 'other'},
+        'yolo': {'enabled': False},
+    }
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline_version, 'PIPELINE_VERSIONS_PATH', str(tmp_path / 'pipeline_versions.json'))
+    monkeypatch.setattr(pipeline_version, '_registry', None)
+    monkeypatch.setattr(pipeline_version, '_current', {})
+    monkeypatch.setattr(pipeline_version, '_impact_cache', {})
+    monkeypatch.setattr(pipeline_version, 'describe_pipeline', lambda classifier_name=None: _description())
+
+
+def _reset_current(monkeypatch):
+    monkeypatch.setattr(pipeline_version, '_current', {})
+    monkeypatch.setattr(pipeline_version, '_impact_cache', {})
+
+
+def test_rules_change_moves_version_and_needs_full_retag(registry, monkeypatch):
+    old = pipeline_version.current_version()
+    monkeypatch.setattr(category_tags, 'ILLUSTRATION_FOOD_CUTOFF', 0.5)
+    _reset_current(monkeypatch)
+
+    assert pipeline_version.current_version() != old
+    info = pipeline_version.impact(old)
+    assert info['changed'] == ['rules']
+    assert info['all']
+
+
+def test_versions_recorded_without_rules_match_the_legacy_rules(registry, monkeypatch):
+    legacy = _description()
+    del legacy['rules']
+    pipeline_version._register('plegacy', legacy)
+
+    info = pipeline_version.impact('plegacy')
+    assert info['changed'] == []
+    assert not info['all']
@@ -0,0 +1,173 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from backend import yolo_clip_hybrid as hybrid
+from backend.category_tags import select_tags
+from backend.retag import compute_tags
+from backend.score_store import ScoreStore
+
+CATEGORIES = ["people", "animals", "food", "scenery", "document", "illustration"]
+THRESHOLDS = {"food": 0.80, "document": 0.70, "animals": 0.70, "people": 0.80, "scenery": 0.70,
+              "illustration": 0.60}
+CLASSES = [0, 14, 15, 16, 46, 53, 55, 73, 56, 62]  # mapped classes plus two unmapped (chair, tv)
+
+
+def _yolo_description():
+    mapping = {}
+    for class_id, category in hybrid.YOLO_TO_CATEGORY.items():
+        mapping.setdefault(category, []).append(class_id)
+    return {
+        'enabled': True,
+        'mapping': mapping,
+        'min_box_percent': hybrid.MIN_BOX_PERCENT,
+        'min_person_percent': hybrid.MIN_PERSON_PERCENT,
+        'min_confidence': {
+            'people': hybrid.PEOPLE_MIN_CONFIDENCE,
+            'animals': hybrid.ANIMAL_MIN_CONFIDENCE,
+            'food': hybrid.FOOD_RELATED_MIN_CONFIDENCE,
+            'document': hybrid.YOLO_MIN_CONFIDENCE,
+        },
+    }
+
+
+def _yolo_result(dets):
+    """Minimal ultralytics-style result on a 1x1 image, so box fraction == box area."""
+    boxes = [SimpleNamespace(cls=[int(c)], conf=[float(conf)], xyxy=[[0.0, 0.0, float(box), 1.0]])
+             for c, conf, box in dets]
+    return SimpleNamespace(boxes=boxes, orig_shape=(1, 1), names={c: f"class_{c}" for c in range(80)})
+
+
+def _edge_values(rng, size, edges):
+    # Mix random values with float16 values at and just below each threshold
+    at = np.array(sorted(edges), dtype=np.float16)
+    below = np.nextafter(at, np.float16(0))
+    pool = np.concatenate([at, below]).astype(np.float32)
+    values = rng.random(size).astype(np.float16).astype(np.float32)
+    mask = rng.random(size) < 0.3
+    values[mask] = rng.choice(pool, mask.sum())
+    return values
+
+
+def _random_library(rng, n):
+    records = {}
+    edges = list(THRESHOLDS.values()) + [0.40]
+    conf_edges = list(_yolo_description()['min_confidence'].values())
+    box_edges = [hybrid.MIN_BOX_PERCENT, hybrid.MIN_PERSON_PERCENT]
+    for i in range(n):
+        kind = rng.integers(4)
+        probs = None
+        if kind != 0:
+            probs = rng.dirichlet(np.ones(len(CATEGORIES)) * 0.3).astype(np.float32)
+            if rng.random() < 0.5:
+                probs = _edge_values(rng, len(CATEGORIES), edges)
+        dets = None
+        if kind != 1:
+            k = int(rng.integers(0, 5))
+            dets = np.stack([rng.choice(CLASSES, k).astype(np.float32),
+                             _edge_values(rng, k, conf_edges),
+                             _edge_values(rng, k, box_edges)], axis=1)
+            if k >= 2 and rng.random() < 0.2:
+                # Same weighted score in two categories: priority must decide
+                dets[1, 1:] = dets[0, 1:]
+        if probs is None and dets is None:
+            probs = rng.dirichlet(np.ones(len(CATEGORIES))).astype(np.float32)
+        records[f"p{i}"] = (probs, dets)
+    return records
+
+
+def _reference(probs, dets, max_tags, yolo):
+    """Tags as the classifiers' batch path and map_yolo_detections_to_categories give them."""
+    if yolo and dets is not None:
+        tags, _ = hybrid.map_yolo_detections_to_categories(_yolo_result(dets))
+        if tags:
+            return tags[:max_tags]
+    if probs is None:
+        return None
+    return [tag for tag, _ in select_tags(probs, CATEGORIES, THRESHOLDS, max_tags, "other")[0]]
+
+
+@pytest.mark.parametrize('hybrid_mode', [False, True])
+@pytest.mark.parametrize('max_tags', [1, 3])
+def test_compute_tags_matches_the_per_photo_path(tmp_path, hybrid_mode, max_tags):
+    rng = np.random.default_rng(7)
+    store = ScoreStore(str(tmp_path / 'scores.npz'), CATEGORIES)
+    records = _random_library(rng, 3000)
+    store.put_many(records)
+    yolo = _yolo_description() if hybrid_mode else None
+
+    arrays = store.arrays()
+    got = compute_tags(arrays, CATEGORIES, THRESHOLDS, max_tags, "other", yolo)
+    for photo_id, tags in zip(arrays['photo_ids'], got):
+        # Compare against what the store kept (float16), as retag only ever sees that
+        probs, dets = store.get(photo_id)
+        assert tags == _reference(probs, dets, max_tags, hybrid_mode), photo_id
+
+
+def test_person_size_floor_and_priority():
+    yolo = _yolo_description()
+    # Smallest float16 box fraction at or above the person floor, and the one below it
+    floor = np.float16(hybrid.MIN_PERSON_PERCENT)
+    if float(floor) < hybrid.MIN_PERSON_PERCENT:
+        floor = np.nextafter(floor, np.float16(1))
+    below = np.float32(np.nextafter(floor, np.float16(0)))
+    floor = np.float32(floor)
+    cases = {
+        # A small person still counts (person floor is below the object floor)...
+        'small-person': np.array([[0, 0.9, floor]], dtype=np.float32),
+        # ...but not below it
+        'tiny-person': np.array([[0, 0.9, below]], dtype=np.float32),
+        # A bigger, more confident cat loses to a person on priority
+        'cat-and-person': np.array([[15, 0.99, 0.9], [0, 0.6, 0.3]], dtype=np.float32),
+        'unmapped-only': np.array([[56, 0.99, 0.9]], dtype=np.float32),
+    }
+    arrays = {
+        'probs': np.full((len(cases), len(CATEGORIES)), np.nan, dtype=np.float32),
+        'has_yolo': np.ones(len(cases), dtype=bool),
+        'det_row': np.concatenate([np.full(len(d), i) for i, d in enumerate(cases.values())]),
+        'det_class': np.concatenate([d[:, 0] for d in cases.values()]).astype(np.int64),
+        'det_conf': np.concatenate([d[:, 1] for d in cases.values()]),
+        'det_box': np.concatenate([d[:, 2] for d in cases.values()]),
+    }
+    got = dict(zip(cases, compute_tags(arrays, CATEGORIES, THRESHOLDS, 1, "other", yolo)))
+    assert got == {'small-person': ['people'], 'tiny-person': None, 'cat-and-person': ['people'],
+                   'unmapped-only': None}
+    for name, dets in cases.items():
+        assert (got[name] or []) == hybrid.map_yolo_detections_to_categories(_yolo_result(dets))[0]
+
+
+def test_score_store_overwrite_compaction_and_reload(tmp_path):
+    rng = np.random.default_rng(11)
+    path = str(tmp_path / 'scores.npz')
+    store = ScoreStore(path, CATEGORIES)
+    model = {}
+    for _ in range(300):
+        batch = _random_library(rng, int(rng.integers(1, 20)))
+        # Re-key into a small ID space so most puts overwrite earlier rows
+        batch = {f"p{rng.integers(200)}": v for v in batch.values()}
+        store.put_many(batch)
+        model.update(batch)
+
+    def check(s):
+        assert len(s) == len(model)
+        for photo_id, (probs, dets) in model.items():
+            got_probs, got_dets = s.get(photo_id)
+            if probs is None:
+                assert got_probs is None
+            else:
+                np.testing.assert_array_equal(got_probs, probs.astype(np.float16).astype(np.float32))
+            if dets is None:
+                assert got_dets is None
+            else:
+                np.testing.assert_array_equal(got_dets, dets.astype(np.float16).astype(np.float32))
+        arrays = s.arrays()
+        for row, photo_id in enumerate(arrays['photo_ids']):
+            dets = model[photo_id][1]
+            sel = arrays['det_row'] == row
+            assert arrays['has_yolo'][row] == (dets is not None)
+            assert sel.sum() == (0 if dets is None else len(dets))
+
+    check(store)
+    assert store.flush()
+    check(ScoreStore(path, CATEGORIES))
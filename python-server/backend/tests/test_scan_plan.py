@@ -0,0 +1,83 @@
+import gzip
+import json
+from collections import OrderedDict
+
+import pytest
+
+from backend import pipeline_version, tags_db
+from backend.tags_db import ScanPlanTooLarge, parse_scan_request, plan_scan
+
+
+@pytest.fixture
+def shard(tmp_path, monkeypatch):
+    monkeypatch.setattr(tags_db, 'TAGS_DB_SHARDS_DIR', str(tmp_path))
+    monkeypatch.setattr(tags_db, '_shards', OrderedDict())
+    monkeypatch.setattr(tags_db, '_shard_last_used', {})
+    monkeypatch.setattr(tags_db, '_shard_stores', tags_db.weakref.WeakValueDictionary())
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_BACKEND', 'json')
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_MODE', 'snapshot')
+    tags_db.set_tags_many([('same', ['people'], None, 'h1'),
+                           ('changed', ['food'], None, 'h2'),
+                           ('unhashed', ['animals'])], tenant='plan', model_version='pold')
+    tags_db.set_tags_many([('current', ['scenery'])], tenant='plan', model_version='pnew')
+    return 'plan'
+
+
+REQUEST = {'photoIDs': ['same', 'changed', 'unhashed', 'current', 'new'],
+           'contentHashes': {'same': 'h1', 'changed': 'h2-edited', 'unhashed': 'h3'}}
+
+
+def test_plain_and_gzip_bodies_parse_the_same():
+    raw = json.dumps(REQUEST).encode()
+    expected = (REQUEST['photoIDs'], REQUEST['contentHashes'], None)
+    assert parse_scan_request(raw) == expected
+    assert parse_scan_request(gzip.compress(raw), gzipped=True) == expected
+    # The gzip magic is enough without Content-Encoding
+    assert parse_scan_request(gzip.compress(raw)) == expected
+
+
+def test_hash_list_and_model_version():
+    body = json.dumps({'photoIDs': ['a', 'b', 'c'], 'contentHashes': ['x', None, 'z'], 'modelVersion': 7})
+    assert parse_scan_request(body.encode()) == (['a', 'b', 'c'], {'a': 'x', 'c': 'z'}, '7')
+
+
+def test_gzip_bomb_is_rejected_without_inflating_it():
+    bomb = gzip.compress(b' ' * (50 * 1024 * 1024))
+    assert len(bomb) < 100 * 1024
+    with pytest.raises(ScanPlanTooLarge):
+        parse_scan_request(bomb, gzipped=True, max_bytes=1024 * 1024)
+
+
+def test_limits_and_invalid_bodies():
+    with pytest.raises(ScanPlanTooLarge):
+        parse_scan_request(json.dumps({'photoIDs': ['x'] * 11}).encode(), max_ids=10)
+    with pytest.raises(ScanPlanTooLarge):
+        parse_scan_request(b'{"photoIDs": []}' + b' ' * 100, max_bytes=50)
+    with pytest.raises(ValueError):
+        parse_scan_request(gzip.compress(json.dumps(REQUEST).encode())[:-12], gzipped=True)
+    with pytest.raises(ValueError):
+        parse_scan_request(b'{"photoIDs": "a"}')
+    with pytest.raises(ValueError):
+        parse_scan_request(b'[1, 2]')
+
+
+def test_missing_and_hash_stale_ids(shard, monkeypatch):
+    monkeypatch.setattr(tags_db, 'current_model_version', lambda: 'pnew')
+    # The pipeline change from pold does not affect these entries
+    monkeypatch.setattr(pipeline_version, 'is_stale', lambda version, tags: False)
+    plan = plan_scan(*parse_scan_request(json.dumps(REQUEST).encode()), tenant=shard)
+    assert plan['missing'] == ['new']
+    assert plan['stale'] == ['changed']
+    assert plan['up_to_date'] == 3
+
+
+def test_pipeline_and_explicit_model_version_staleness(shard, monkeypatch):
+    monkeypatch.setattr(tags_db, 'current_model_version', lambda: 'pnew')
+    monkeypatch.setattr(pipeline_version, 'is_stale', lambda version, tags: 'animals' in tags)
+    plan = plan_scan(REQUEST['photoIDs'], REQUEST['contentHashes'], tenant=shard)
+    assert plan['stale'] == ['changed', 'unhashed']
+
+    # An explicit version makes every other version stale
+    plan = plan_scan(REQUEST['photoIDs'], {}, model_version='pnew', tenant=shard)
+    assert plan['stale'] == ['same', 'changed', 'unhashed']
+    assert plan['missing'] == ['new'] and plan['model_version'] == 'pnew'
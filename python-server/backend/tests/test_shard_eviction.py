@@ -0,0 +1,75 @@
+import gc
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from backend import duplicate_index, embedding_store, tags_db
+
+
+@pytest.fixture
+def one_open_shard(tmp_path, monkeypatch):
+    monkeypatch.setattr(tags_db, 'TAGS_DB_SHARDS_DIR', str(tmp_path))
+    monkeypatch.setattr(tags_db, '_shards', OrderedDict())
+    monkeypatch.setattr(tags_db, '_shard_last_used', {})
+    monkeypatch.setattr(tags_db, '_shard_stores', tags_db.weakref.WeakValueDictionary())
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_BACKEND', 'json')
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_MODE', 'snapshot')
+    monkeypatch.setattr(tags_db._cfg, 'TAGS_DB_MAX_OPEN_SHARDS', 1)
+    for module in (duplicate_index, embedding_store):
+        monkeypatch.setattr(module, '_stores', OrderedDict())
+        monkeypatch.setattr(module, '_held', module.weakref.WeakValueDictionary())
+
+
+def _entry(tags):
+    return {'tags': tags, 'last_updated': '2024-01-01T00:00:00', 'source': 'classifier'}
+
+
+def test_writes_to_a_held_evicted_tag_shard_are_kept(one_open_shard):
+    a = tags_db.get_store('A')
+    a.put('p1', _entry(['people']))
+    tags_db.get_store('B')  # evicts A
+    a.put('p2', _entry(['food']))
+    again = tags_db.get_store('A')
+    assert again is a
+    again.put('p3', _entry(['animals']))
+    tags_db.flush()
+
+    assert sorted(tags_db._read_tags_file(tags_db._shard_path('A'))) == ['p1', 'p2', 'p3']
+
+
+def test_a_released_evicted_tag_shard_reloads_from_disk(one_open_shard):
+    tags_db.get_store('A').put('p1', _entry(['people']))
+    tags_db.get_store('B')
+    gc.collect()
+
+    assert tags_db.get_store('A').get('p1')['tags'] == ['people']
+
+
+def test_writes_to_a_held_evicted_hash_store_are_kept(one_open_shard):
+    a = duplicate_index.get_hash_store('A')
+    a.put_many({'p1': (1, 2)})
+    duplicate_index.get_hash_store('B')
+    a.put_many({'p2': (3, 4)})
+    assert duplicate_index.get_hash_store('A') is a
+    del a
+    gc.collect()
+
+    reloaded = duplicate_index.HashStore(duplicate_index.hash_path_for(tags_db._shard_path('A')))
+    assert reloaded.get('p1') == (1, 2) and reloaded.get('p2') == (3, 4)
+
+
+def test_writes_to_a_held_evicted_embedding_store_are_kept(one_open_shard):
+    rows = np.eye(4, dtype=np.float32)
+    a = embedding_store.get_embedding_store(4, 'model', 'A')
+    a.add_many(['p1'], rows[:1])
+    embedding_store.get_embedding_store(4, 'model', 'B')
+    a.add_many(['p2'], rows[1:2])
+    assert embedding_store.get_embedding_store(4, 'model', 'A') is a
+    base = a.base_path
+    del a
+    gc.collect()
+
+    reloaded = embedding_store.EmbeddingStore(base, 4, 'model')
+    assert len(reloaded) == 2
+    assert reloaded.get('p2').tolist() == rows[1].tolist()
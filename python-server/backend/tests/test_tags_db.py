@@ -0,0 +1,222 @@
+import json
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from backend.tags_db import JournaledTagStore, TagStore
+
+
+def _entry(tags):
+    return {'tags': tags, 'last_updated': '2024-01-01T00:00:00', 'source': 'classifier'}
+
+
+def _run_threads(targets, timeout=30.0):
+    threads = [threading.Thread(target=t, daemon=True) for t in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout)
+    assert not any(t.is_alive() for t in threads), 'threads deadlocked'
+
+
+@pytest.mark.parametrize('durability,threshold', [('sync', 500), ('write-behind', 5)])
+def test_move_and_put_concurrently_do_not_deadlock(tmp_path, durability, threshold):
+    store = TagStore(str(tmp_path / 'tags_db.json'), durability=durability,
+                     flush_interval=0.05, flush_threshold=threshold)
+    store.put_many({f'm{i}': _entry(['people']) for i in range(200)})
+
+    def mover():
+        for i in range(200):
+            assert store.move(f'm{i}', f'moved{i}', '2024-02-01T00:00:00')
+
+    def writer():
+        for i in range(200):
+            store.put(f'p{i}', _entry(['food']))
+
+    _run_threads([mover, writer])
+    store.flush()
+    assert store.get('m0') is None
+    assert store.get('moved199')['last_updated'] == '2024-02-01T00:00:00'
+    assert len(store) == 400
+
+
+def test_journaled_move_is_replayed(tmp_path):
+    path = str(tmp_path / 'tags_db.json')
+    store = JournaledTagStore(path, fsync='never')
+    store.put('a', _entry(['animals']))
+    assert store.move('a', 'b', '2024-02-01T00:00:00')
+    assert not store.move('a', 'c', '2024-02-01T00:00:00')
+    store._sync_journal()
+
+    reloaded = JournaledTagStore(path, fsync='never')
+    assert reloaded.get('a') is None
+    assert reloaded.get('b')['tags'] == ['animals']
+    store.close()
+    reloaded.close()
+
+
+def test_reads_never_see_a_half_written_entry(tmp_path):
+    store = TagStore(str(tmp_path / 'tags_db.json'), flush_interval=60)
+    ids = [f'id{i}' for i in range(50)]
+    store.put_many({photo_id: _entry(['people', 'food']) for photo_id in ids})
+    stop = threading.Event()
+    bad = []
+
+    def writer():
+        for n in range(3000):
+            # Alternate list lengths so slices are released and the pool compacts
+            store.put(ids[n % len(ids)], _entry(['people'] if n % 2 else ['food', 'animals', 'document']))
+        stop.set()
+
+    def reader():
+        while not stop.is_set():
+            for photo_id in ids:
+                tags = store.get_list(photo_id, 'tags')
+                entry = store.get(photo_id)
+                if not tags or not entry or not entry['tags']:
+                    bad.append((photo_id, tags, entry))
+
+    _run_threads([writer, reader])
+    assert not bad
+
+
+def _journaled(path):
+    # No background compaction during a test: crashes are simulated by dropping the store
+    return JournaledTagStore(path, fsync='never', compact_interval=3600)
+
+
+def _crash(store):
+    """Stop the compactor and drop the store without the flush close() would do."""
+    store._closed = True
+    store._wake.set()
+    if store._worker is not None:
+        store._worker.join(timeout=5)
+    store._journal.close()
+
+
+def test_journal_replay_skips_a_torn_last_line(tmp_path):
+    path = str(tmp_path / 'tags_db.json')
+    store = _journaled(path)
+    store.put_many({'a': _entry(['people']), 'b': _entry(['food'])})
+    _crash(store)
+    with open(store.journal_path, 'a', encoding='utf-8') as f:
+        f.write('{"op":"set","id":"c","entry":{"tags":["ani')
+
+    reloaded = _journaled(path)
+    assert sorted(reloaded.keys()) == ['a', 'b']
+    assert reloaded.stats()['replayed_records'] == 2
+    # The next append starts on its own line, so it survives another crash
+    reloaded.put('d', _entry(['scenery']))
+    _crash(reloaded)
+
+    again = _journaled(path)
+    assert sorted(again.keys()) == ['a', 'b', 'd']
+    again.close()
+
+
+def test_journal_replay_after_an_interrupted_compaction(tmp_path):
+    path = str(tmp_path / 'tags_db.json')
+    store = _journaled(path)
+    store.put('a', _entry(['people']))
+    assert store.compact()
+    store.put('b', _entry(['food']))
+    store.pop('a')
+    _crash(store)
+    # Crash after the journal was rotated but before the snapshot was written
+    os.replace(store.journal_path, store.journal_path + '.compacting')
+    with open(store.journal_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'op': 'set', 'id': 'c', 'entry': _entry(['document'])}) + '\n')
+
+    reloaded = _journaled(path)
+    assert sorted(reloaded.keys()) == ['b', 'c']
+    assert reloaded.compact()
+    assert not os.path.exists(reloaded.journal_path + '.compacting')
+    reloaded.close()
+
+    assert sorted(_journaled(path).keys()) == ['b', 'c']
+
+
+def test_journal_replays_moves_after_a_crash(tmp_path):
+    path = str(tmp_path / 'tags_db.json')
+    store = _journaled(path)
+    store.put_many({'a': _entry(['people']), 'x': _entry(['food'])})
+    assert store.move('a', 'b', '2024-02-01T00:00:00')
+    assert store.move('b', 'c', '2024-03-01T00:00:00')
+    # Moving onto an existing ID replaces it
+    assert store.move('c', 'x', '2024-04-01T00:00:00')
+    _crash(store)
+
+    reloaded = _journaled(path)
+    assert reloaded.keys() == ['x']
+    assert reloaded.get('x')['tags'] == ['people']
+    assert reloaded.get('x')['last_updated'] == '2024-04-01T00:00:00'
+    reloaded.close()
+
+
+def _sqlite_shard_worker(shards_dir, worker, count):
+    from backend import tags_db
+    tags_db._cfg.TAGS_DB_BACKEND = 'sqlite'
+    tags_db.TAGS_DB_SHARDS_DIR = shards_dir
+    for start in range(0, count, 10):
+        tags_db.set_tags_many([(f'{worker}-{i}', ['people']) for i in range(start, start + 10)]
+                              + [(f'shared-{i}', [f'w{worker}']) for i in range(start, start + 10)],
+                              tenant='mp', model_version='ptest')
+        for i in range(start, start + 10, 2):
+            tags_db.move_tags(f'{worker}-{i}', f'{worker}-{i}-moved', tenant='mp')
+
+
+def test_sqlite_store_loses_no_updates_across_processes(tmp_path):
+    from backend.tags_db import SQLiteTagStore, _shard_path
+    ctx = multiprocessing.get_context('spawn')
+    workers, count = 4, 60
+    procs = [ctx.Process(target=_sqlite_shard_worker, args=(str(tmp_path), w, count)) for w in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+    assert [p.exitcode for p in procs] == [0] * workers
+
+    path = os.path.join(str(tmp_path), os.path.basename(_shard_path('mp')))
+    db = SQLiteTagStore(os.path.splitext(path)[0] + '.sqlite3').snapshot()
+    expected = {f'{w}-{i}-moved' if i % 2 == 0 else f'{w}-{i}' for w in range(workers) for i in range(count)}
+    assert expected <= set(db)
+    assert not any(f'{w}-{i}' in db for w in range(workers) for i in range(0, count, 2))
+    assert {f'shared-{i}' for i in range(count)} <= set(db)
+    assert all(db[f'shared-{i}']['tags'][0] in {f'w{w}' for w in range(workers)} for i in range(count))
+    assert len(db) == workers * count + count
+
+
+def _sqlite_import_worker(path, json_path, barrier, worker):
+    from backend.tags_db import SQLiteTagStore
+    store = SQLiteTagStore(path, json_path=json_path)
+    barrier.wait()
+    len(store)
+    barrier.wait()
+    if worker == 0:
+        store.pop('legacy-0')
+    barrier.wait()
+    store.close()
+
+
+def test_sqlite_json_import_runs_once_with_concurrent_starts(tmp_path):
+    from backend.tags_db import SQLiteTagStore, _write_tags_file
+    json_path = str(tmp_path / 'tags_db.json')
+    path = str(tmp_path / 'tags_db.sqlite3')
+    _write_tags_file(json_path, {f'legacy-{i}': _entry(['food']) for i in range(500)})
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(2)
+    procs = [ctx.Process(target=_sqlite_import_worker, args=(path, json_path, barrier, w)) for w in range(2)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+    assert [p.exitcode for p in procs] == [0, 0]
+
+    store = SQLiteTagStore(path, json_path=json_path)
+    # A second import would have brought legacy-0 back
+    assert len(store) == 499 and store.get('legacy-0') is None
+    conn = store._conn()
+    assert conn.execute("SELECT COUNT(*) FROM meta WHERE key = 'imported_json'").fetchone()[0] == 1
+    store.close()
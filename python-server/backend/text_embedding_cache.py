@@ -0,0 +1,85 @@
+"""
+Cache of L2-normalized CLIP text embeddings per (model, prompt list).
+
+The category prompts never change between calls, so running them through the
+text tower on every classification is wasted work. Embeddings are computed
+once, kept in memory, and saved as `.npy` files keyed by a hash of the model
+id and prompts, so a restarted server skips the text tower entirely.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from . import config as _cfg
+
+logger = logging.getLogger(__name__)
+
+_memory: Dict[Tuple[str, Tuple[str, ...]], np.ndarray] = {}
+_lock = threading.Lock()
+
+
+def cache_key(model_id: str, prompts: List[str]) -> str:
+    raw = json.dumps([model_id, list(prompts)], ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:24]
+
+
+def get_text_embeddings(model_id: str, prompts: List[str],
+                        encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+    """Return float32[len(prompts), D] normalized text embeddings.
+
+    Args:
+        model_id: Identifies the text tower weights (name + pretrained tag).
+        prompts: Prompt strings, in order.
+        encode: Runs the text tower; called only on a cache miss.
+
+    Returns:
+        Row-normalized embeddings (memory cache, then disk, then `encode`).
+    """
+    mem_key = (model_id, tuple(prompts))
+    cached = _memory.get(mem_key)
+    if cached is not None:
+        return cached
+    with _lock:
+        cached = _memory.get(mem_key)
+        if cached is not None:
+            return cached
+        path = os.path.join(_cfg.TEXT_EMBEDDING_CACHE_DIR, f"text_{cache_key(model_id, prompts)}.npy")
+        emb = None
+        if os.path.exists(path):
+            try:
+                emb = np.load(path)
+                if emb.shape[0] != len(prompts):
+                    logger.warning(f"Ignoring text embedding cache {path}: shape {emb.shape}")
+                    emb = None
+            except Exception:
+                logger.exception(f"Failed to read text embedding cache {path}")
+        if emb is None:
+            emb = np.asarray(encode(list(prompts)), dtype=np.float32)
+            emb = emb / np.linalg.norm(emb, axis=-1, keepdims=True)
+            try:
+                os.makedirs(_cfg.TEXT_EMBEDDING_CACHE_DIR, exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.tmp.npy"
+                np.save(tmp, emb)
+                os.replace(tmp, path)
+                logger.info(f"Cached {len(prompts)} text embeddings for {model_id} at {path}")
+            except Exception:
+                logger.exception('Failed to persist text embeddings (continuing with in-memory copy)')
+        else:
+            logger.info(f"Loaded {len(prompts)} cached text embeddings for {model_id} from {path}")
+        emb = np.ascontiguousarray(emb, dtype=np.float32)
+        _memory[mem_key] = emb
+        return emb
+
+
+def softmax_scores(image_embeddings: np.ndarray, text_embeddings: np.ndarray, scale: float) -> np.ndarray:
+    """CLIP-style probabilities: softmax(scale * image @ text.T) over prompts, float32[N, P]."""
+    logits = scale * (np.asarray(image_embeddings, dtype=np.float32) @ text_embeddings.T)
+    logits -= logits.max(axis=1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=1, keepdims=True)
+    return logits
@@ -25,27 +25,28 @@ Expected performance (with yolov8n.pt on CPU):
 """
 
 import logging
+import os
 import time
 from typing import List, Tuple, Set
-from ultralytics import YOLO
+import numpy as np
+from . import config as _cfg
 from .config import MIN_BOX_PERCENT, MIN_PERSON_PERCENT
+from .image_context import ImageContext, load_rgb
+from .image_hash import hash_image
 
 logger = logging.getLogger(__name__)
 
 # Fast YOLO model for hybrid classification
-_hybrid_yolo_model = None
+HYBRID_YOLO_MODEL = "yolov8n.pt"
 
 def get_fast_yolo_model():
     """
-    Get or load the fast YOLO model (nano) for hybrid classification.
-    This is separate from the main YOLO model to ensure we use the fastest version.
+    Get the shared fast YOLO model (nano) for hybrid classification.
+    This is separate from the main YOLO model to ensure we use the fastest version;
+    model_registry loads it on first use.
     """
-    global _hybrid_yolo_model
-    if _hybrid_yolo_model is None:
-        logger.info("Loading yolov8n.pt (nano model) for hybrid classification...")
-        _hybrid_yolo_model = YOLO("yolov8n.pt")
-        logger.info("Fast YOLO model loaded successfully")
-    return _hybrid_yolo_model
+    from .model_registry import get_model
+    return get_model(os.path.splitext(HYBRID_YOLO_MODEL)[0])
 
 # YOLO class ID to category mapping
 # Based on COCO dataset 80 classes
@@ -231,6 +232,25 @@ def map_yolo_detections_to_categories(yolo_results, confidence_threshold: float
     return result, debug_info
 
 
+def compact_detections(yolo_results) -> np.ndarray:
+    """
+    Reduce YOLO results to a float32 (k, 3) array of (class_id, confidence, box_fraction)
+    so they can be stored and re-mapped later without running YOLO again.
+    """
+    if not yolo_results or getattr(yolo_results, 'boxes', None) is None or len(yolo_results.boxes) == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    boxes = yolo_results.boxes
+    img_height, img_width = yolo_results.orig_shape if hasattr(yolo_results, 'orig_shape') else (1, 1)
+    image_area = img_width * img_height
+    xyxy = boxes.xyxy.cpu().numpy().astype(np.float32)
+    areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    return np.stack([
+        boxes.cls.cpu().numpy().astype(np.float32),
+        boxes.conf.cpu().numpy().astype(np.float32),
+        areas / image_area if image_area > 0 else np.zeros_like(areas),
+    ], axis=1)
+
+
 def classify_image_hybrid(image_path: str, yolo_model, clip_classifier_func, 
                          yolo_confidence: float = YOLO_MIN_CONFIDENCE,
                          clip_threshold: float = 0.70) -> Tuple[List[str], dict]:
@@ -259,7 +279,7 @@ def classify_image_hybrid(image_path: str, yolo_model, clip_classifier_func,
     # Step 1: Try YOLO (fast)
     t0 = time.time()
     try:
-        yolo_results = yolo_model(image_path)[0]
+        yolo_results = yolo_model(image_path.pil if isinstance(image_path, ImageContext) else image_path)[0]
         t1 = time.time()
         timing["yolo_ms"] = round((t1 - t0) * 1000, 1)
         
@@ -309,12 +329,16 @@ def classify_image_hybrid(image_path: str, yolo_model, clip_classifier_func,
 def classify_batch_hybrid(image_paths: List[str], yolo_model=None, clip_batch_func=None,
                          yolo_confidence: float = YOLO_MIN_CONFIDENCE,
                          clip_threshold: float = 0.70,
-                         max_tags: int = 5) -> Tuple[List[List[str]], List[List[str]], dict]:
+                         max_tags: int = 5,
+                         scores_out: list = None,
+                         embeddings_out: list = None,
+                         hashes_out: list = None,
+                         embed_func=None) -> Tuple[List[List[str]], List[List[str]], dict]:
     """
     Classify a batch of images using YOLO+CLIP hybrid approach.
     
     This is more efficient than processing sequentially because:
-    1. YOLO can be called individually (very fast anyway at 15-30ms with nano model)
+    1. Images are decoded once and sent to YOLO in YOLO_BATCH_SIZE mini-batches
     2. Only images that failed YOLO are batched for CLIP (much faster than sequential CLIP)
     
     Args:
@@ -325,6 +349,13 @@ def classify_batch_hybrid(image_paths: List[str], yolo_model=None, clip_batch_fu
         yolo_confidence: Minimum confidence for YOLO detections
         clip_threshold: Confidence threshold for CLIP
         max_tags: Maximum tags per image
+        scores_out: If given, extended with one (clip_probs, yolo_detections) tuple per
+                   image for score_store (clip_batch_func must accept `scores_out`)
+        embeddings_out: If given, extended with one normalized image embedding (or None)
+                       per image; images YOLO answered are embedded in one extra batch
+        hashes_out: If given, extended with one (dhash, phash) tuple (or None) per image
+        embed_func: Image-tower function for YOLO-answered images (default:
+                   clip_switcher.embed_images); must match clip_batch_func's model
         
     Returns:
         Tuple of (results_list, all_detections_list, stats_dict)
@@ -342,6 +373,10 @@ def classify_batch_hybrid(image_paths: List[str], yolo_model=None, clip_batch_fu
     all_detections = [None] * len(image_paths)  # All detected objects
     clip_needed_indices = []  # Track which images need CLIP
     clip_needed_paths = []
+    yolo_scores = [None] * len(image_paths)
+    clip_scores = [None] * len(image_paths)
+    embeddings = [None] * len(image_paths)
+    hashes = [None] * len(image_paths)
     
     stats = {
         "total_images": len(image_paths),
@@ -353,30 +388,59 @@ def classify_batch_hybrid(image_paths: List[str], yolo_model=None, clip_batch_fu
         "avg_time_per_image_ms": 0,
     }
     
-    # Phase 1: Try YOLO for all images (fast, sequential is fine)
+    # Phase 1: YOLO on decoded images in mini-batches. Ultralytics letterboxes
+    # each mini-batch itself, so boxes stay in original-image coordinates
     t0 = time.time()
-    for idx, image_path in enumerate(image_paths):
+    keep_decoded = embeddings_out is not None or hashes_out is not None
+    yolo_images = {}  # YOLO-answered images, reused for their embedding and hash
+    batch_size = max(1, _cfg.YOLO_BATCH_SIZE)
+    stats["yolo_batch_size"] = batch_size
+    for start in range(0, len(image_paths), batch_size):
+        batch = []
+        for idx in range(start, min(start + batch_size, len(image_paths))):
+            try:
+                batch.append((idx, load_rgb(image_paths[idx])))
+            except Exception as e:
+                logger.warning(f"YOLO error for {image_paths[idx]}: {e}")
+                all_detections[idx] = []
+                clip_needed_indices.append(idx)
+                clip_needed_paths.append(image_paths[idx])
+        if not batch:
+            continue
         try:
-            yolo_results = yolo_model(image_path)[0]
-            tags, debug_info = map_yolo_detections_to_categories(yolo_results, yolo_confidence)
-            
-            if tags:
-                # YOLO succeeded
-                results[idx] = tags[:max_tags]
-                # Store all detections for search
-                all_detections[idx] = debug_info.get("all_objects_list", tags[:max_tags])
-                stats["yolo_success"] += 1
-            else:
-                # Need CLIP fallback but still store any all_objects detected
-                all_detections[idx] = debug_info.get("all_objects_list", [])
+            batch_results = yolo_model([img for _, img in batch], verbose=False)
+        except Exception as e:
+            logger.warning(f"YOLO error for batch of {len(batch)} images: {e}")
+            batch_results = [None] * len(batch)
+        
+        for (idx, img), yolo_results in zip(batch, batch_results):
+            image_path = image_paths[idx]
+            try:
+                if yolo_results is None:
+                    raise RuntimeError("no YOLO result")
+                tags, debug_info = map_yolo_detections_to_categories(yolo_results, yolo_confidence)
+                if scores_out is not None:
+                    yolo_scores[idx] = compact_detections(yolo_results)
+                
+                if tags:
+                    # YOLO succeeded
+                    results[idx] = tags[:max_tags]
+                    # Store all detections for search
+                    all_detections[idx] = debug_info.get("all_objects_list", tags[:max_tags])
+                    stats["yolo_success"] += 1
+                    if keep_decoded:
+                        yolo_images[idx] = img
+                else:
+                    # Need CLIP fallback but still store any all_objects detected
+                    all_detections[idx] = debug_info.get("all_objects_list", [])
+                    clip_needed_indices.append(idx)
+                    clip_needed_paths.append(image_path)
+                    
+            except Exception as e:
+                logger.warning(f"YOLO error for {image_path}: {e}")
+                all_detections[idx] = []
                 clip_needed_indices.append(idx)
                 clip_needed_paths.append(image_path)
-                
-        except Exception as e:
-            logger.warning(f"YOLO error for {image_path}: {e}")
-            all_detections[idx] = []
-            clip_needed_indices.append(idx)
-            clip_needed_paths.append(image_path)
     
     t1 = time.time()
     stats["yolo_time_ms"] = round((t1 - t0) * 1000, 1)
@@ -385,7 +449,21 @@ def classify_batch_hybrid(image_paths: List[str], yolo_model=None, clip_batch_fu
     if clip_needed_paths:
         t2 = time.time()
         try:
-            clip_results = clip_batch_func(clip_needed_paths, clip_threshold, max_tags)
+            extra = {}
+            if scores_out is not None:
+                extra['scores_out'] = clip_probs = []
+            if embeddings_out is not None:
+                extra['embeddings_out'] = clip_embeddings = []
+            if hashes_out is not None:
+                extra['hashes_out'] = clip_hashes = []
+            clip_results = clip_batch_func(clip_needed_paths, clip_threshold, max_tags, **extra)
+            for clip_idx, original_idx in enumerate(clip_needed_indices):
+                if scores_out is not None and clip_idx < len(clip_probs):
+                    clip_scores[original_idx] = clip_probs[clip_idx]
+                if embeddings_out is not None and clip_idx < len(clip_embeddings):
+                    embeddings[original_idx] = clip_embeddings[clip_idx]
+                if hashes_out is not None and clip_idx < len(clip_hashes):
+                    hashes[original_idx] = clip_hashes[clip_idx]
             
             # Map CLIP results back to original indices
             for clip_idx, original_idx in enumerate(clip_needed_indices):
@@ -407,6 +485,39 @@ def classify_batch_hybrid(image_paths: List[str], yolo_model=None, clip_batch_fu
         t3 = time.time()
         stats["clip_time_ms"] = round((t3 - t2) * 1000, 1)
     
+    if scores_out is not None:
+        scores_out.extend(zip(clip_scores, yolo_scores))
+    if embeddings_out is not None or hashes_out is not None:
+        # YOLO-answered images never reached CLIP: reuse their phase 1 decode
+        # for the semantic-search embedding and the duplicate hash
+        missing = [idx for idx in range(len(image_paths))
+                   if (embeddings_out is not None and embeddings[idx] is None)
+                   or (hashes_out is not None and hashes[idx] is None)]
+        decoded = []
+        for idx in missing:
+            if idx in yolo_images:
+                decoded.append((idx, yolo_images[idx]))
+                continue
+            try:
+                decoded.append((idx, load_rgb(image_paths[idx])))
+            except Exception as e:
+                logger.warning(f"Failed to load {image_paths[idx]}: {e}")
+        if hashes_out is not None:
+            for idx, img in decoded:
+                hashes[idx] = hash_image(img)
+        if embeddings_out is not None and decoded:
+            try:
+                if embed_func is None:
+                    from .clip_switcher import embed_images as embed_func
+                for (idx, _), emb in zip(decoded, embed_func([img for _, img in decoded])):
+                    embeddings[idx] = emb
+            except Exception as e:
+                logger.warning(f"Embedding YOLO-classified images failed: {e}")
+    if embeddings_out is not None:
+        embeddings_out.extend(embeddings)
+    if hashes_out is not None:
+        hashes_out.extend(hashes)
+    
     # Ensure no None values in results - use "Other" for failed classifications
     for idx in range(len(results)):
         if results[idx] is None or results[idx] == []:
@@ -476,94 +587,112 @@ def validate_yolo_with_clip(image_path: str, yolo_tags: List[str],
         
         t1 = time.time()
         result["clip_time_ms"] = round((t1 - t0) * 1000, 1)
-        result["clip_tags"] = clip_tags
-        
-        # Check for agreement
-        yolo_set = set(yolo_tags)
-        clip_set = set(clip_tags)
-        
-        if yolo_set == clip_set:
-            result["agreement"] = True
-            result["reason"] = "Perfect agreement"
-            return result
-        
-        # Check for overlap
-        overlap = yolo_set & clip_set
-        if overlap and len(overlap) >= len(yolo_set) * 0.5:
-            result["agreement"] = True
-            result["reason"] = f"Partial agreement: {overlap}"
-            return result
-        
-        # Disagreement detected
-        result["agreement"] = False
+        # Re-run CLIP with NORMAL threshold only if the decision needs it
+        # Pass yolo_tags as expected_tags to enable dynamic threshold search
+        return _decide_validation(
+            result, yolo_tags, clip_tags,
+            lambda: clip_classifier_func(image_path, clip_threshold, expected_tags=yolo_tags)
+        )
         
-        # YOLO is better at object detection (people, animals, food)
-        # CLIP is better at scene/context classification (scenery, document)
-        # NEVER let CLIP remove YOLO's object detections
-        # CLIP can only ADD complementary tags
+    except Exception as e:
+        t1 = time.time()
+        result["clip_time_ms"] = round((t1 - t0) * 1000, 1)
+        result["reason"] = f"Validation error: {e}"
+        logger.error(f"Validation error for {image_path}: {e}")
+        return result
+
+
+def _decide_validation(result: dict, yolo_tags: List[str], clip_tags: List[str],
+                       confident_tags_func) -> dict:
+    """
+    Fill in the agreement/override decision of a validation result.
+    
+    Args:
+        result: Validation result dict to update (see validate_yolo_with_clip)
+        yolo_tags: Tags returned by YOLO
+        clip_tags: CLIP tags at the validation (lowered) threshold
+        confident_tags_func: Returns CLIP tags at the normal threshold with yolo_tags
+            as expected tags; only called on disagreement
+    """
+    result["clip_tags"] = clip_tags
+    
+    # Check for agreement
+    yolo_set = set(yolo_tags)
+    clip_set = set(clip_tags)
+    
+    if yolo_set == clip_set:
+        result["agreement"] = True
+        result["reason"] = "Perfect agreement"
+        return result
+    
+    # Check for overlap
+    overlap = yolo_set & clip_set
+    if overlap and len(overlap) >= len(yolo_set) * 0.5:
+        result["agreement"] = True
+        result["reason"] = f"Partial agreement: {overlap}"
+        return result
+    
+    # Disagreement detected
+    result["agreement"] = False
+    
+    # YOLO is better at object detection (people, animals, food)
+    # CLIP is better at scene/context classification (scenery, document)
+    # NEVER let CLIP remove YOLO's object detections
+    # CLIP can only ADD complementary tags
+    
+    yolo_object_categories = {'people', 'animals', 'food'}
+    has_yolo_objects = yolo_set & yolo_object_categories
+    
+    if clip_tags:
+        clip_confident_tags = confident_tags_func()
         
-        yolo_object_categories = {'people', 'animals', 'food'}
-        has_yolo_objects = yolo_set & yolo_object_categories
+        logger.info(f"🔍 Validation check: YOLO={yolo_tags}, CLIP_low={clip_tags}, CLIP_high={clip_confident_tags}")
         
-        if clip_tags:
-            # Re-run CLIP with NORMAL threshold to check if it's confident
-            # Pass yolo_tags as expected_tags to enable dynamic threshold search
-            clip_confident_tags = clip_classifier_func(image_path, clip_threshold, expected_tags=yolo_tags)
+        # CRITICAL: Never override with empty or None
+        if not clip_confident_tags or len(clip_confident_tags) == 0:
+            # CLIP couldn't find anything confident - keep YOLO's detection
+            result["should_override"] = False
+            result["override_tags"] = []
+            result["reason"] = f"CLIP found nothing confident. Keeping YOLO tags: {yolo_tags}"
+            logger.info(f"✅ Keeping YOLO tags (CLIP empty): {yolo_tags}")
+        elif has_yolo_objects:
+            # YOLO detected objects (people/animals/food)
+            # NEVER remove these - YOLO is authoritative for objects
+            # CLIP can only add scene/context tags (NOT unknown)
+            clip_set_confident = set(clip_confident_tags)
+            clip_scene_tags = clip_set_confident - yolo_object_categories
             
-            logger.info(f"🔍 Validation check: YOLO={yolo_tags}, CLIP_low={clip_tags}, CLIP_high={clip_confident_tags}")
+            # Remove "other" from scene tags - if YOLO detected something, it's not other
+            clip_scene_tags.discard('other')
             
-            # CRITICAL: Never override with empty or None
-            if not clip_confident_tags or len(clip_confident_tags) == 0:
-                # CLIP couldn't find anything confident - keep YOLO's detection
+            if clip_scene_tags:
+                # CLIP found complementary scene tags - COMBINE with YOLO
+                combined_tags = list(yolo_set | clip_scene_tags)
+                result["should_override"] = True
+                result["override_tags"] = combined_tags
+                result["reason"] = f"Adding CLIP scene tags to YOLO objects: {yolo_tags} + {list(clip_scene_tags)}"
+                logger.info(f"➕ Validation enhancement: {yolo_tags} + {list(clip_scene_tags)} = {combined_tags}")
+            else:
+                # CLIP only found object tags - trust YOLO for objects
                 result["should_override"] = False
                 result["override_tags"] = []
-                result["reason"] = f"CLIP found nothing confident. Keeping YOLO tags: {yolo_tags}"
-                logger.info(f"✅ Keeping YOLO tags (CLIP empty): {yolo_tags}")
-            elif has_yolo_objects:
-                # YOLO detected objects (people/animals/food)
-                # NEVER remove these - YOLO is authoritative for objects
-                # CLIP can only add scene/context tags (NOT unknown)
-                clip_set_confident = set(clip_confident_tags)
-                clip_scene_tags = clip_set_confident - yolo_object_categories
-                
-                # Remove "other" from scene tags - if YOLO detected something, it's not other
-                clip_scene_tags.discard('other')
-                
-                if clip_scene_tags:
-                    # CLIP found complementary scene tags - COMBINE with YOLO
-                    combined_tags = list(yolo_set | clip_scene_tags)
-                    result["should_override"] = True
-                    result["override_tags"] = combined_tags
-                    result["reason"] = f"Adding CLIP scene tags to YOLO objects: {yolo_tags} + {list(clip_scene_tags)}"
-                    logger.info(f"➕ Validation enhancement: {yolo_tags} + {list(clip_scene_tags)} = {combined_tags}")
-                else:
-                    # CLIP only found object tags - trust YOLO for objects
-                    result["should_override"] = False
-                    result["override_tags"] = []
-                    result["reason"] = f"YOLO objects are authoritative. Keeping: {yolo_tags}"
-                    logger.info(f"✅ Keeping YOLO objects (authoritative): {yolo_tags}")
-            else:
-                # No YOLO objects detected - CLIP can replace freely
-                result["should_override"] = True
-                result["override_tags"] = clip_confident_tags
-                result["reason"] = f"No YOLO objects. Using CLIP: {clip_confident_tags}"
-                logger.info(f"🔄 Validation override (no YOLO objects): {yolo_tags} -> {clip_confident_tags}")
+                result["reason"] = f"YOLO objects are authoritative. Keeping: {yolo_tags}"
+                logger.info(f"✅ Keeping YOLO objects (authoritative): {yolo_tags}")
         else:
-            # CLIP found nothing even at low threshold
-            # Keep YOLO tags - YOLO is better at object detection
-            result["should_override"] = False
-            result["override_tags"] = []  # Explicitly empty
-            result["reason"] = f"CLIP found nothing, keeping YOLO tags: {yolo_tags}"
-            logger.info(f"✅ Keeping YOLO tags (CLIP found nothing): {yolo_tags}")
-        
-        return result
-        
-    except Exception as e:
-        t1 = time.time()
-        result["clip_time_ms"] = round((t1 - t0) * 1000, 1)
-        result["reason"] = f"Validation error: {e}"
-        logger.error(f"Validation error for {image_path}: {e}")
-        return result
+            # No YOLO objects detected - CLIP can replace freely
+            result["should_override"] = True
+            result["override_tags"] = clip_confident_tags
+            result["reason"] = f"No YOLO objects. Using CLIP: {clip_confident_tags}"
+            logger.info(f"🔄 Validation override (no YOLO objects): {yolo_tags} -> {clip_confident_tags}")
+    else:
+        # CLIP found nothing even at low threshold
+        # Keep YOLO tags - YOLO is better at object detection
+        result["should_override"] = False
+        result["override_tags"] = []  # Explicitly empty
+        result["reason"] = f"CLIP found nothing, keeping YOLO tags: {yolo_tags}"
+        logger.info(f"✅ Keeping YOLO tags (CLIP found nothing): {yolo_tags}")
+    
+    return result
 
 
 def validate_batch_with_clip(image_paths: List[str], yolo_tags_list: List[List[str]],
@@ -574,23 +703,54 @@ def validate_batch_with_clip(image_paths: List[str], yolo_tags_list: List[List[s
     Args:
         image_paths: List of image paths
         yolo_tags_list: List of YOLO tags for each image (parallel to image_paths)
-        clip_batch_func: Function to batch process with CLIP
+        clip_batch_func: clip_switcher.classify_batch or a compatible function
+            (must accept scores_out); called once for the whole batch
         clip_threshold: Confidence threshold for CLIP
         
     Returns:
         List of validation results (one per image)
     """
-    # For now, validate sequentially (could optimize with true batching later)
-    from .clip_switcher import classify_image as clip_classify_single
+    # One batched CLIP pass for each image's probabilities. Tags come from the
+    # single-image thresholds, as validate_yolo_with_clip gets them from
+    # classify_image (batch tables can be stricter, e.g. full CLIP's people).
+    # Category thresholds cover every category, so the low- and normal-threshold
+    # tags are the same; only the expected-tags search differs.
+    from .category_tags import match_expected, select_tags
+    from .clip_switcher import category_names_for, category_thresholds_for, other_label_for
+    
+    categories = category_names_for()
+    thresholds = category_thresholds_for()
+    other_label = other_label_for()
+    validation_threshold = max(0.40, clip_threshold - 0.20)
+    
+    t0 = time.time()
+    scores = []
+    try:
+        batch_tags = clip_batch_func(image_paths, validation_threshold, 1, scores_out=scores)
+        error = None
+    except Exception as e:
+        batch_tags, scores, error = [[] for _ in image_paths], [None] * len(image_paths), e
+        logger.error(f"Batch validation error: {e}")
+    clip_time_ms = round((time.time() - t0) * 1000 / max(1, len(image_paths)), 1)
     
     results = []
-    for image_path, yolo_tags in zip(image_paths, yolo_tags_list):
-        validation = validate_yolo_with_clip(
-            image_path, 
-            yolo_tags,
-            clip_classify_single,
-            clip_threshold
-        )
-        results.append(validation)
+    for clip_tags, probs, yolo_tags in zip(batch_tags, scores, yolo_tags_list):
+        result = {
+            "agreement": False,
+            "clip_tags": [],
+            "should_override": False,
+            "override_tags": [],
+            "clip_time_ms": clip_time_ms,
+            "reason": f"Validation error: {error}" if error else ""
+        }
+        if error is None:
+            if probs is not None:
+                clip_tags = [tag for tag, _ in select_tags(probs, categories, thresholds, 1, other_label,
+                                                           validation_threshold)[0]]
+            def confident_tags(clip_tags=clip_tags, probs=probs, yolo_tags=yolo_tags):
+                match = match_expected(probs, categories, yolo_tags, 1, other_label) if probs is not None else None
+                return [tag for tag, _ in match[1]] if match else clip_tags
+            _decide_validation(result, yolo_tags, clip_tags, confident_tags)
+        results.append(result)
     
     return results
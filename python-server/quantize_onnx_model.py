@@ -0,0 +1,214 @@
+"""
+Build INT8 variants of an ONNX CLIP image encoder and compare them with fp32.
+
+Writes two files next to the model, which clip_switcher serves as
+CLIP_BACKEND=onnx-int8 and CLIP_BACKEND=onnx-int8-dynamic:
+- `<name>.int8.onnx`: static quantization (QDQ, per-channel weights,
+  activation ranges calibrated on local images)
+- `<name>.int8-dynamic.onnx`: dynamic quantization (INT8 weights, activation
+  scales computed at run time; no calibration needed)
+
+Calibration uses calibration_image_sample_data_20x128x128x3_float32.npy (RGB
+in [0, 1]) plus any images under --calibration-dir, preprocessed exactly like
+the serving path (backend/onnx_mobile_clip_model.py).
+
+The report compares every variant with fp32 on --eval-dir: latency per image,
+speedup, top-1 category agreement and mean embedding cosine. When the images
+sit in sub-folders named after categories (people/, food/, ...) accuracy
+against those labels is reported too.
+
+Usage:
+    python quantize_onnx_model.py --eval-dir ~/labeled_photos
+    python quantize_onnx_model.py --calibration-dir ~/Pictures --calibration-limit 300
+    python quantize_onnx_model.py --skip-quantize --eval-dir ~/labeled_photos   # re-run the report
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from backend import config
+from backend.onnx_mobile_clip_model import (
+    CATEGORY_NAMES,
+    ONNX_VARIANTS,
+    OnnxMobileCLIPPhotoClassifier,
+    preprocess_image,
+    variant_path,
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.heic')
+DEFAULT_CALIBRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'calibration_image_sample_data_20x128x128x3_float32.npy')
+# Folder names accepted as labels besides CATEGORY_NAMES themselves
+LABEL_ALIASES = {'person': 'people', 'animal': 'animals', 'documents': 'document', 'landscape': 'scenery'}
+
+
+def list_images(root, limit=None):
+    paths = []
+    for dirpath, _, files in os.walk(root):
+        paths.extend(os.path.join(dirpath, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS))
+    paths.sort()
+    return paths[:limit] if limit else paths
+
+
+def calibration_images(npy_path, image_dir, limit):
+    images = []
+    if npy_path and os.path.exists(npy_path):
+        for arr in np.load(npy_path):
+            images.append(Image.fromarray((np.clip(arr, 0.0, 1.0) * 255).round().astype(np.uint8)))
+    if image_dir:
+        for path in list_images(image_dir, limit):
+            try:
+                images.append(Image.open(path).convert('RGB'))
+            except Exception as e:
+                print(f"skipping {path}: {e}")
+    return images
+
+
+def input_spec(model_path):
+    import onnxruntime as ort
+
+    model_input = ort.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0]
+    size = model_input.shape[2] if isinstance(model_input.shape[2], int) else 256
+    return model_input.name, size
+
+
+def quantize(model_path, images, args):
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    input_name, size = input_spec(model_path)
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            # One image per call works for fixed (batch 1) and dynamic batch graphs
+            self._batches = iter([{input_name: preprocess_image(im, size)[None]} for im in images])
+
+        def get_next(self):
+            return next(self._batches, None)
+
+    workdir = tempfile.mkdtemp(prefix='quantize_')
+    try:
+        # Shape inference + graph cleanup first, as ONNX Runtime recommends before quantizing
+        prepared = os.path.join(workdir, 'prepared.onnx')
+        try:
+            quant_pre_process(model_path, prepared)
+        except Exception as e:
+            print(f"pre-processing failed ({e}); quantizing the original graph")
+            prepared = model_path
+
+        static_path = variant_path(model_path, 'onnx-int8')
+        t0 = time.perf_counter()
+        quantize_static(
+            prepared, static_path, Reader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=getattr(CalibrationMethod, args.calibrate_method),
+        )
+        print(f"static INT8: {static_path} ({time.perf_counter() - t0:.1f}s, {len(images)} calibration images)")
+
+        dynamic_path = variant_path(model_path, 'onnx-int8-dynamic')
+        t0 = time.perf_counter()
+        quantize_dynamic(
+            prepared, dynamic_path,
+            per_channel=True,
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=args.dynamic_op_types or None,
+        )
+        print(f"dynamic INT8: {dynamic_path} ({time.perf_counter() - t0:.1f}s)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def load_eval_set(eval_dir, limit, fallback):
+    if not eval_dir:
+        print("no --eval-dir: comparing on the calibration images (agreement will be optimistic)")
+        return fallback, [None] * len(fallback)
+    images, labels = [], []
+    for path in list_images(eval_dir, limit):
+        folder = os.path.basename(os.path.dirname(path)).lower()
+        folder = LABEL_ALIASES.get(folder, folder)
+        try:
+            images.append(Image.open(path).convert('RGB'))
+        except Exception as e:
+            print(f"skipping {path}: {e}")
+            continue
+        labels.append(folder if folder in CATEGORY_NAMES else None)
+    return images, labels
+
+
+def evaluate(model_path, images, repeats):
+    clf = OnnxMobileCLIPPhotoClassifier(model_path=model_path)
+    clf.embed_images(images[:2])  # warm-up: session initialization and first-run allocations
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        embeddings = clf.embed_images(images)
+        best = min(best, time.perf_counter() - t0)
+    return embeddings, clf.score_embeddings(embeddings).argmax(axis=1), best * 1000 / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=config.ONNX_MODEL_PATH, help='fp32 image encoder (.onnx)')
+    parser.add_argument('--calibration-npy', default=DEFAULT_CALIBRATION)
+    parser.add_argument('--calibration-dir', help='extra calibration images (recommended: a few hundred real photos)')
+    parser.add_argument('--calibration-limit', type=int, default=200)
+    parser.add_argument('--calibrate-method', default='MinMax', choices=['MinMax', 'Entropy', 'Percentile'])
+    parser.add_argument('--dynamic-op-types', nargs='*', default=['MatMul'],
+                        help='ops to quantize dynamically (ConvInteger is often slower than fp32 Conv on CPU)')
+    parser.add_argument('--eval-dir', help='evaluation images; sub-folder names matching categories are labels')
+    parser.add_argument('--eval-limit', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=3, help='timed passes per variant (best is reported)')
+    parser.add_argument('--skip-quantize', action='store_true', help='only run the comparison')
+    args = parser.parse_args()
+
+    calibration = calibration_images(args.calibration_npy, args.calibration_dir, args.calibration_limit)
+    if not args.skip_quantize:
+        if not calibration:
+            parser.error('no calibration images')
+        quantize(args.model, calibration, args)
+
+    # Comparing must not overwrite the serving optimized graph with a variant's
+    config.ONNX_OPTIMIZED_MODEL_PATH = ''
+    images, labels = load_eval_set(args.eval_dir, args.eval_limit, calibration)
+    if not images:
+        parser.error('no evaluation images')
+    labeled = [i for i, label in enumerate(labels) if label is not None]
+    print(f"\nthreads intra={config.ONNX_INTRA_OP_THREADS or 'auto'}, {len(images)} images "
+          f"({len(labeled)} labeled), best of {args.repeats}")
+
+    reference = None
+    print(f"\n{'backend':<18} {'MiB':>6} {'ms/img':>8} {'speedup':>8} {'top-1 agree':>12} {'cosine':>7} {'accuracy':>9}")
+    for backend in ONNX_VARIANTS:
+        path = variant_path(args.model, backend)
+        if not os.path.exists(path):
+            print(f"{backend:<18} missing ({path})")
+            continue
+        embeddings, top1, ms = evaluate(path, images, args.repeats)
+        if reference is None:
+            reference = (embeddings, top1, ms)
+        ref_embeddings, ref_top1, ref_ms = reference
+        agree = float((top1 == ref_top1).mean())
+        cosine = float((embeddings * ref_embeddings).sum(axis=1).mean())
+        accuracy = (f"{np.mean([CATEGORY_NAMES[top1[i]] == labels[i] for i in labeled]):>9.3f}"
+                    if labeled else f"{'-':>9}")
+        print(f"{backend:<18} {os.path.getsize(path) / 2 ** 20:>6.1f} {ms:>8.1f} {ref_ms / ms:>7.2f}x "
+              f"{agree:>12.3f} {cosine:>7.4f} {accuracy}")
+
+
+if __name__ == '__main__':
+    main()
@@ -48,6 +48,7 @@ if __name__ == "__main__":
     parser.add_argument("--no-reload", action="store_true", help="Disable uvicorn reload")
     parser.add_argument("--upload-token", type=str, default=None, help="Optional upload token that the server requires")
     parser.add_argument("--persist-uploads", action="store_true", help="If set, do not remove uploaded files after processing")
+    parser.add_argument("--workers", type=int, default=1, help="Number of uvicorn worker processes (disables reload)")
     args = parser.parse_args()
 
     if args.allow_remote:
@@ -69,10 +70,29 @@ if __name__ == "__main__":
     if args.reload:
         srv_cfg.RELOAD = True
 
+    if args.workers > 1:
+        # Worker processes can't share the in-process JSON tag cache; switch to the
+        # SQLite tag store (workers inherit the environment) unless set explicitly.
+        if "TAGS_DB_BACKEND" not in os.environ:
+            os.environ["TAGS_DB_BACKEND"] = "sqlite"
+            print(f"Using SQLite tags DB for {args.workers} workers")
+        elif srv_cfg.TAGS_DB_BACKEND != "sqlite":
+            print(f"WARNING: TAGS_DB_BACKEND={srv_cfg.TAGS_DB_BACKEND} is not safe with multiple workers; use sqlite")
+        # The score, embedding, duplicate-hash and similar-group stores are
+        # whole-file rewrites of per-process state: workers would overwrite each
+        # other's files and silently drop records, so they are turned off.
+        for name in ("SCORE_STORE_ENABLED", "SEMANTIC_SEARCH_ENABLED",
+                     "DUPLICATE_HASHES_ENABLED", "SIMILAR_GROUPS_ENABLED"):
+            if getattr(srv_cfg, name):
+                print(f"WARNING: {name} is not supported with multiple workers; disabling it")
+            os.environ[name] = "False"
+        srv_cfg.RELOAD = False
+
     uvicorn.run(
         "backend.backend_api:app",
         host=host,
         port=args.port,
         reload=srv_cfg.RELOAD,
+        workers=args.workers,
         log_level="info"
     )